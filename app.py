@@ -1,17 +1,19 @@
-import ast
-import base64
-import glob
-import os
 import urllib.parse
 
 import pandas as pd
 import streamlit as st
-from massql import msql_engine
 from streamlit.components.v1 import html
 
 from queries import *
-from utils import gnps2_get_libray_dataframe_wrapper, \
-    get_git_short_rev, download_and_filter_mgf, insert_mgf_info, create_mirrorplot_link
+from artifact_store import ArtifactStore
+from exports import TABLE_FORMATS, write_gzip_copy
+from jobs import DONE, FAILED, QUEUED, RUNNING, JobManager
+from query_engine import QUERY_WORKERS
+from query_plans import get_plan_cache
+from perf import PERF_LOG
+from prefetch import PREFETCH_ENABLED, Prefetcher, is_task_id
+from results_view import render_download, render_performance, render_results_table
+from utils import download_and_filter_mgf, get_git_short_rev, insert_mgf_info
 from welcome import welcome_page
 
 page_title = "Post MN MassQL"
@@ -35,166 +37,174 @@ citations = {
     "N-acyl lipids queries": """Mannochio-Russo, H., Charron-Lamoureux, V., van Faassen, M., et al. (2025).  The microbiome diversifies N-acyl lipid pools – including short-chain fatty acid-derived compounds. Cell, 188(15), 4154–4169.e19. https://doi.org/10.1016/j.cell.2025.05.015""",
 }
 
-def run_analysis(task_id, custom_queries):
+@st.cache_resource
+def get_flattened_queries() -> dict:
+    """Entries of the query menu, built once per server process; treat it as read-only."""
+    # Flatten only the Compendium queries
+    flattened_queries = {"Manual entry": {"query1": ""}}
+    for category, query_dict in ALL_QUERIES.items():
+        if "Compendium" in category:
+            for name, query in query_dict.items():
+                label = f"{name}"
+                flattened_queries[label] = {label: query}
+        else:
+            flattened_queries[category] = query_dict
+    return flattened_queries
+
+
+@st.cache_resource
+def get_email_link() -> str:
+    """Link to the email template for adding a predefined query, read once per server process."""
+    with open("email_template.txt", "r") as file:
+        email_template = file.read()
+
+    subject = urllib.parse.quote("Compendium query addition")
+    body = urllib.parse.quote(email_template, safe="")
+    return f"mailto:hmannochiorusso@health.ucsd.edu?subject={subject}&body={body}"
+
+
+@st.cache_resource
+def get_job_manager():
+    """One job manager per server process, shared by all sessions."""
+    return JobManager()
+
+
+@st.cache_resource
+def get_prefetcher():
+    """One prefetcher per server process, shared by all sessions."""
+    return Prefetcher()
+
+
+def update_prefetches(task_ids: list):
+    """Prefetch the tasks entered in this session, and withdraw the prefetches of tasks no longer entered."""
+    previous = st.session_state.get("prefetch_task_ids", [])
+    for task_id in previous:
+        if task_id not in task_ids:
+            get_prefetcher().cancel(task_id)
+    for task_id in task_ids:
+        if task_id not in previous:
+            get_prefetcher().prefetch(task_id)
+    st.session_state.prefetch_task_ids = task_ids
+
+
+def prefetch_pending(task_ids: list) -> bool:
+    return any((get_prefetcher().status(task_id) or (None,))[0] in (QUEUED, RUNNING) for task_id in task_ids)
+
+
+def render_prefetch_status(task_ids: list):
+    statuses = {task_id: get_prefetcher().status(task_id) for task_id in task_ids}
+    statuses = {task_id: status for task_id, status in statuses.items() if status is not None}
+    for task_id, (state, message) in statuses.items():
+        if state == FAILED:
+            st.caption(f"Could not fetch the files of task {task_id} yet: {message}")
+    fetching = sum(state in (QUEUED, RUNNING) for state, _ in statuses.values())
+    tasks = "the task" if len(task_ids) == 1 else f"{len(task_ids)} tasks"
+    if fetching:
+        st.caption(f"Fetching the files of {tasks} in the background...")
+    elif statuses and all(state == DONE for state, _ in statuses.values()):
+        st.caption(f"The files of {tasks} are ready.")
+
+
+@st.fragment(run_every=1.0)
+def poll_prefetch_status(task_ids: list):
+    render_prefetch_status(task_ids)
+    if not prefetch_pending(task_ids):
+        # The page is rerun once, and shows the final status without polling
+        st.rerun()
+
+
+def show_prefetch_status(task_ids: list):
+    """Show whether the files of the entered tasks have been fetched in the background, refreshed while they are."""
+    (poll_prefetch_status if prefetch_pending(task_ids) else render_prefetch_status)(task_ids)
+
+
+@st.cache_resource(max_entries=8)
+def load_job_results(job_id: str) -> dict:
+    return get_job_manager().results(job_id)
+
+
+@st.fragment(run_every=1.0)
+def show_job_progress(job_id: str):
     """
-    Main analysis function that processes GNPS2 task data with MassQL queries.
-    
-    Args:
-        task_id (str): GNPS2 task ID to analyze
-        custom_queries (dict): Dictionary of query names and their MassQL queries
-    
-    Returns:
-        dict: Analysis results containing library_final, full_table, executed_queries, and task_id
+    Poll the job's status and rerun the page once it has finished; only shown for queued and
+    running jobs, so the finished page does not poll.
     """
-    st.title("🔬 Post Molecular Networking MassQL")
-    
-    # Initialize a list to store the queries that were run
-    executed_queries = []
-
-    with st.spinner("Downloading files and running queries..."):
-        try:
-            library_matches = gnps2_get_libray_dataframe_wrapper(task_id)
-            cleaned_mgf_path, all_scans, pepmass_list = download_and_filter_mgf(task_id)
-            mgf_path = cleaned_mgf_path
-        except Exception as e:
-            st.error(f"Error downloading files: {str(e)}")
-            st.stop()
-
-    with st.spinner("Running MassQL queries... This may take a while, please be patient!"):
-        all_query_results_df = []
-        container = st.empty()
-        for query_name, input_query in custom_queries.items():
-            with container:
-                st.write(f"Running query: {query_name}")
-                executed_queries.append(f"{query_name}: {input_query}")
-                try:
-                    results_df = msql_engine.process_query(input_query, mgf_path)
-                except KeyError:
-                    results_df = pd.DataFrame()
-
-            if len(results_df) == 0:
-                all_query_results_df.append({"query": query_name, "scan_list": "NA"})
-            else:
-                passed_scan_ls = results_df["scan"].values.tolist()
-                passed_scan_ls = [int(x) for x in passed_scan_ls]
-                all_query_results_df.append({"query": query_name, "scan_list": passed_scan_ls})
-
-        all_query_results_df = pd.DataFrame(all_query_results_df)
-        all_query_results_df["scan_list"] = all_query_results_df["scan_list"].replace("NA", "[]")
-        all_query_results_df["scan_list"] = all_query_results_df["scan_list"].apply(
-            lambda x: ast.literal_eval(x) if isinstance(x, str) else x)
-        all_query_results_df = all_query_results_df.explode("scan_list")
-        all_query_results_df = all_query_results_df.rename(
-            columns={"scan_list": "#Scan#", "query": "query_validation"})
-
-    with st.spinner("Merging and displaying results..."):
-        all_query_results_df["#Scan#"] = all_query_results_df["#Scan#"].astype(str)
-        library_matches["#Scan#"] = library_matches["#Scan#"].astype(str)
-
-        library_final = pd.merge(library_matches, all_query_results_df, on="#Scan#", how="left")
-        fallback_label = "Did not pass any selected query"
-        library_final["query_validation"] = library_final["query_validation"].fillna(fallback_label)
-        create_mirrorplot_link(library_final, task_id)
-
-        column_order = ["mirror_link", "query_validation", "Compound_Name"]
-        library_final = library_final[
-            column_order + [col for col in library_final.columns if
-                     col not in column_order]]
-
-        library_final = library_final.groupby("#Scan#", as_index=False).agg(
-            {
-                "query_validation": lambda x: ", ".join(set(x)),
-                **{
-                    col: "first"
-                    for col in library_final.columns
-                    if col not in ["#Scan#", "query_validation"]
-                },
-            }
-        )
+    status = get_job_manager().status(job_id)
+    if status is None or status["state"] not in (QUEUED, RUNNING):
+        st.rerun()
+    st.progress(status["progress"], text=status["message"])
 
-        # Create full table
-        all_scans_df = pd.DataFrame({'#Scan#': all_scans})
-        all_scans_df['#Scan#'] = all_scans_df['#Scan#'].astype(str)
-        all_scans_df['pepmass'] = pepmass_list
-
-        full_table = pd.merge(all_scans_df, all_query_results_df, on='#Scan#', how='left')
-        full_table = pd.merge(full_table, library_matches, on='#Scan#', how='left')
-        full_table['query_validation'] = full_table['query_validation'].fillna(fallback_label)
-        create_mirrorplot_link(full_table, task_id)
-
-        # Allow multiple queries per scan in the full table
-        col_order = ['#Scan#', 'pepmass', 'mirror_link', 'query_validation', 'Compound_Name']
-        full_table = full_table.groupby("#Scan#", as_index=False).agg(
-            {
-                "query_validation": lambda x: ", ".join(set(x)),
-                **{
-                    col: "first"
-                    for col in full_table.columns
-                    if col not in col_order
-                },
-            }
-        )
 
-        # Clean up temporary files
-        feather_files = glob.glob("temp_mgf/*.feather")
-        for file in feather_files:
-            try:
-                os.remove(file)
-            except Exception as e:
-                st.warning(f"Could not delete {file}: {e}")
+def query_checks_pending(custom_queries: dict) -> bool:
+    return any(get_plan_cache().status(query)[0] == "pending" for query in custom_queries.values())
 
-    st.success("Analysis complete!", icon="✅")
-    
-    return {
-        'library_final': library_final,
-        'full_table': full_table,
-        'executed_queries': executed_queries,
-        'task_id': task_id
-    }
 
+def render_query_checks(custom_queries: dict):
+    statuses = {name: get_plan_cache().status(query) for name, query in custom_queries.items()}
+    pending = sum(state == "pending" for state, _ in statuses.values())
+    for name, (state, message) in statuses.items():
+        if state == "error":
+            st.error(f"**{name}**: {message}", icon=":material/error:")
+        elif state == "warning":
+            st.warning(f"**{name}**: {message}", icon=":material/warning:")
+    if pending:
+        st.caption(f"Checking {pending} of {len(statuses)} queries...")
+    elif all(state == "ok" for state, _ in statuses.values()):
+        st.caption(f"All {len(statuses)} queries are valid.")
 
-@st.cache_data
-def cache_run_analysis(task_id, custom_queries):
-    return run_analysis(task_id, custom_queries)
 
+@st.fragment(run_every=1.0)
+def poll_query_checks(custom_queries: dict):
+    render_query_checks(custom_queries)
+    if not query_checks_pending(custom_queries):
+        # The page is rerun once, and shows the final checks without polling
+        st.rerun()
 
-def run_analysis_wrapper(task_id: str, custom_queries: dict):
-    """Retrieve cached results or run fresh analysis."""
-    if task_id == EXAMPLE_TASK_ID:
-        print('Triggering cache run - retrieve results from cache')
-        return cache_run_analysis(task_id, custom_queries)
-    else:
-        return run_analysis(task_id, custom_queries)
-    
-
-# Initialize session state for results
-if 'results_ready' not in st.session_state:
-    st.session_state.results_ready = False
-if 'analysis_results' not in st.session_state:
-    st.session_state.analysis_results = None
-
-# Flatten only the Compendium queries
-flattened_queries = {"Manual entry": {"query1": ""}}
-for category, query_dict in ALL_QUERIES.items():
-    if "Compendium" in category:
-        for name, query in query_dict.items():
-            label = f"{name}"
-            flattened_queries[label] = {label: query}
-    else:
-        flattened_queries[category] = query_dict
 
-# Generate link to email template (add a predefined query)
-with open("email_template.txt", "r") as file:
-    email_template = file.read()
+def show_query_checks(custom_queries: dict):
+    """Show whether the edited queries parse; they are parsed once, in the background, and cached."""
+    (poll_query_checks if query_checks_pending(custom_queries) else render_query_checks)(custom_queries)
+
+
+def render_table_download(job_id: str, table: pd.DataFrame, file_stem: str, task_id: str, executed_queries: list,
+                          key: str):
+    """Download of a results table in the format picked by the user, see exports.TABLE_FORMATS."""
+    table_format = st.columns([1, 3])[0].selectbox("Download format", list(TABLE_FORMATS), key=f"{key}_format")
+    extension, mime, writer = TABLE_FORMATS[table_format]
+    render_download(get_job_manager(), job_id, f"{file_stem}{extension}", f"{table_format} table",
+                    lambda path: writer(table, task_id, executed_queries, path), key=key, mime=mime)
+
+
+def show_executed_queries(executed_queries: list):
+    # Display the executed queries at the end
+    st.markdown("## Executed Queries")
+    st.text_area(
+        "All queries:", value="\n\n".join(executed_queries), height=300
+    )
+    queries_tsv = "\n".join([
+        f"{e}\t{f}" for e, f in [i.split(":", 1) for i in executed_queries]
+    ])
+    st.download_button("Download data as TSV", data=queries_tsv, file_name="executed_queries.tsv",
+                       mime="text/tab-separated-values", icon=":material/download:", on_click="ignore")
+
+
+def show_citations():
+    # Display citations
+    st.markdown("## Citations")
+    for key, citation in citations.items():
+        st.markdown(f"**{key}:** {citation}")
+
 
-subject = urllib.parse.quote("Compendium query addition")
-body = urllib.parse.quote(email_template, safe="")
-link = f"mailto:hmannochiorusso@health.ucsd.edu?subject={subject}&body={body}"
+# Only the job id is kept in the session; status and results are read from the job manager.
+# A shared ?job_id= link attaches to the same job.
+job_id = st.session_state.get("job_id") or st.query_params.get("job_id")
+job_status = get_job_manager().status(job_id) if job_id else None
+
+flattened_queries = get_flattened_queries()
+link = get_email_link()
 
-# Predefined example task ID
-EXAMPLE_TASK_ID = "a322acf7936c4f91a41fd2f267d9b613" # FBMN_CMMC_Workshop_including_druganalog
 EXAMPLE_DESCRIPTION = f"""- HNRC cohort samples of 10 cognitively impaired, 10 non impaired pacients, all from the HIV+ group
-- **Executed Queries**: Bile acids (stage 1) queries
+- **Executed Queries**: {EXAMPLE_QUERY_GROUP}
 - [Go to FBMN job](https://gnps2.org/status?task={EXAMPLE_TASK_ID})"""
 
 # Sidebar Configuration
@@ -206,8 +216,17 @@ with st.sidebar:
 
     query_params = st.query_params
 
+    compare_tasks = st.checkbox("🧮 Compare several tasks", disabled=load_example,
+                                help="Run the selected queries against several GNPS2 tasks at the same time")
+    compare_tasks = compare_tasks and not load_example
+    task_ids = []
+
     # Input task ID with example functionality
-    if load_example:
+    if compare_tasks:
+        task_id = ""
+        task_ids_text = st.text_area("Enter GNPS2 Task IDs", placeholder="One GNPS2 task ID per line")
+        task_ids = list(dict.fromkeys(t.strip() for t in task_ids_text.replace(",", "\n").split("\n") if t.strip()))
+    elif load_example:
         task_id = st.text_input(
             "Enter GNPS2 Task ID",
             placeholder="Enter a GNPS2 task ID",
@@ -221,11 +240,18 @@ with st.sidebar:
             value=query_params.get("task_id", ""),
         ).strip()
 
+    # Download and clean the task files while the queries are picked; the analysis reuses them
+    if PREFETCH_ENABLED:
+        prefetch_task_ids = [t for t in (task_ids if compare_tasks else [task_id]) if is_task_id(t)]
+        update_prefetches(prefetch_task_ids)
+        if prefetch_task_ids:
+            show_prefetch_status(prefetch_task_ids)
+
     # Multiselect to choose one or more queries or groups
     defined_query_modes = st.multiselect(
         f"Select queries ([add new query]({link}))",
         list(flattened_queries.keys()),
-        default=['Bile acids (stage 1) queries'] if load_example else None,
+        default=[EXAMPLE_QUERY_GROUP] if load_example else None,
     )
 
     # Combine selected queries
@@ -236,6 +262,7 @@ with st.sidebar:
     # Show query editor in sidebar if queries are selected
     custom_queries = {}
     run_button = False
+    run_parallel = False
 
     if selected_query_dict:
         st.markdown("### Query Editor")
@@ -256,22 +283,33 @@ with st.sidebar:
         # Update custom queries
         def get_custom_queries(df):
             return {
-                row["name"]: row["query"]
-                for _, row in df.iterrows()
-                if row["name"] and row["query"]
+                name: query
+                for name, query in zip(df["name"], df["query"])
+                if name and query
             }
 
 
         custom_queries = get_custom_queries(edited_df)
+        show_query_checks(custom_queries)
+
+        if task_ids:
+            run_parallel = st.checkbox(
+                "Analyze tasks in parallel", value=QUERY_WORKERS > 1, disabled=QUERY_WORKERS <= 1,
+                help=f"Analyze up to {QUERY_WORKERS} tasks at the same time, each in its own worker process")
+        else:
+            run_parallel = st.checkbox(
+                "Run queries in parallel", value=QUERY_WORKERS > 1, disabled=QUERY_WORKERS <= 1,
+                help=f"Spread the selected queries over up to {QUERY_WORKERS} worker processes")
 
         run_button = st.button("Run Analysis", icon=":material/play_arrow:",type="primary", width='content')
 
     # Reset results button
-    if st.session_state.results_ready:
+    if job_status is not None:
         if st.button("New Analysis", icon=":material/replay:", width='content'):
-            st.session_state.results_ready = False
-            st.session_state.analysis_results = None
+            # Withdrawn first, since clearing the session forgets which tasks it asked for
+            update_prefetches([])
             st.session_state.clear()
+            st.query_params.pop("job_id", None)
             st.rerun()
 
     st.subheader("Contributors")
@@ -293,28 +331,104 @@ with st.sidebar:
     )
 
 # Main page content
-if not st.session_state.results_ready:
-    if not run_button:
-        # Show welcome page
-        welcome_page()
+if run_button:
+    # Run analysis was clicked
+    # Task IDs are also used in file names and server requests
+    rejected_task_ids = [t for t in (task_ids if compare_tasks else [task_id]) if t and not is_task_id(t)]
+    if compare_tasks and len(task_ids) < 2:
+        st.error("Please enter at least two GNPS2 Task IDs in the sidebar to compare them.")
+    elif not compare_tasks and not task_id:
+        st.error("Please enter a GNPS2 Task ID in the sidebar.")
+    elif rejected_task_ids:
+        st.error(f"Not GNPS2 Task IDs (32 hexadecimal characters): {', '.join(rejected_task_ids)}")
+    elif not custom_queries:
+        st.error("Please select at least one query in the sidebar.")
+    elif any(get_plan_cache().status(query)[0] == "error" for query in custom_queries.values()):
+        st.error("Some queries are invalid, please fix them in the query editor.")
+    elif task_ids:
+        # Every task is analyzed in its own worker process, with the queries parsed once
+        st.session_state.job_id = get_job_manager().submit_comparison(
+            task_ids, custom_queries, QUERY_WORKERS if run_parallel else 1)
+        st.query_params["job_id"] = st.session_state.job_id
+        st.rerun()
     else:
-        # Run analysis was clicked
-        if not task_id:
-            st.error("Please enter a GNPS2 Task ID in the sidebar.")
-        elif not custom_queries:
-            st.error("Please select at least one query in the sidebar.")
+        # The analysis runs in the background; identical runs attach to the existing job, and
+        # a new run on the same task only runs the queries edited since the last one
+        st.session_state.job_id = get_job_manager().submit(
+            task_id, custom_queries, QUERY_WORKERS if run_parallel else 1, previous_job_id=job_id)
+        st.query_params["job_id"] = st.session_state.job_id
+        st.rerun()
+
+if job_status is None:
+    if job_id:
+        st.warning(f"Analysis job {job_id} was not found, it may have expired. Please run the analysis again.")
+    # Show welcome page
+    welcome_page()
+
+elif job_status["state"] in (QUEUED, RUNNING):
+    st.title("🔬 Post Molecular Networking MassQL")
+    analyzed = "tasks" if job_status.get("kind") == "comparison" else "task"
+    st.info(f"Analyzing {analyzed} {job_status['task_id']}. This may take a while; you can reload the page or "
+            f"share its link, the analysis keeps running in the background.", icon="⏳")
+    show_job_progress(job_id)
+
+elif job_status["state"] == FAILED:
+    st.title("🔬 Post Molecular Networking MassQL")
+    st.error(job_status["message"])
+
+elif job_status.get("kind") == "comparison":
+    # Display the comparison of several tasks
+    results = load_job_results(job_id)
+    hit_counts = results['hit_counts']
+    executed_queries = results['executed_queries']
+    query_names = [eq.split(":", 1)[0].strip() for eq in executed_queries]
+
+    st.title("⚖️ MassQL Comparison")
+    for failed_task, error in results['errors'].items():
+        st.error(f"Task {failed_task} failed: {error}")
+
+    tab_counts, tab_tasks, tab3, tab_perf, tab4 = st.tabs(
+        [
+            "🧮 Hit Counts",
+            "📋 Task Tables",
+            "🛠️ Executed Queries",
+            "⏱️ Performance",
+            "📖 Citations",
+        ]
+    )
+
+    with tab_counts:
+        st.markdown("## Scans Passing Each Query")
+        st.caption(f"One row per task, one column per query; {len(results['task_ids'])} tasks compared.")
+        st.dataframe(hit_counts, width='content')
+        render_download(get_job_manager(), job_id, "hit_counts.tsv", "TSV table",
+                        lambda path: hit_counts.to_csv(path, sep="\t"), key="hit_counts_download")
+
+    with tab_tasks:
+        if results['tasks']:
+            task_id = st.selectbox("Task", list(results['tasks']))
+            full_table = results['tasks'][task_id]['full_table']
+            st.markdown(f"## Full Table of Task {task_id}")
+            render_results_table(full_table, query_names, key=f"full_{task_id}")
+            render_table_download(job_id, full_table, f"{task_id}_full_table", task_id, executed_queries,
+                                  key=f"full_download_{task_id}")
         else:
-            # Call warpper to retrieve cached results or run fresh analysis
-            results = run_analysis_wrapper(task_id, custom_queries)
+            st.info("None of the tasks could be analyzed.")
 
-            # Store results in session state
-            st.session_state.analysis_results = results
-            st.session_state.results_ready = True
-            st.rerun()
+    with tab3:
+        show_executed_queries(executed_queries)
+
+    with tab_perf:
+        st.markdown("## Performance")
+        st.caption(f"Measurements of this comparison, its tasks and its exports, also logged to {PERF_LOG}.")
+        render_performance(get_job_manager().perf_records(job_id))
+
+    with tab4:
+        show_citations()
 
 else:
     # Display results
-    results = st.session_state.analysis_results
+    results = load_job_results(job_id)
     library_final = results['library_final']
     full_table = results['full_table']
     executed_queries = results['executed_queries']
@@ -322,38 +436,23 @@ else:
 
     st.title(f"⚖️ MassQL Results")
 
-    tab1, tab2, tab3, tab4 = st.tabs(
+    tab1, tab2, tab3, tab_perf, tab4 = st.tabs(
         [
             "📚 Library Matches",
             "📋 Full Table",
             "🛠️ Executed Queries",
+            "⏱️ Performance",
             "📖 Citations",
         ]
     )
 
+    query_names = [eq.split(":", 1)[0].strip() for eq in executed_queries]
+
     with tab1:
         st.markdown("## Table With Library Matches Only")
-        st.dataframe(library_final, width='content', column_config={
-            "mirror_link": st.column_config.LinkColumn("Mirror plot", width='small', display_text="View")})
-
-        # Build a multi-line header: one item per line as "key<TAB>value"
-        header_lines = [f"task_id\t{task_id}"]
-        for eq in executed_queries:
-            try:
-                name, q = eq.split(":", 1)
-                name = name.strip()
-                # sanitize value: remove tabs/newlines to keep TSV integrity
-                q = q.strip().replace('\t', ' ').replace('\n', ' ')
-                header_lines.append(f"{name}\t{q}")
-            except Exception:
-                # If parsing fails, skip this entry
-                continue
-
-        header_text = "\n".join(header_lines) + "\n"
-        library_download = header_text + "\n" + library_final.to_csv(sep='\t', index=False)
-        b64 = base64.b64encode(library_download.encode()).decode()
-        href = f'<a href="data:file/csv;base64,{b64}" download="library_matches.tsv">Download TSV table</a>'
-        st.markdown(href, unsafe_allow_html=True)
+        render_results_table(library_final, query_names, key="library")
+        render_table_download(job_id, library_final, "library_matches", task_id, executed_queries,
+                              key="library_download")
 
         # Summary for library table
         st.markdown("#### Summary for Library Table")
@@ -362,34 +461,14 @@ else:
         query_summary_library = library_final.groupby('query_validation')['#Scan#'].nunique().reset_index()
 
         st.write("Number of scans that matched each query:")
-        st.dataframe(query_summary_library.rename(columns={"#Scan#": "Number of Scans"}), width='content',
-                     column_config={
-                         "mirror_link": st.column_config.LinkColumn("Mirror plot", width='small', display_text="View")}
-                     )
+        st.dataframe(query_summary_library.rename(columns={"#Scan#": "Number of Scans"}), width='content')
 
     with tab2:
         st.markdown("## Full Table With All Scans")
-        st.dataframe(full_table, width='content',
-                     column_config={
-                         "mirror_link": st.column_config.LinkColumn("Mirror plot", width='small', display_text="View")}
-                     )
-
-        # Prepend the same multi-line header to the full table TSV
-        header_lines = [f"task_id\t{task_id}"]
-        for eq in executed_queries:
-            try:
-                name, q = eq.split(":", 1)
-                name = name.strip()
-                q = q.strip().replace('\t', ' ').replace('\n', ' ')
-                header_lines.append(f"{name}\t{q}")
-            except Exception:
-                continue
-
-        header_text = "\n".join(header_lines) + "\n"
-        full_download = header_text + "\n" + full_table.to_csv(sep='\t', index=False)
-        b64 = base64.b64encode(full_download.encode()).decode()
-        href = f'<a href="data:file/csv;base64,{b64}" download="full_table.tsv">Download TSV table</a>'
-        st.markdown(href, unsafe_allow_html=True)
+        render_results_table(full_table, query_names, key="full")
+
+        # TSV downloads start with the task ID and queries, Parquet and Feather keep them as metadata
+        render_table_download(job_id, full_table, "full_table", task_id, executed_queries, key="full_download")
 
         # Summary for full table
         st.markdown("#### Summary for Full Table")
@@ -403,33 +482,47 @@ else:
         st.dataframe(query_summary_full, width='content')
 
     with tab3:
-        # Display the executed queries at the end
-        st.markdown("## Executed Queries")
-        st.text_area(
-            "All queries:", value="\n\n".join(executed_queries), height=300
-        )
-        queries_tsv = "\n".join([
-            f"{e}\t{f}" for e, f in [i.split(":", 1) for i in executed_queries]
-        ])
-        b64 = base64.b64encode(queries_tsv.encode()).decode()
-        href = f'<a href="data:file/csv;base64,{b64}" download="executed_queries.tsv">Download data as TSV</a>'
-        st.markdown(href, unsafe_allow_html=True)
+        show_executed_queries(executed_queries)
+
+    with tab_perf:
+        st.markdown("## Performance")
+        st.caption(f"Measurements of this analysis and its exports, also logged to {PERF_LOG}.")
+        render_performance(get_job_manager().perf_records(job_id))
 
     with tab4:
-        # Display citations
-        st.markdown("## Citations")
-        for key, citation in citations.items():
-            st.markdown(f"**{key}:** {citation}")
+        show_citations()
 
     st.subheader("Download MGF with validated scans")
 
+    compress_mgf = st.checkbox("Compress with gzip", key="mgf_gzip",
+                               help="Download a .mgf.gz file, several times smaller than the MGF")
     if st.button("Generate MGF with validated scans", type="primary", icon=":material/manufacturing:"):
-        buf = insert_mgf_info(task_id, f'./temp_mgf/{task_id}_mgf_cleaned.mgf',
-                              full_table[["#Scan#", "query_validation"]].astype(str))
-        st.download_button(
-            label="Download validated MGF",
-            data=buf.getvalue(),
-            file_name=f"{task_id}_validated_scans.mgf",
-            mime="txt/plain",
-            icon=":material/download:"
-        )
+        perf = get_job_manager().perf_recorder(job_id)
+        # The task's files are not evicted by downloads of other tasks while they are exported
+        with ArtifactStore().reading(task_id):
+            try:
+                with perf.stage("export", file="validated.mgf"):
+                    # The cleaned MGF may have been evicted since the analysis, or never fetched when
+                    # every query came from the result cache; it is downloaded again if so
+                    cleaned_mgf, _, _ = download_and_filter_mgf(task_id, perf=perf)
+                    validated_mgf = insert_mgf_info(task_id, cleaned_mgf,
+                                                    full_table[["#Scan#", "query_validation"]].astype(str))
+            except Exception as e:
+                st.error(f"Could not generate the MGF of task {task_id}: {e}")
+                st.stop()
+            finally:
+                perf.flush()
+            download_path, file_name, mime = validated_mgf, f"{task_id}_validated_scans.mgf", "txt/plain"
+            if compress_mgf:
+                # Compressed from the validated MGF on disk and kept with the job results
+                file_name, mime = f"{file_name}.gz", "application/gzip"
+                download_path = get_job_manager().export(job_id, file_name,
+                                                         lambda path: write_gzip_copy(validated_mgf, path))
+            with open(download_path, "rb") as validated_file:
+                st.download_button(
+                    label="Download validated MGF",
+                    data=validated_file,
+                    file_name=file_name,
+                    mime=mime,
+                    icon=":material/download:"
+                )
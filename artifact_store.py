@@ -0,0 +1,203 @@
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from result_cache import file_sha256
+
+TEMP_MGF_DIR = "temp_mgf"
+# Byte budget for the per-task files in temp_mgf/ (MGFs and massql feather caches)
+TEMP_MGF_MAX_BYTES = int(os.environ.get("MASSQL_TEMP_MGF_MAX_BYTES", str(20 * 1024 ** 3)))
+
+# Manifest path -> (file identity, parsed manifest), shared by the stores of a process
+_manifest_cache = {}
+
+
+class ArtifactStore:
+    """
+    Managed store for the per-task files in temp_mgf/.
+
+    - files are written to a temporary name and atomically renamed into place
+    - a manifest records the size and SHA-256 of every committed file, so that a
+      half-written or corrupted file is never trusted
+    - a per-task file lock makes concurrent sessions on the same task wait for a single
+      download instead of racing on the same paths
+    - least recently used tasks are evicted to keep the directory under a byte budget, except
+      tasks being downloaded or read (see reading())
+
+    All files of a task share the "{task_id}_" prefix and are evicted together.
+    """
+
+    def __init__(self, root: str = TEMP_MGF_DIR, max_bytes: int = TEMP_MGF_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.manifest_path = os.path.join(root, "manifest.json")
+        self.lock_dir = os.path.join(root, "locks")
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    @contextmanager
+    def _flock(self, lock_name: str, blocking: bool = True, shared: bool = False):
+        with open(os.path.join(self.lock_dir, lock_name), "a") as lock_file:
+            flags = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_file, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextmanager
+    def task_lock(self, task_id: str, part: str = None):
+        """
+        Hold the task's lock; other sessions on the same task block until it is released.
+
+        A part names a separate lock of the task, for a file downloaded alongside the MGF.
+        """
+        with self._flock(f"{task_id}.{part}.lock" if part else f"{task_id}.lock"):
+            yield
+
+    @contextmanager
+    def reading(self, task_id: str):
+        """
+        Keep the task's files from being evicted while they are read, e.g. by the queries or an
+        export. Any number of threads and processes may read the same task at once.
+        """
+        with self._flock(f"{task_id}.read.lock", shared=True):
+            yield
+
+    def _read_manifest(self) -> dict:
+        try:
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _cached_manifest(self) -> dict:
+        """The manifest, parsed again only when the file was replaced since the last read; not to be modified."""
+        try:
+            stat = os.stat(self.manifest_path)
+        except OSError:
+            return {}
+        # Every write replaces the file, so a new inode or mtime means new content
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached = _manifest_cache.get(self.manifest_path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        manifest = self._read_manifest()
+        _manifest_cache[self.manifest_path] = (key, manifest)
+        return manifest
+
+    def _write_manifest(self, manifest: dict):
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    @contextmanager
+    def _manifest(self):
+        with self._flock("manifest.lock"):
+            manifest = self._read_manifest()
+            yield manifest
+            self._write_manifest(manifest)
+
+    @contextmanager
+    def atomic_write(self, task_id: str, name: str):
+        """
+        Yield a temporary path to write the file to; on success it is renamed to `name`
+        and recorded in the manifest, on failure it is removed.
+        """
+        tmp_path = f"{self.path(name)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            yield tmp_path
+            self.commit(task_id, name, tmp_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def commit(self, task_id: str, name: str, src_path: str):
+        """Atomically move a fully written file into place as `name` and record it in the manifest."""
+        final_path = self.path(name)
+        os.replace(src_path, final_path)
+
+        entry = {"task_id": task_id, "size": os.path.getsize(final_path),
+                 "sha256": file_sha256(final_path), "last_access": time.time()}
+        with self._manifest() as manifest:
+            manifest[name] = entry
+
+    def verify(self, name: str) -> bool:
+        """True if the file was committed through the store and still matches its checksum."""
+        entry = self._cached_manifest().get(name)
+        path = self.path(name)
+        if entry is None or not os.path.exists(path):
+            return False
+        return os.path.getsize(path) == entry["size"] and file_sha256(path) == entry["sha256"]
+
+    def exists(self, name: str) -> bool:
+        """
+        Cheaper check than verify(): the file was committed through the store and still
+        has its recorded size. Meant for files that are opened often, e.g. memory-mapped.
+        """
+        entry = self._cached_manifest().get(name)
+        path = self.path(name)
+        return entry is not None and os.path.exists(path) and os.path.getsize(path) == entry["size"]
+
+    def checksum(self, name: str) -> str:
+        """Recorded SHA-256 of a committed file."""
+        return self._cached_manifest()[name]["sha256"]
+
+    def touch(self, name: str):
+        with self._manifest() as manifest:
+            if name in manifest:
+                manifest[name]["last_access"] = time.time()
+
+    def evict(self, keep=()):
+        """
+        Remove least recently used tasks until temp_mgf/ fits in the byte budget.
+        Tasks in `keep`, tasks whose lock is currently held and tasks being read are never evicted.
+        """
+        with self._manifest() as manifest:
+            last_access = {}
+            for entry in manifest.values():
+                last_access[entry["task_id"]] = max(last_access.get(entry["task_id"], 0), entry["last_access"])
+
+            # Account for every file of a task, including the ones massql writes next to the MGF
+            task_files = {task_id: [] for task_id in last_access}
+            total_bytes = 0
+            for name in os.listdir(self.root):
+                path = self.path(name)
+                if not os.path.isfile(path):
+                    continue
+                size = os.path.getsize(path)
+                total_bytes += size
+                task_id = name.split("_", 1)[0]
+                if task_id in task_files:
+                    task_files[task_id].append((name, size))
+
+            for task_id in sorted(last_access, key=last_access.get):
+                if total_bytes <= self.max_bytes:
+                    break
+                if task_id in keep:
+                    continue
+                with self._flock(f"{task_id}.lock", blocking=False) as acquired, \
+                        self._flock(f"{task_id}.read.lock", blocking=False) as unread:
+                    if not (acquired and unread):
+                        continue
+                    print(f"Evicting temp_mgf files of task {task_id}")
+                    for name, size in task_files[task_id]:
+                        try:
+                            os.remove(self.path(name))
+                            total_bytes -= size
+                        except OSError:
+                            pass
+                        manifest.pop(name, None)
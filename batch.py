@@ -0,0 +1,114 @@
+"""
+Run MassQL query groups over many GNPS2 tasks without the Streamlit UI.
+
+Example:
+    python batch.py TASK_ID [TASK_ID ...] --groups "Bile acids (stage 1) queries" "N-acyl lipids queries"
+    python batch.py --task-file tasks.txt --groups "Compendium" --processes 4 --output-dir batch_output
+"""
+import argparse
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from exports import write_tsv
+from pipeline import run_pipeline
+from queries import ALL_QUERIES
+
+
+def _process_task(task_id: str, custom_queries: dict, output_dir: str, query_workers: int) -> dict:
+    """Analyze one task and write its tables; runs in a worker process."""
+    start_time = time.time()
+    try:
+        results = run_pipeline(task_id, custom_queries, query_workers)
+    except Exception as e:
+        traceback.print_exc()
+        return {"task_id": task_id, "status": "failed", "error": str(e), "seconds": time.time() - start_time}
+
+    task_dir = os.path.join(output_dir, task_id)
+    os.makedirs(task_dir, exist_ok=True)
+    for name, table in (("library_matches", results["library_final"]), ("full_table", results["full_table"])):
+        write_tsv(table, task_id, results["executed_queries"], os.path.join(task_dir, f"{name}.tsv"))
+
+    return {"task_id": task_id, "status": "ok", "seconds": time.time() - start_time,
+            "scans": len(results["full_table"]), "library_matches": len(results["library_final"])}
+
+
+def _read_task_ids(args) -> list:
+    task_ids = list(args.task_ids)
+    if args.task_file:
+        with open(args.task_file, "r") as f:
+            task_ids += [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    # Keep the first occurrence of every task
+    return list(dict.fromkeys(task_ids))
+
+
+def _print_summary(stats: list, n_queries: int, wall_seconds: float):
+    print("\nTask                               Status   Scans  Library    Time (s)")
+    for s in stats:
+        print(f"{s['task_id']:<34} {s['status']:<7} {s.get('scans', 0):>6} {s.get('library_matches', 0):>8} "
+              f"{s['seconds']:>11.1f}" + (f"  {s['error']}" if s["status"] != "ok" else ""))
+
+    done = [s for s in stats if s["status"] == "ok"]
+    scans = sum(s["scans"] for s in done)
+    print(f"\n{len(done)}/{len(stats)} tasks succeeded in {wall_seconds:.1f}s wall time")
+    if done and wall_seconds > 0:
+        print(f"Throughput: {len(done) / wall_seconds * 60:.2f} tasks/min, {scans / wall_seconds:.0f} scans/s, "
+              f"{len(done) * n_queries / wall_seconds:.2f} task-queries/s")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Run MassQL query groups over many GNPS2 tasks.")
+    parser.add_argument("task_ids", nargs="*", help="GNPS2 task IDs")
+    parser.add_argument("--task-file", help="File with one task ID per line")
+    parser.add_argument("--groups", nargs="+", default=[], metavar="GROUP",
+                        help="Query groups from queries.py to run (see --list-groups)")
+    parser.add_argument("--list-groups", action="store_true", help="List the available query groups and exit")
+    parser.add_argument("--output-dir", default="batch_output",
+                        help="Directory receiving one <task_id>/ folder of TSV tables per task")
+    parser.add_argument("--processes", type=int, default=min(4, os.cpu_count() or 1),
+                        help="Number of tasks processed in parallel")
+    parser.add_argument("--query-workers", type=int, default=1,
+                        help="Worker processes used for the queries of each task")
+    args = parser.parse_args(argv)
+
+    if args.list_groups:
+        for group, queries in ALL_QUERIES.items():
+            print(f"{group} ({len(queries)} queries)")
+        return 0
+
+    unknown = [group for group in args.groups if group not in ALL_QUERIES]
+    if unknown:
+        parser.error(f"unknown query groups: {', '.join(unknown)}; see --list-groups")
+    if not args.groups:
+        parser.error("select at least one query group with --groups")
+
+    task_ids = _read_task_ids(args)
+    if not task_ids:
+        parser.error("no task IDs given")
+
+    custom_queries = {}
+    for group in args.groups:
+        custom_queries.update(ALL_QUERIES[group])
+
+    print(f"Running {len(custom_queries)} queries over {len(task_ids)} tasks with {args.processes} processes")
+    start_time = time.time()
+    stats = []
+    with ProcessPoolExecutor(max_workers=max(1, min(args.processes, len(task_ids)))) as pool:
+        futures = [pool.submit(_process_task, task_id, custom_queries, args.output_dir, args.query_workers)
+                   for task_id in task_ids]
+        for future in as_completed(futures):
+            s = future.result()
+            stats.append(s)
+            print(f"[{len(stats)}/{len(task_ids)}] {s['task_id']}: {s['status']} in {s['seconds']:.1f}s")
+
+    # Report the tasks in the order they were given
+    order = {task_id: i for i, task_id in enumerate(task_ids)}
+    stats.sort(key=lambda s: order[s["task_id"]])
+    _print_summary(stats, len(custom_queries), time.time() - start_time)
+    return 0 if all(s["status"] == "ok" for s in stats) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
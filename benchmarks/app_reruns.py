@@ -0,0 +1,86 @@
+"""
+Time the Streamlit script of the app: its first run in a fresh process and later reruns.
+
+Streamlit runs app.py from the top on every interaction, so the cost of a rerun is paid on
+every click and keystroke. The script is run headless with Streamlit's AppTest, with no query
+selected (the welcome page) and with query groups loaded in the query editor. Every run appends
+one JSON line to the output file, like run_benchmarks.
+
+Run it in a fresh process, since the first run includes the imports of the app's modules:
+    python -m benchmarks.app_reruns
+    python -m benchmarks.app_reruns --groups "N-acyl lipids queries" --reruns 50
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import time
+import uuid
+
+from perf import max_rss_mb, rss_mb
+
+DEFAULT_GROUPS = ["Bile acids (stage 1) queries", "N-acyl lipids queries"]
+
+
+def _timed_run(app) -> float:
+    start_time = time.perf_counter()
+    app.run()
+    if app.exception:
+        raise RuntimeError(f"app.py raised: {app.exception[0].value}")
+    return time.perf_counter() - start_time
+
+
+def _wait_for_query_checks(app, timeout: float):
+    """Wait until the queries of the editor are parsed, so that parsing does not slow the reruns down."""
+    deadline = time.time() + timeout
+    while not any("valid" in caption.value or "invalid" in caption.value for caption in app.sidebar.caption):
+        if time.time() > deadline:
+            raise RuntimeError("The queries were not checked in time")
+        time.sleep(0.5)
+        app.run()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the reruns of the Streamlit script.")
+    parser.add_argument("--groups", nargs="+", default=DEFAULT_GROUPS, metavar="GROUP",
+                        help="Entries of the query menu loaded in the query editor")
+    parser.add_argument("--reruns", type=int, default=20, help="Timed reruns of each page")
+    parser.add_argument("--parse-timeout", type=float, default=600,
+                        help="Seconds to wait for the queries of the editor to be parsed")
+    parser.add_argument("--output", default=os.path.join("benchmark_output", "results.jsonl"),
+                        help="JSON lines file the records are appended to")
+    args = parser.parse_args(argv)
+
+    # Imported here so that the imports of app.py are part of its first run
+    from streamlit.testing.v1 import AppTest
+    from utils import get_git_short_rev
+
+    run_fields = {"run_id": uuid.uuid4().hex[:12], "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "git_rev": get_git_short_rev(), "python": platform.python_version(),
+                  "cpu_count": os.cpu_count(), "benchmark": "app_reruns"}
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+
+    def record(stage: str, seconds: list, **fields):
+        entry = dict(run_fields, stage=stage, seconds=round(statistics.median(seconds), 4),
+                     runs=len(seconds), min_seconds=round(min(seconds), 4), max_seconds=round(max(seconds), 4),
+                     **fields, rss_after_mb=round(rss_mb(), 1), max_rss_mb=round(max_rss_mb(), 1))
+        with open(args.output, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+        print(f"{stage:<16} {fields.get('page', ''):<8} median {entry['seconds'] * 1000:>8.1f} ms  "
+              f"({len(seconds)} runs, {entry['min_seconds'] * 1000:.1f}-{entry['max_seconds'] * 1000:.1f} ms)")
+
+    app = AppTest.from_file("app.py", default_timeout=120)
+    print(f"Run {run_fields['run_id']}, appending to {args.output}")
+    record("cold_start", [_timed_run(app)], page="welcome")
+    record("rerun", [_timed_run(app) for _ in range(args.reruns)], page="welcome")
+
+    app.sidebar.multiselect[0].set_value(args.groups)
+    app.run()
+    _wait_for_query_checks(app, args.parse_timeout)
+    record("rerun", [_timed_run(app) for _ in range(args.reruns)], page="editor", groups=args.groups)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,190 @@
+"""
+Time the stages of the analysis pipeline on synthetic tasks, offline.
+
+Every stage of every run appends one JSON line to the output file, so that runs on
+different commits or machines can be compared over time.
+
+Example:
+    python -m benchmarks.run_benchmarks --sizes 1000 10000 100000
+    python -m benchmarks.run_benchmarks --sizes 1000000 --groups "Bile acids (stage 1) queries" --workers 4
+    python -m benchmarks.run_benchmarks --sizes 10000 --trace-memory
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import time
+import tracemalloc
+import uuid
+
+import pandas as pd
+
+import query_engine
+import query_plans
+from artifact_store import ArtifactStore
+from benchmarks.synthetic_data import generate_dataset
+from exports import write_tsv
+from mgf_index import MgfIndexBuilder
+from perf import max_rss_mb, rss_mb
+from pipeline import build_result_tables
+from queries import ALL_QUERIES
+from query_plans import PlanCache, prepare_queries
+from spectra_store import SpectraStoreBuilder
+from utils import clean_mgf_file, create_mirrorplot_link, get_git_short_rev, insert_mgf_info
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+
+
+class StageRecorder:
+    """Run pipeline stages, measuring their wall time and memory, and append one JSON line per stage."""
+
+    def __init__(self, output_path: str, trace_memory: bool = False, **run_fields):
+        self.output_path = output_path
+        self.trace_memory = trace_memory
+        self.run_fields = run_fields
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+
+    def run(self, stage: str, func, *args, **fields):
+        """
+        Call func(*args) as the given stage and record it.
+
+        Args:
+            stage (str): Stage name, e.g. "clean" or "query"
+            func (callable): The stage
+            fields: Extra fields of the record, e.g. the query group
+
+        Returns:
+            The return value of func
+        """
+        if self.trace_memory:
+            tracemalloc.start()
+        rss_before = rss_mb()
+        start_time = time.perf_counter()
+        try:
+            result = func(*args)
+        finally:
+            seconds = time.perf_counter() - start_time
+            traced_peak = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+            if self.trace_memory:
+                tracemalloc.stop()
+
+        record = dict(self.run_fields, stage=stage, seconds=round(seconds, 4), **fields,
+                      traced_peak_mb=None if traced_peak is None else round(traced_peak / 1024 ** 2, 2),
+                      rss_before_mb=round(rss_before, 1), rss_after_mb=round(rss_mb(), 1),
+                      max_rss_mb=round(max_rss_mb(), 1))
+        with open(self.output_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        print(f"{record['n_spectra']:>9} {stage:<11} {fields.get('group', ''):<32} {seconds:>9.3f}s  "
+              f"RSS {record['rss_after_mb']} MB" +
+              (f", traced peak {record['traced_peak_mb']} MB" if traced_peak is not None else ""))
+        return result
+
+
+def clean_stage(store: ArtifactStore, task_id: str, raw_mgf: str) -> (str, list, list):
+    """Clean the raw MGF and build its spectra store and index, as after a download."""
+    cleaned_name = f"{task_id}_mgf_cleaned.mgf"
+    builder, index = SpectraStoreBuilder(store, task_id), MgfIndexBuilder()
+    try:
+        with store.atomic_write(task_id, cleaned_name) as tmp_path:
+            scan_list, pepmass_list = clean_mgf_file(raw_mgf, tmp_path, builder=builder, index=index)
+        index.write(store, task_id)
+        if builder.valid:
+            builder.write()
+    finally:
+        builder.discard()
+    return store.path(cleaned_name), scan_list, pepmass_list
+
+
+def load_stage(mgf_path: str):
+    """Load the peak tables of the task, without the in-process cache of earlier runs."""
+    query_engine._spectra_cache.clear()
+    return query_engine.load_task_spectra(mgf_path)
+
+
+def run_queries_stage(custom_queries: dict, mgf_path: str, workers: int, plans: dict) -> list:
+    return query_engine.run_queries(custom_queries, mgf_path, workers, plans=plans)
+
+
+def export_tsv_stage(library_final: pd.DataFrame, full_table: pd.DataFrame, task_id: str,
+                     executed_queries: list, out_dir: str) -> int:
+    """Write both tables as the batch runner does; returns the bytes written."""
+    total_bytes = 0
+    for name, table in (("library_matches", library_final), ("full_table", full_table)):
+        path = os.path.join(out_dir, f"{name}.tsv")
+        write_tsv(table, task_id, executed_queries, path)
+        total_bytes += os.path.getsize(path)
+    return total_bytes
+
+
+def benchmark_size(recorder: StageRecorder, n_spectra: int, groups: list, work_dir: str, seed: int, workers: int):
+    raw_mgf, library_path = generate_dataset(os.path.join(work_dir, "data"), n_spectra, seed)
+    library_matches = pd.read_csv(library_path, sep="\t")
+
+    # A fresh store per run, so that no file of a previous run is reused
+    task_id = f"synthetic{n_spectra}s{seed}"
+    store_dir = os.path.join(work_dir, "store", task_id)
+    shutil.rmtree(store_dir, ignore_errors=True)
+    store = ArtifactStore(store_dir, max_bytes=2 ** 62)
+
+    recorder.run_fields.update(n_spectra=n_spectra)
+    mgf_path, scan_list, pepmass_list = recorder.run("clean", clean_stage, store, task_id, raw_mgf)
+    recorder.run("load", load_stage, mgf_path, kept_spectra=len(scan_list))
+
+    for group in groups:
+        custom_queries = ALL_QUERIES[group]
+        executed_queries = [f"{query_name}: {input_query}" for query_name, input_query in custom_queries.items()]
+        fields = {"group": group, "n_queries": len(custom_queries)}
+
+        # Queries are parsed on the first size only, later sizes reuse the plans
+        plans = recorder.run("prepare", prepare_queries, custom_queries, **fields)
+        query_results = recorder.run("query", run_queries_stage, custom_queries, mgf_path, workers, plans,
+                                     workers=workers, **fields)
+        library_final, full_table = recorder.run(
+            "merge", build_result_tables, query_results, library_matches, scan_list, pepmass_list, task_id,
+            hits=sum(len(result["scan_list"]) for result in query_results), **fields)
+        recorder.run("links", create_mirrorplot_link, full_table.drop(columns="mirror_link"), task_id, **fields)
+        recorder.run("export_tsv", export_tsv_stage, library_final, full_table, task_id, executed_queries,
+                     store.root, **fields)
+        recorder.run("export_mgf", insert_mgf_info, task_id, mgf_path,
+                     full_table[["#Scan#", "query_validation"]].astype(str), store, **fields)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline on synthetic tasks.")
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES,
+                        help="Numbers of spectra of the synthetic tasks, e.g. 1000 10000 100000 1000000")
+    parser.add_argument("--groups", nargs="+", default=list(ALL_QUERIES), metavar="GROUP",
+                        help="Query groups from queries.py to run (default: all)")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes used for the queries")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+    parser.add_argument("--work-dir", default="benchmark_output",
+                        help="Directory for the synthetic data and the task files")
+    parser.add_argument("--output", default=os.path.join("benchmark_output", "results.jsonl"),
+                        help="JSON lines file the stage records are appended to")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Also record the peak of traced Python allocations per stage; this slows "
+                             "pure Python stages down several times, so timings of such runs are not comparable")
+    args = parser.parse_args(argv)
+
+    unknown = [group for group in args.groups if group not in ALL_QUERIES]
+    if unknown:
+        parser.error(f"unknown query groups: {', '.join(unknown)}")
+
+    recorder = StageRecorder(args.output, trace_memory=args.trace_memory,
+                             run_id=uuid.uuid4().hex[:12], timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                             git_rev=get_git_short_rev(), python=platform.python_version(),
+                             cpu_count=os.cpu_count(), seed=args.seed)
+    # Start from an empty plan cache, so that the prepare stage measures the parsing of the queries
+    plan_cache_dir = os.path.join(args.work_dir, "plan_cache")
+    shutil.rmtree(plan_cache_dir, ignore_errors=True)
+    query_plans._plan_cache = PlanCache(plan_cache_dir)
+
+    print(f"Run {recorder.run_fields['run_id']}, appending to {args.output}")
+    for n_spectra in args.sizes:
+        benchmark_size(recorder, n_spectra, args.groups, args.work_dir, args.seed, args.workers)
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
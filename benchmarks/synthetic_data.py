@@ -0,0 +1,145 @@
+"""
+Synthetic GNPS2-like inputs for the benchmarks: a raw specs_ms.mgf and the matching library table.
+
+Example:
+    python -m benchmarks.synthetic_data 100000 --output-dir benchmark_output/data
+"""
+import argparse
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from queries import ALL_QUERIES
+
+# Share of the spectra written without any peak, which the cleaner must drop
+PEAKLESS_FRACTION = 0.05
+# Share of the spectra built to pass one of the built-in queries
+PLANTED_FRACTION = 0.1
+# Share of the kept spectra with a library match
+LIBRARY_FRACTION = 0.1
+
+_MASS_CONDITION = re.compile(r"(MS2PROD|MS2NL|MS2PREC)=\(?([0-9.]+)")
+
+
+def query_signatures(query_groups: dict = ALL_QUERIES) -> list:
+    """
+    Fixed masses of the built-in queries, used to plant spectra that pass them.
+
+    Queries on variables (X) or MS1 data are skipped. Of an OR list, only the first mass is used.
+
+    Returns:
+        list: (precursor m/z or None, [fragment m/z], [neutral loss]) per query
+    """
+    signatures = []
+    for queries in query_groups.values():
+        for input_query in queries.values():
+            if "X" in input_query.split("WHERE", 1)[-1] or "MS1" in input_query:
+                continue
+            conditions = {"MS2PROD": [], "MS2NL": [], "MS2PREC": []}
+            for condition, value in _MASS_CONDITION.findall(input_query):
+                conditions[condition].append(float(value))
+            if conditions["MS2PROD"] or conditions["MS2NL"]:
+                precursor = conditions["MS2PREC"][0] if conditions["MS2PREC"] else None
+                signatures.append((precursor, conditions["MS2PROD"], conditions["MS2NL"]))
+    return signatures
+
+
+def write_synthetic_mgf(path: str, n_spectra: int, seed: int = 0) -> list:
+    """
+    Write a raw MGF with n_spectra spectra, like the specs_ms.mgf of a molecular networking task.
+
+    Spectra have 5 to 60 peaks, some with zero intensity. A PEAKLESS_FRACTION of them have
+    no peaks and a PLANTED_FRACTION carry the masses of a built-in query.
+
+    Args:
+        path (str): Output path
+        n_spectra (int): Number of spectra, including the peakless ones
+        seed (int): Seed of the random generator; the same seed writes the same file
+
+    Returns:
+        list: Scan numbers of the spectra that have peaks, i.e. the ones kept by the cleaner
+    """
+    rng = np.random.default_rng(seed)
+    signatures = query_signatures()
+    kept_scans = []
+    with open(path, "w") as f:
+        for scan in range(1, n_spectra + 1):
+            precursor = rng.uniform(150, 1200)
+            mz, intensity = np.array([]), np.array([])
+            if rng.random() >= PEAKLESS_FRACTION:
+                n_peaks = int(rng.integers(5, 61))
+                mz = rng.uniform(50, precursor, n_peaks)
+                intensity = rng.uniform(0, 1e4, n_peaks).round(1)
+                intensity[rng.random(n_peaks) < 0.05] = 0.0
+                if signatures and rng.random() < PLANTED_FRACTION:
+                    signature_precursor, fragments, losses = signatures[rng.integers(len(signatures))]
+                    precursor = signature_precursor or max(fragments + [precursor])
+                    planted = fragments + [precursor - loss for loss in losses]
+                    mz = np.concatenate([mz, planted])
+                    intensity = np.concatenate([intensity, np.full(len(planted), 2e4)])
+                order = np.argsort(mz)
+                mz, intensity = mz[order], intensity[order]
+                kept_scans.append(scan)
+
+            peaks = "".join(f"{m:.4f} {i:.1f}\n" for m, i in zip(mz.tolist(), intensity.tolist()))
+            f.write(f"BEGIN IONS\nFEATURE_ID={scan}\nPEPMASS={precursor:.5f}\nSCANS={scan}\n"
+                    f"RTINSECONDS={rng.uniform(30, 1200):.2f}\nCHARGE=1+\nMSLEVEL=2\n{peaks}END IONS\n\n")
+    return kept_scans
+
+
+def write_synthetic_library(path: str, scans: list, seed: int = 0) -> pd.DataFrame:
+    """
+    Write a library match table, like merged_results_with_gnps.tsv, for a LIBRARY_FRACTION of scans.
+
+    Some scans get two matches, as library searches can return several hits per scan.
+    """
+    rng = np.random.default_rng(seed + 1)
+    matched = np.sort(rng.choice(scans, size=int(len(scans) * LIBRARY_FRACTION), replace=False))
+    matched = np.sort(np.concatenate([matched, matched[rng.random(len(matched)) < 0.1]]))
+    ids = np.arange(len(matched))
+    library = pd.DataFrame({
+        "#Scan#": matched,
+        "SpectrumID": [f"CCMSLIB{i:011d}" for i in ids],
+        "Compound_Name": [f"Synthetic compound {i}" for i in ids],
+        "MQScore": rng.uniform(0.7, 1.0, len(matched)).round(4),
+        "SharedPeaks": rng.integers(4, 30, len(matched)),
+        "MZErrorPPM": rng.uniform(-10, 10, len(matched)).round(3),
+        "Adduct": "M+H",
+        "LibraryName": "synthetic-library.mgf",
+    })
+    library.to_csv(path, sep="\t", index=False)
+    return library
+
+
+def generate_dataset(output_dir: str, n_spectra: int, seed: int = 0) -> (str, str):
+    """
+    Write the raw MGF and library table of a synthetic task, unless they were already written.
+
+    Returns:
+        tuple: (mgf_path, library_path)
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    mgf_path = os.path.join(output_dir, f"synthetic_{n_spectra}_{seed}.mgf")
+    library_path = os.path.join(output_dir, f"synthetic_{n_spectra}_{seed}_library.tsv")
+    if not (os.path.exists(mgf_path) and os.path.exists(library_path)):
+        tmp_path = f"{mgf_path}.tmp"
+        kept_scans = write_synthetic_mgf(tmp_path, n_spectra, seed)
+        write_synthetic_library(library_path, kept_scans, seed)
+        os.replace(tmp_path, mgf_path)
+    return mgf_path, library_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write synthetic MGF and library files for the benchmarks.")
+    parser.add_argument("sizes", nargs="+", type=int, help="Numbers of spectra, e.g. 1000 10000 100000 1000000")
+    parser.add_argument("--output-dir", default=os.path.join("benchmark_output", "data"))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    for n_spectra in args.sizes:
+        print(*generate_dataset(args.output_dir, n_spectra, args.seed))
+
+
+if __name__ == "__main__":
+    main()
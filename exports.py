@@ -0,0 +1,100 @@
+import gzip
+import io
+import json
+import shutil
+from contextlib import contextmanager
+from functools import partial
+
+import pandas as pd
+
+# gzip level of the compressed exports; higher levels are much slower for little gain on TSV and MGF text
+GZIP_LEVEL = 6
+# Rows formatted at a time when a table is written as TSV
+TSV_CHUNK_ROWS = 10000
+
+
+def parse_executed_queries(executed_queries: list) -> list:
+    """(name, query) pairs of "name: query" entries; entries without a colon are skipped."""
+    pairs = []
+    for eq in executed_queries:
+        name, separator, query = eq.partition(":")
+        if separator:
+            pairs.append((name.strip(), query.strip()))
+    return pairs
+
+
+def tsv_header(task_id: str, executed_queries: list) -> str:
+    """Header of the TSV exports: the task ID and the executed queries, one "key<TAB>value" per line."""
+    header_lines = [f"task_id\t{task_id}"]
+    for name, query in parse_executed_queries(executed_queries):
+        # sanitize value: remove tabs/newlines to keep TSV integrity
+        header_lines.append(f"{name}\t{query.replace(chr(9), ' ').replace(chr(10), ' ')}")
+    return "\n".join(header_lines) + "\n\n"
+
+
+@contextmanager
+def _gzip_text(path: str):
+    """Text file written gzip-compressed, without the temporary file name in the gzip header."""
+    with open(path, "wb") as raw, gzip.GzipFile(filename="", mode="wb", fileobj=raw, compresslevel=GZIP_LEVEL) as gz:
+        with io.TextIOWrapper(gz, encoding="utf-8") as f:
+            yield f
+
+
+def write_tsv(table: pd.DataFrame, task_id: str, executed_queries: list, path: str, compress: bool = False):
+    """
+    Write a results table as TSV after the header of tsv_header(), as the app's TSV downloads.
+
+    Rows are formatted and written TSV_CHUNK_ROWS at a time, so the text of the whole table
+    is never held in memory, and gzip-compressed as they are written when compress is set.
+    """
+    with (_gzip_text(path) if compress else open(path, "w", encoding="utf-8")) as f:
+        f.write(tsv_header(task_id, executed_queries))
+        table.to_csv(f, sep="\t", index=False, chunksize=TSV_CHUNK_ROWS)
+
+
+def _arrow_table(table: pd.DataFrame, task_id: str, executed_queries: list):
+    """Arrow table of a results table, with the task ID and the executed queries in its schema metadata."""
+    import pyarrow as pa
+
+    arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+    queries = [{"name": name, "query": query} for name, query in parse_executed_queries(executed_queries)]
+    metadata = dict(arrow_table.schema.metadata or {})
+    metadata.update({b"task_id": task_id.encode(), b"executed_queries": json.dumps(queries).encode()})
+    return arrow_table.replace_schema_metadata(metadata)
+
+
+def write_parquet(table: pd.DataFrame, task_id: str, executed_queries: list, path: str):
+    """
+    Write a results table as zstd-compressed Parquet.
+
+    The task ID and the executed queries are stored in the file's schema metadata instead of
+    header lines, as "task_id" and "executed_queries" (a JSON list of {"name", "query"}):
+        pyarrow.parquet.read_schema(path).metadata[b"executed_queries"]
+    """
+    import pyarrow.parquet as pq
+
+    pq.write_table(_arrow_table(table, task_id, executed_queries), path, compression="zstd")
+
+
+def write_feather(table: pd.DataFrame, task_id: str, executed_queries: list, path: str):
+    """Write a results table as zstd-compressed Feather (Arrow IPC), with the metadata of write_parquet()."""
+    from pyarrow import feather
+
+    feather.write_feather(_arrow_table(table, task_id, executed_queries), path, compression="zstd")
+
+
+def write_gzip_copy(input_path: str, path: str):
+    """Write a gzip-compressed copy of a file, e.g. the validated MGF, streaming it in blocks."""
+    with open(input_path, "rb") as fin, open(path, "wb") as raw:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=raw, compresslevel=GZIP_LEVEL) as gz:
+            shutil.copyfileobj(fin, gz, 1024 * 1024)
+
+
+# Download formats of the results tables: label -> (file extension, MIME type, writer), where
+# writer(table, task_id, executed_queries, path) writes the file
+TABLE_FORMATS = {
+    "TSV": (".tsv", "text/tab-separated-values", write_tsv),
+    "TSV (gzip)": (".tsv.gz", "application/gzip", partial(write_tsv, compress=True)),
+    "Parquet": (".parquet", "application/vnd.apache.parquet", write_parquet),
+    "Feather": (".feather", "application/vnd.apache.arrow.file", write_feather),
+}
@@ -0,0 +1,113 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Point this at a local stand-in server to run the app offline
+GNPS2_BASE_URL = os.environ.get("GNPS2_BASE_URL", "https://gnps2.org").rstrip("/")
+# (connect, read) timeouts in seconds
+GNPS2_TIMEOUT = (10, float(os.environ.get("GNPS2_READ_TIMEOUT", "120")))
+# How many times an interrupted download is resumed before giving up
+GNPS2_DOWNLOAD_RETRIES = int(os.environ.get("GNPS2_DOWNLOAD_RETRIES", "3"))
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+_session = None
+
+
+def _forget_session_after_fork():
+    """A forked worker opens connections of its own instead of sharing the parent's pooled sockets."""
+    global _session
+    _session = None
+
+
+os.register_at_fork(after_in_child=_forget_session_after_fork)
+
+
+class DownloadCancelled(Exception):
+    """A download stopped because its cancel event was set."""
+
+
+def get_session() -> requests.Session:
+    """Shared HTTP session, so that requests to GNPS2 reuse pooled keep-alive connections."""
+    global _session
+    if _session is None:
+        session = requests.Session()
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                      allowed_methods=("GET",))
+        session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry))
+        _session = session
+    return _session
+
+
+def get_task_information(task_id: str) -> dict:
+    response = get_session().get(f"{GNPS2_BASE_URL}/taskjson", params={"task": task_id}, timeout=GNPS2_TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def _iter_file_chunks(path: str, chunk_size: int):
+    with open(path, "rb") as f:
+        yield from iter(lambda: f.read(chunk_size), b"")
+
+
+def iter_resultfile(task_id: str, result_path: str, part_path: str, chunk_size: int = DOWNLOAD_CHUNK_SIZE,
+                    retries: int = GNPS2_DOWNLOAD_RETRIES, cancelled: threading.Event = None):
+    """
+    Stream a task result file as bytes while saving it to `part_path`.
+
+    The download is resumable: bytes already in `part_path` from an interrupted attempt
+    are requested again with an HTTP Range header, and are replayed from disk first so that
+    the caller always sees the whole file. A connection dropped mid-stream is resumed the
+    same way, up to `retries` times. Setting `cancelled` stops the download with
+    DownloadCancelled after the current chunk; the bytes received so far stay in `part_path`.
+    """
+    url = f"{GNPS2_BASE_URL}/resultfile"
+    params = {"task": task_id, "file": result_path}
+    # Bytes on disk from an earlier attempt that the caller has not been given yet
+    replay = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    offset = replay
+    attempt = 0
+
+    while True:
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            with get_session().get(url, params=params, headers=headers, stream=True,
+                                   timeout=GNPS2_TIMEOUT) as response:
+                if offset and response.status_code == 416:
+                    # The earlier attempt had already received the whole file
+                    if replay:
+                        yield from _iter_file_chunks(part_path, chunk_size)
+                    return
+                response.raise_for_status()
+
+                mode = "ab"
+                if offset and response.status_code != 206:
+                    if not replay:
+                        raise IOError(f"{url} does not support resuming an interrupted download")
+                    # The server ignored the range, start over
+                    print(f"Cannot resume {result_path} of task {task_id}, downloading it again")
+                    mode, offset, replay = "wb", 0, 0
+                elif replay:
+                    print(f"Resuming {result_path} of task {task_id} at byte {offset}")
+                    yield from _iter_file_chunks(part_path, chunk_size)
+                    replay = 0
+
+                with open(part_path, mode) as f:
+                    for chunk in response.iter_content(chunk_size=chunk_size):
+                        f.write(chunk)
+                        offset += len(chunk)
+                        if cancelled is not None and cancelled.is_set():
+                            raise DownloadCancelled(f"Download of {result_path} of task {task_id} "
+                                                    f"cancelled at byte {offset}")
+                        yield chunk
+            return
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout):
+            attempt += 1
+            if attempt > retries:
+                raise
+            print(f"Download of {result_path} of task {task_id} interrupted at byte {offset}, resuming")
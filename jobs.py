@@ -0,0 +1,268 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import shutil
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from artifact_store import TEMP_MGF_DIR
+from perf import PERF_LOG, PerfRecorder, read_perf_log
+
+# Job status and results live next to the other task files so that they survive restarts
+JOBS_DIR = os.environ.get("MASSQL_JOBS_DIR", os.path.join(TEMP_MGF_DIR, "jobs"))
+# Analyses running at the same time on this server; further jobs wait in the queue
+MAX_CONCURRENT_JOBS = int(os.environ.get("MASSQL_MAX_CONCURRENT_JOBS", "2"))
+# Finished jobs are kept this long, so that reloads and shared ?job_id= links keep working
+JOB_RETENTION_HOURS = float(os.environ.get("MASSQL_JOB_RETENTION_HOURS", "24"))
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+def _job_key(task_id, custom_queries: dict) -> str:
+    return hashlib.sha256(json.dumps([task_id, custom_queries], sort_keys=True).encode()).hexdigest()
+
+
+def _process_identity(pid: int):
+    """
+    Identity of a running process: its pid and, where /proc is available, its start time, so that
+    a later process reusing the pid, e.g. the server after a container restart, is told apart.
+
+    Returns:
+        str: The identity, or None if no process has this pid
+    """
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            # The start time is field 22, the 20th after the parenthesized command name
+            return f"{pid}:{f.read().rsplit(')', 1)[1].split()[19]}"
+    except OSError:
+        if os.path.isdir("/proc/self"):
+            return None
+    # No /proc on this platform
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return None
+    except PermissionError:
+        pass
+    return str(pid)
+
+
+def _is_alive(owner: str) -> bool:
+    """True if the process that recorded this identity is still running."""
+    return owner is not None and _process_identity(int(owner.split(":", 1)[0])) == owner
+
+
+class JobManager:
+    """
+    Runs analyses in a bounded pool of background threads, outside the Streamlit script thread.
+
+    - at most max_concurrent jobs run at once, the others wait in the executor's queue in
+      submission order
+    - the status and progress of every job is written to {jobs_dir}/{job_id}/status.json
+      and its results to results.pkl, so any session or page reload can pick them up
+    - performance measurements of the job and of its exports go to perf.jsonl, as well as
+      to the server-wide performance log
+    - submitting the same task and queries again returns the existing job instead of
+      queueing a duplicate, unless that job failed
+    - jobs queued or running in another live process, e.g. warmup.py, are reported as they are,
+      and attached to by identical submissions; those of a process that is gone are reported failed
+    - a job can build on a finished job of the same task, only running its new or edited
+      queries (see run_pipeline's previous argument)
+    - comparison jobs run one set of queries against several tasks (see run_comparison)
+    """
+
+    def __init__(self, jobs_dir: str = JOBS_DIR, max_concurrent: int = MAX_CONCURRENT_JOBS,
+                 retention_hours: float = JOB_RETENTION_HOURS):
+        self.jobs_dir = jobs_dir
+        self.retention_seconds = retention_hours * 3600
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="massql-job")
+        self._lock = threading.Lock()
+        # Jobs queued or running in this process
+        self._active = set()
+        # Recorded in the status of the jobs submitted here
+        self._owner = _process_identity(os.getpid())
+        os.makedirs(jobs_dir, exist_ok=True)
+
+    def _status_path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id, "status.json")
+
+    def _results_path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id, "results.pkl")
+
+    def _perf_path(self, job_id: str) -> str:
+        return os.path.join(self.jobs_dir, job_id, "perf.jsonl")
+
+    def perf_recorder(self, job_id: str) -> PerfRecorder:
+        """Recorder whose measurements go to the job's perf.jsonl and to the performance log."""
+        status = self._read_status(job_id) or {}
+        return PerfRecorder(log_paths=(PERF_LOG, self._perf_path(job_id)), job_id=job_id,
+                            task_id=status.get("task_id"))
+
+    def perf_records(self, job_id: str) -> list:
+        """Performance records of a job, see PerfRecorder."""
+        return read_perf_log(self._perf_path(job_id))
+
+    def _write_status(self, job_id: str, **fields):
+        status = self._read_status(job_id) or {"job_id": job_id}
+        status.update(fields)
+        path = self._status_path(job_id)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(status, f)
+        os.replace(tmp_path, path)
+
+    def _read_status(self, job_id: str):
+        try:
+            with open(self._status_path(job_id), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _find_job(self, key: str):
+        """Most recent job for the same task and queries that is queued, running or done."""
+        candidates = []
+        for job_id in os.listdir(self.jobs_dir):
+            status = self.status(job_id)
+            if status is not None and status.get("key") == key and status["state"] != FAILED:
+                candidates.append((status["created"], job_id))
+        return max(candidates)[1] if candidates else None
+
+    def _submit(self, key: str, task_id: str, compute, **status_fields) -> str:
+        with self._lock:
+            self.cleanup()
+            job_id = self._find_job(key)
+            if job_id is not None:
+                return job_id
+
+            job_id = uuid.uuid4().hex
+            os.makedirs(os.path.join(self.jobs_dir, job_id))
+            self._write_status(job_id, key=key, task_id=task_id, state=QUEUED, progress=0.0,
+                               message="Waiting for a free worker...", created=time.time(), owner=self._owner,
+                               **status_fields)
+            self._active.add(job_id)
+
+        self._executor.submit(self._run, job_id, compute)
+        return job_id
+
+    def submit(self, task_id: str, custom_queries: dict, workers: int = 1, previous_job_id: str = None) -> str:
+        """
+        Queue an analysis and return its job id.
+
+        Args:
+            task_id (str): GNPS2 task ID to analyze
+            custom_queries (dict): Dictionary of query names and their MassQL queries
+            workers (int): Number of worker processes used to run the queries
+            previous_job_id (str): Earlier job whose results are reused where the task and query
+                texts are the same, e.g. the session's last analysis
+        """
+        def compute(on_progress, perf):
+            # The pipeline and massql are imported by the first job, not when the app starts
+            from pipeline import run_pipeline
+            return run_pipeline(task_id, custom_queries, workers, on_progress=on_progress, perf=perf,
+                                previous=self._previous_results(previous_job_id, task_id))
+
+        return self._submit(_job_key(task_id, custom_queries), task_id, compute)
+
+    def submit_comparison(self, task_ids: list, custom_queries: dict, processes: int = 1) -> str:
+        """
+        Queue a comparison of several tasks, see run_comparison, and return its job id.
+
+        The job's task_id is the comma-separated list of its tasks, and its status also has
+        the list itself as task_ids.
+        """
+        def compute(on_progress, perf):
+            from pipeline import run_comparison
+            return run_comparison(task_ids, custom_queries, processes, on_progress=on_progress, perf=perf)
+
+        return self._submit(_job_key(task_ids, custom_queries), ", ".join(task_ids), compute,
+                            kind="comparison", task_ids=list(task_ids))
+
+    def _previous_results(self, previous_job_id: str, task_id: str):
+        """Results of a finished job on the same task, or None."""
+        status = self.status(previous_job_id) if previous_job_id else None
+        if status is None or status["state"] != DONE or status["task_id"] != task_id:
+            return None
+        try:
+            return self.results(previous_job_id)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            # Removed by cleanup() since it finished
+            return None
+
+    def _run(self, job_id: str, compute):
+        self._write_status(job_id, state=RUNNING, started=time.time(), message="Starting...")
+        try:
+            results = compute(lambda fraction, text: self._write_status(job_id, progress=fraction, message=text),
+                              self.perf_recorder(job_id))
+            tmp_path = f"{self._results_path(job_id)}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(results, f)
+            os.replace(tmp_path, self._results_path(job_id))
+            self._write_status(job_id, state=DONE, progress=1.0, message="Analysis complete!",
+                               finished=time.time())
+        except Exception as e:
+            traceback.print_exc()
+            self._write_status(job_id, state=FAILED, message=str(e), finished=time.time())
+        finally:
+            with self._lock:
+                self._active.discard(job_id)
+
+    def status(self, job_id: str):
+        """
+        Returns:
+            dict: The job's status (state, progress, message, task_id, timestamps), or None
+                if the job does not exist
+        """
+        # Job ids also come from the ?job_id= URL parameter
+        if not re.fullmatch(r"[0-9a-f]{32}", job_id or ""):
+            return None
+        status = self._read_status(job_id)
+        if status is None:
+            return None
+        if status["state"] in (QUEUED, RUNNING) and job_id not in self._active and not _is_alive(status.get("owner")):
+            # Queued or running in a server process that no longer exists
+            status.update(state=FAILED, message="The job was interrupted by a server restart, please run it again.")
+        return status
+
+    def results(self, job_id: str) -> dict:
+        """Results of a finished job, as returned by run_pipeline."""
+        with open(self._results_path(job_id), "rb") as f:
+            return pickle.load(f)
+
+    def export(self, job_id: str, file_name: str, write_export) -> str:
+        """
+        Path of a file exported from a job's results, kept next to them for later downloads.
+
+        Args:
+            job_id (str): Finished job the export belongs to
+            file_name (str): Name of the export inside the job's folder
+            write_export (callable): Called as write_export(path) when the file does not exist yet
+
+        Returns:
+            str: Path of the exported file
+        """
+        path = os.path.join(self.jobs_dir, job_id, file_name)
+        perf = self.perf_recorder(job_id)
+        perf.count("exports", os.path.exists(path))
+        if not os.path.exists(path):
+            with perf.stage("export", file=file_name) as fields:
+                tmp_path = f"{path}.{threading.get_ident()}.tmp"
+                write_export(tmp_path)
+                os.replace(tmp_path, path)
+                fields["bytes"] = os.path.getsize(path)
+        perf.flush()
+        return path
+
+    def cleanup(self):
+        """Remove finished jobs older than the retention period."""
+        cutoff = time.time() - self.retention_seconds
+        for job_id in os.listdir(self.jobs_dir):
+            if job_id in self._active:
+                continue
+            status = self._read_status(job_id)
+            if status is None or status.get("finished", status.get("created", 0)) < cutoff:
+                shutil.rmtree(os.path.join(self.jobs_dir, job_id), ignore_errors=True)
@@ -0,0 +1,125 @@
+from array import array
+
+import numpy as np
+
+from artifact_store import ArtifactStore
+
+# One row per spectrum of the cleaned MGF: byte offsets of its BEGIN IONS line, of its first
+# SCANS line (-1 if it has none) and just past its END IONS line, and the scan number
+INDEX_DTYPE = np.dtype([("start", "<i8"), ("scans", "<i8"), ("end", "<i8"), ("scan", "<i8")])
+# Scan number of a spectrum whose SCANS value is not an integer
+INVALID_SCAN = np.iinfo(np.int64).min
+
+EXPORT_CHUNK_SIZE = 1024 * 1024
+
+
+def index_name(task_id: str) -> str:
+    return f"{task_id}_mgf_cleaned.index.npy"
+
+
+def _byte_length(line: str) -> int:
+    return len(line) if line.isascii() else len(line.encode("utf-8"))
+
+
+class MgfIndexBuilder:
+    """
+    Record the byte offsets of every spectrum while a cleaned MGF is written line by line.
+
+    Spectrum boundaries follow the cleaner: blocks start at a "BEGIN IONS" line and end at
+    an "END IONS" line. The lines must be fed exactly as they are written, in UTF-8.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.columns = {name: array("q") for name in INDEX_DTYPE.names}
+        self._start = None
+        self._scans = -1
+        self._scan = INVALID_SCAN
+
+    def add_line(self, line: str):
+        if line.startswith("BEGIN IONS"):
+            self._start, self._scans, self._scan = self.offset, -1, INVALID_SCAN
+        elif self._start is not None and line.startswith("SCANS") and self._scans < 0:
+            self._scans = self.offset
+            try:
+                self._scan = int(line.split("=")[1].strip())
+            except (ValueError, IndexError):
+                pass
+        elif self._start is not None and line.startswith("END IONS"):
+            for name, value in zip(INDEX_DTYPE.names,
+                                   (self._start, self._scans, self.offset + _byte_length(line), self._scan)):
+                self.columns[name].append(value)
+            self._start = None
+        self.offset += _byte_length(line)
+
+    def to_array(self) -> np.ndarray:
+        index = np.empty(len(self.columns["start"]), dtype=INDEX_DTYPE)
+        for name, values in self.columns.items():
+            index[name] = np.frombuffer(values, dtype=np.int64)
+        return index
+
+    def write(self, store: ArtifactStore, task_id: str):
+        with store.atomic_write(task_id, index_name(task_id)) as tmp_path:
+            with open(tmp_path, "wb") as f:
+                np.save(f, self.to_array())
+
+
+def build_mgf_index(store: ArtifactStore, task_id: str, mgf_path: str):
+    """Index an existing cleaned MGF, e.g. one written before indexes were built during cleaning."""
+    builder = MgfIndexBuilder()
+    with open(mgf_path, "r", encoding="utf-8", newline="") as f:
+        for line in f:
+            builder.add_line(line)
+    builder.write(store, task_id)
+
+
+def open_mgf_index(store: ArtifactStore, task_id: str):
+    """Memory-mapped index of a task's cleaned MGF, or None if it has not been built."""
+    if not store.exists(index_name(task_id)):
+        return None
+    return np.load(store.path(index_name(task_id)), mmap_mode="r")
+
+
+def iter_validated_mgf(mgf_path: str, index: np.ndarray, valid_scans: set, scan_to_validation: dict,
+                       chunk_size: int = EXPORT_CHUNK_SIZE):
+    """
+    Stream the spectra of a cleaned MGF that passed validation, as bytes.
+
+    A MASSQL_VALIDATION=<queries> line is inserted before the SCANS line of each exported
+    spectrum. Spectra without a SCANS line are exported as they are. Lines between two
+    spectra go with the spectrum before them. Only the selected byte ranges are read, so
+    memory use does not depend on the size of the file.
+    """
+    with open(mgf_path, "rb") as f:
+        file_size = f.seek(0, 2)
+        region_ends = np.append(index["start"][1:], file_size)
+        keep = (index["scans"] < 0) | np.isin(index["scan"], np.fromiter(valid_scans, dtype=np.int64))
+
+        def read_range(start, end):
+            f.seek(start)
+            while start < end:
+                data = f.read(min(chunk_size, end - start))
+                if not data:
+                    break
+                start += len(data)
+                yield data
+
+        # Consecutive byte ranges are read as one
+        pending_start, pending_end = 0, (index["start"][0] if len(index) else file_size)
+        kept = np.flatnonzero(keep)
+        for start, scans, end, scan in zip(index["start"][kept].tolist(), index["scans"][kept].tolist(),
+                                           region_ends[kept].tolist(), index["scan"][kept].tolist()):
+            if scans >= 0:
+                if start != pending_end:
+                    yield from read_range(pending_start, pending_end)
+                    pending_start = start
+                yield from read_range(pending_start, scans)
+                validation_status = scan_to_validation.get(scan, "Unknown")
+                yield f"MASSQL_VALIDATION={validation_status}\n".encode("utf-8")
+                pending_start, pending_end = scans, end
+            elif start == pending_end:
+                pending_end = end
+            else:
+                yield from read_range(pending_start, pending_end)
+                pending_start, pending_end = start, end
+        yield from read_range(pending_start, pending_end)
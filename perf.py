@@ -0,0 +1,154 @@
+import json
+import os
+import resource
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Structured performance log of every run, in the ./logs volume of docker-compose.yml
+PERF_LOG = os.environ.get("MASSQL_PERF_LOG", os.path.join("logs", "perf.jsonl"))
+# How often the resident set size is sampled while a stage runs
+RSS_SAMPLE_SECONDS = 0.02
+
+
+def rss_mb() -> float:
+    """Current resident set size of this process."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except (OSError, ValueError):
+        return float("nan")
+
+
+def max_rss_mb() -> float:
+    """Peak resident set size of this process so far (ru_maxrss is in kilobytes on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class PeakRssSampler:
+    """Track the peak resident set size of the process from a background thread, until stop()."""
+
+    def __init__(self, interval: float = RSS_SAMPLE_SECONDS):
+        self.interval = interval
+        self.peak = rss_mb()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def stop(self) -> float:
+        self._stop.set()
+        self._thread.join()
+        return max(self.peak, rss_mb())
+
+
+def measure(func, *args):
+    """
+    Call func(*args), measuring its wall time and the peak RSS of the process meanwhile.
+
+    Returns:
+        tuple: (result, seconds, peak_rss_mb)
+    """
+    sampler = PeakRssSampler()
+    start_time = time.perf_counter()
+    try:
+        result = func(*args)
+    finally:
+        seconds = time.perf_counter() - start_time
+        peak_rss = sampler.stop()
+    return result, seconds, peak_rss
+
+
+class PerfRecorder:
+    """
+    Collects the performance measurements of one analysis run and writes them as JSON lines.
+
+    - stages (download, queries, merge, export, ...) record their wall time and the peak RSS
+      of the process while they ran, plus counts such as the number of scans
+    - every MassQL query records its own time, peak RSS and number of matching scans
+    - caches count their hits and misses
+
+    Records are kept in memory until flush() appends them to every path of log_paths, each
+    with the run fields (e.g. job_id and task_id) and a timestamp. Stages and queries may be
+    recorded from several threads.
+    """
+
+    def __init__(self, log_paths=(PERF_LOG,), **run_fields):
+        self.log_paths = [path for path in log_paths if path]
+        self.run_fields = run_fields
+        self.records = []
+        self.cache_counts = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, kind: str, **fields):
+        record = dict(self.run_fields, timestamp=time.time(), kind=kind, **fields)
+        with self._lock:
+            self.records.append(record)
+
+    @contextmanager
+    def stage(self, name: str, **fields):
+        """
+        Measure the wrapped block as a pipeline stage.
+
+        Yields the fields dict of the record, so the block can add counts to it.
+        """
+        sampler = PeakRssSampler()
+        start_time = time.perf_counter()
+        failed = True
+        try:
+            yield fields
+            failed = False
+        finally:
+            seconds = time.perf_counter() - start_time
+            self.add("stage", stage=name, seconds=round(seconds, 4), peak_rss_mb=round(sampler.stop(), 1),
+                     failed=failed, **fields)
+
+    def query(self, name: str, seconds: float, peak_rss_mb, scans: int, cached: bool):
+        """Record one MassQL query; peak_rss_mb is None for results read from a cache."""
+        self.add("query", query=name, seconds=round(seconds, 4),
+                 peak_rss_mb=None if peak_rss_mb is None else round(peak_rss_mb, 1), scans=scans, cached=cached)
+
+    def count(self, cache: str, hit: bool):
+        """Count a hit or a miss of the named cache."""
+        with self._lock:
+            self.cache_counts[(cache, "hits" if hit else "misses")] += 1
+
+    def flush(self):
+        """Append the records collected so far, and the cache counts, to the logs."""
+        with self._lock:
+            records, self.records = self.records, []
+            counts, self.cache_counts = self.cache_counts, Counter()
+        for cache in sorted({cache for cache, _ in counts}):
+            records.append(dict(self.run_fields, timestamp=time.time(), kind="cache", cache=cache,
+                                hits=counts[(cache, "hits")], misses=counts[(cache, "misses")]))
+        if not records:
+            return
+
+        lines = "".join(json.dumps(record) + "\n" for record in records)
+        for path in self.log_paths:
+            try:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                with open(path, "a") as f:
+                    f.write(lines)
+            except OSError as e:
+                # Measurements must never fail the analysis itself
+                print(f"Could not write performance log {path}: {e}")
+
+
+def read_perf_log(path: str) -> list:
+    """Records of a JSON lines performance log, skipping a partially written last line."""
+    records = []
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except OSError:
+        pass
+    return records
@@ -0,0 +1,344 @@
+import os
+import time
+from concurrent.futures import as_completed
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from artifact_store import ArtifactStore
+from perf import PerfRecorder
+from query_engine import process_pool, run_queries
+from query_plans import QueryError, prepare_queries
+from result_cache import ResultCache, normalize_query
+from utils import download_and_filter_mgf, fetch_task_data, create_mirrorplot_link
+
+
+def run_pipeline(task_id: str, custom_queries: dict, workers: int = 1, on_progress=None,
+                 perf: PerfRecorder = None, previous: dict = None, plans: dict = None) -> dict:
+    """
+    Main analysis function that processes GNPS2 task data with MassQL queries.
+
+    Args:
+        task_id (str): GNPS2 task ID to analyze
+        custom_queries (dict): Dictionary of query names and their MassQL queries
+        workers (int): Number of worker processes used to run the queries
+        on_progress (callable): Called as on_progress(fraction, text) as the analysis advances
+        perf (PerfRecorder): Receives the measurements of the run, which are appended to its logs
+            at the end; by default they go to the performance log only
+        previous (dict): Results of an earlier run on the same task; only the queries whose text
+            it has no results for are run, and the task's library matches and scans are taken
+            from it instead of being downloaded again
+        plans (dict): Query name -> parsed plans, when the queries were already parsed, e.g. for
+            a comparison of several tasks
+
+    Returns:
+        dict: Analysis results containing library_final, full_table, executed_queries, and task_id,
+            as well as the per-query scans and the task data that later runs can reuse
+    """
+    def progress(fraction, text):
+        if on_progress is not None:
+            on_progress(fraction, text)
+
+    perf = perf or PerfRecorder(task_id=task_id)
+    try:
+        # Downloads of other tasks evict least recently used tasks, but not this one while it runs
+        with ArtifactStore().reading(task_id):
+            return _run_pipeline(task_id, custom_queries, workers, progress, perf, previous, plans)
+    finally:
+        perf.flush()
+
+
+def _prepare_plans(custom_queries: dict, perf: PerfRecorder) -> dict:
+    try:
+        with perf.stage("prepare_queries", queries=len(custom_queries)):
+            return prepare_queries(custom_queries, perf)
+    except QueryError as e:
+        raise RuntimeError(str(e)) from e
+
+
+def _reusable_results(task_id: str, previous: dict) -> dict:
+    """Normalized query text -> scan list of an earlier run on the same task, empty if there is none."""
+    if not previous or previous.get("task_id") != task_id or "library_matches" not in previous:
+        # Results of other tasks, or saved before runs recorded their per-query scans
+        return {}
+    return previous["query_scans"]
+
+
+def _run_pipeline(task_id: str, custom_queries: dict, workers: int, progress, perf: PerfRecorder,
+                  previous: dict = None, plans: dict = None) -> dict:
+    # Initialize a list to store the queries that were run
+    executed_queries = [f"{query_name}: {input_query}" for query_name, input_query in custom_queries.items()]
+
+    # Invalid queries are reported before anything is downloaded
+    if plans is None:
+        progress(0.0, "Checking queries...")
+        plans = _prepare_plans(custom_queries, perf)
+
+    # Queries whose text is unchanged since the previous run keep their results
+    reusable = _reusable_results(task_id, previous)
+    reused = {query_name: reusable[normalize_query(input_query)] for query_name, input_query in custom_queries.items()
+              if normalize_query(input_query) in reusable}
+    pending = {query_name: input_query for query_name, input_query in custom_queries.items()
+               if query_name not in reused}
+    for query_name, scan_list in reused.items():
+        perf.query(query_name, 0.0, None, len(scan_list), cached=True)
+        perf.count("previous_run", True)
+    for query_name in pending:
+        perf.count("previous_run", False)
+
+    progress(0.0, "Reusing the previous results..." if reusable else "Downloading files...")
+    try:
+        with perf.stage("download", reused=bool(reusable)) as fields:
+            if not reusable:
+                library_matches, mgf_path, all_scans, pepmass_list = fetch_task_data(task_id, perf=perf)
+            else:
+                library_matches, all_scans, pepmass_list = (previous["library_matches"], previous["all_scans"],
+                                                            previous["pepmass_list"])
+                # The cleaned MGF is only needed, and normally still on disk, when queries changed
+                mgf_path = download_and_filter_mgf(task_id, perf=perf)[0] if pending else None
+            fields.update(scans=len(all_scans), library_matches=len(library_matches))
+    except Exception as e:
+        raise RuntimeError(f"Error downloading files: {str(e)}") from e
+
+    progress(0.0, f"0/{len(pending)} queries done")
+    start_time = time.time()
+
+    def on_result(query_name, scan_list, done, total):
+        progress(done / total,
+                 f"{done}/{total} queries done · {time.time() - start_time:.1f}s elapsed · "
+                 f"last: {query_name} ({len(scan_list)} scans)")
+
+    # Every query runs against the same task spectra, in worker processes when workers > 1;
+    # queries already run on this task and MGF are read back from the on-disk result cache
+    with perf.stage("queries", queries=len(pending), reused=len(reused), workers=workers):
+        scans_by_name = dict(reused)
+        if pending:
+            for result in run_queries(pending, mgf_path, workers=workers, on_result=on_result,
+                                      task_id=task_id, result_cache=ResultCache(),
+                                      mgf_hash=ArtifactStore().checksum(os.path.basename(mgf_path)), perf=perf,
+                                      plans=plans):
+                scans_by_name[result["query"]] = result["scan_list"]
+        query_results = [{"query": query_name, "scan_list": scans_by_name[query_name]}
+                         for query_name in custom_queries]
+
+    progress(1.0, "Merging results...")
+    with perf.stage("merge") as fields:
+        library_final, full_table = build_result_tables(query_results, library_matches, all_scans, pepmass_list,
+                                                        task_id)
+        fields.update(library_rows=len(library_final), full_rows=len(full_table),
+                      passing_scans=int((full_table["query_validation"] != "Did not pass any selected query").sum()))
+
+    return {
+        'library_final': library_final,
+        'full_table': full_table,
+        'executed_queries': executed_queries,
+        'task_id': task_id,
+        # Reused by the next run on this task, see run_pipeline's previous argument
+        'query_scans': {normalize_query(custom_queries[result["query"]]): result["scan_list"]
+                        for result in query_results},
+        'library_matches': library_matches,
+        'all_scans': all_scans,
+        'pepmass_list': pepmass_list,
+    }
+
+
+def _run_comparison_task(task_id: str, custom_queries: dict, plans: dict, perf_log_paths: list,
+                         run_fields: dict):
+    """Analyze one task of a comparison; runs in a worker process."""
+    start_time = time.time()
+    perf = PerfRecorder(log_paths=perf_log_paths, **dict(run_fields, task_id=task_id))
+    try:
+        return task_id, run_pipeline(task_id, custom_queries, perf=perf, plans=plans), None, time.time() - start_time
+    except Exception as e:
+        return task_id, None, str(e), time.time() - start_time
+
+
+def hit_count_matrix(task_results: dict, custom_queries: dict) -> pd.DataFrame:
+    """
+    Number of scans of each task passing each query.
+
+    Args:
+        task_results (dict): Task ID -> run_pipeline results, or None for tasks that failed
+        custom_queries (dict): Dictionary of query names and their MassQL queries
+
+    Returns:
+        pd.DataFrame: One row per task and one column per query; rows of failed tasks are empty
+    """
+    counts = {}
+    for task_id, results in task_results.items():
+        if results is None:
+            counts[task_id] = {query_name: np.nan for query_name in custom_queries}
+        else:
+            counts[task_id] = {query_name: len(set(results["query_scans"][normalize_query(input_query)]))
+                               for query_name, input_query in custom_queries.items()}
+    matrix = pd.DataFrame.from_dict(counts, orient="index", columns=list(custom_queries))
+    matrix.index.name = "task_id"
+    return matrix.astype("Int64")
+
+
+def run_comparison(task_ids: list, custom_queries: dict, processes: int = 1, on_progress=None,
+                   perf: PerfRecorder = None) -> dict:
+    """
+    Run one set of MassQL queries against several GNPS2 tasks at the same time.
+
+    The queries are parsed once and their plans shared by every task. Each task is downloaded,
+    cleaned, queried and merged in its own worker process, so with enough processes the
+    comparison takes about as long as its slowest task. A task that fails does not stop the
+    others.
+
+    Args:
+        task_ids (list): GNPS2 task IDs to compare
+        custom_queries (dict): Dictionary of query names and their MassQL queries
+        processes (int): Number of tasks analyzed at the same time
+        on_progress (callable): Called as on_progress(fraction, text) as tasks finish
+        perf (PerfRecorder): Receives the measurements of the comparison; those of every task go
+            to the same logs, with that task's ID
+
+    Returns:
+        dict: hit_counts (task x query matrix of passing scans), tasks (task ID -> run_pipeline
+            results of the tasks that succeeded), errors (task ID -> error message),
+            executed_queries, and task_ids
+    """
+    def progress(fraction, text):
+        if on_progress is not None:
+            on_progress(fraction, text)
+
+    perf = perf or PerfRecorder(task_id=", ".join(task_ids))
+    try:
+        progress(0.0, "Checking queries...")
+        plans = _prepare_plans(custom_queries, perf)
+
+        progress(0.0, f"0/{len(task_ids)} tasks done")
+        start_time = time.time()
+        task_results, errors = {}, {}
+        run_fields = {key: value for key, value in perf.run_fields.items() if key != "task_id"}
+        with perf.stage("comparison", tasks=len(task_ids), processes=processes) as fields:
+            with process_pool(max(1, min(processes, len(task_ids)))) as pool:
+                futures = [pool.submit(_run_comparison_task, task_id, custom_queries, plans, perf.log_paths,
+                                       run_fields)
+                           for task_id in task_ids]
+                for future in as_completed(futures):
+                    task_id, results, error, seconds = future.result()
+                    task_results[task_id] = results
+                    if error is not None:
+                        errors[task_id] = error
+                    progress(len(task_results) / len(task_ids),
+                             f"{len(task_results)}/{len(task_ids)} tasks done · {time.time() - start_time:.1f}s "
+                             f"elapsed · last: {task_id} ({'failed' if error else f'{seconds:.1f}s'})")
+            fields["failed_tasks"] = len(errors)
+
+        # Tasks are reported in the order they were given
+        task_results = {task_id: task_results[task_id] for task_id in task_ids}
+        return {
+            'hit_counts': hit_count_matrix(task_results, custom_queries),
+            'tasks': {task_id: results for task_id, results in task_results.items() if results is not None},
+            'errors': errors,
+            'executed_queries': [f"{query_name}: {input_query}" for query_name, input_query in custom_queries.items()],
+            'task_ids': list(task_ids),
+        }
+    finally:
+        perf.flush()
+
+
+def _as_scan_ids(scans, integer: bool) -> np.ndarray:
+    """Scan ids as an int64 array, or as a str array when not every scan id of the task is an integer."""
+    if integer:
+        return np.asarray(scans).astype(np.int64)
+    return np.asarray([str(scan) for scan in scans], dtype=str)
+
+
+def build_membership_matrix(query_results: list, scan_ids: np.ndarray) -> sparse.csr_matrix:
+    """
+    Boolean scan x query matrix; entry (i, j) is set when scan_ids[i] passed query j.
+
+    Scans of a query that are not in scan_ids have no row and are left out.
+
+    Args:
+        query_results (list): {"query": name, "scan_list": [scans]} dicts, as returned by run_queries
+        scan_ids (np.ndarray): Sorted unique scan ids labelling the rows, integers or strings
+    """
+    integer = scan_ids.dtype.kind in "iu"
+    scans = [_as_scan_ids(result["scan_list"], integer) for result in query_results]
+    found = np.concatenate(scans) if scans else _as_scan_ids([], integer)
+    rows = np.searchsorted(scan_ids, found)
+    cols = np.repeat(np.arange(len(query_results)), [len(x) for x in scans])
+    known = rows < len(scan_ids)
+    known[known] = scan_ids[rows[known]] == found[known]
+    rows, cols = rows[known], cols[known]
+    matrix = sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                               shape=(len(scan_ids), len(query_results)))
+    # A scan listed twice by a query is still a single membership
+    matrix.sum_duplicates()
+    return matrix
+
+
+def membership_labels(matrix: sparse.csr_matrix, query_names: list, fallback_label: str) -> np.ndarray:
+    """
+    Per-row label listing the queries a scan passed, in query order, or fallback_label.
+
+    Rows are grouped by their set of queries, so labels are only built once per distinct set.
+    """
+    labels = np.full(matrix.shape[0], fallback_label, dtype=object)
+    hit_rows = np.flatnonzero(matrix.getnnz(axis=1))
+    if len(hit_rows) == 0:
+        return labels
+
+    packed = np.packbits(matrix[hit_rows].toarray(), axis=1)
+    patterns, inverse = np.unique(packed, axis=0, return_inverse=True)
+    names = np.asarray(query_names, dtype=object)
+    pattern_labels = np.array(
+        [", ".join(names[np.unpackbits(pattern)[:len(names)].astype(bool)]) for pattern in patterns], dtype=object)
+    labels[hit_rows] = pattern_labels[inverse.ravel()]
+    return labels
+
+
+def build_result_tables(query_results: list, library_matches: pd.DataFrame, all_scans: list, pepmass_list: list,
+                        task_id: str) -> (pd.DataFrame, pd.DataFrame):
+    """
+    Build the library and full result tables, with one row per scan.
+
+    Args:
+        query_results (list): {"query": name, "scan_list": [scans]} dicts, as returned by run_queries
+        library_matches (pd.DataFrame): Library matches of the task, possibly several per scan
+        all_scans (list): Scan ids of the cleaned MGF
+        pepmass_list (list): Precursor m/z of each scan in all_scans
+        task_id (str): GNPS2 task ID, used for the mirror plot links
+
+    Returns:
+        tuple: (library_final, full_table)
+    """
+    fallback_label = "Did not pass any selected query"
+
+    # Scan ids are integers, unless the MGF has non-integer SCANS values; then every id is
+    # compared as text, as the string-based merge did
+    try:
+        scan_values = _as_scan_ids(all_scans, integer=True)
+        integer = True
+    except ValueError:
+        scan_values = _as_scan_ids(all_scans, integer=False)
+        integer = False
+
+    # Several library hits for one scan are collapsed to the first non-null value of each column
+    library = library_matches.assign(**{"#Scan#": _as_scan_ids(library_matches["#Scan#"], integer)})
+    library = library.groupby("#Scan#", as_index=False, sort=True).first()
+
+    scans_df = pd.DataFrame({"#Scan#": scan_values, "pepmass": pepmass_list})
+    scans_df = scans_df.drop_duplicates("#Scan#").sort_values("#Scan#", kind="stable", ignore_index=True)
+
+    scan_ids = np.union1d(scans_df["#Scan#"].values, library["#Scan#"].values)
+    matrix = build_membership_matrix(query_results, scan_ids)
+    labels = membership_labels(matrix, [result["query"] for result in query_results], fallback_label)
+
+    library["query_validation"] = labels[np.searchsorted(scan_ids, library["#Scan#"].values)]
+    create_mirrorplot_link(library, task_id)
+    column_order = ["#Scan#", "query_validation", "mirror_link", "Compound_Name"]
+    library_final = library[column_order + [col for col in library.columns if col not in column_order]]
+
+    full_table = scans_df.merge(library.drop(columns=["query_validation", "mirror_link"]), on="#Scan#", how="left")
+    full_table["query_validation"] = labels[np.searchsorted(scan_ids, full_table["#Scan#"].values)]
+    create_mirrorplot_link(full_table, task_id)
+    col_order = ["#Scan#", "pepmass", "mirror_link", "query_validation", "Compound_Name"]
+    full_table = full_table[col_order + [col for col in full_table.columns if col not in col_order]]
+
+    return library_final, full_table
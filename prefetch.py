@@ -0,0 +1,120 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from gnps2_client import DownloadCancelled
+from jobs import DONE, FAILED, QUEUED, RUNNING
+from perf import PerfRecorder
+from utils import fetch_task_data
+
+# Task files are fetched as soon as a task ID is entered, unless disabled with 0
+PREFETCH_ENABLED = os.environ.get("MASSQL_PREFETCH", "1") != "0"
+# Tasks fetched at the same time by the prefetcher of a server process
+MAX_CONCURRENT_PREFETCHES = 2
+# Finished prefetches remembered, so that asking for them again does not check their files
+PREFETCH_HISTORY_SIZE = 256
+
+# Prefetches go through the states of jobs, or end cancelled
+CANCELLED = "cancelled"
+
+
+def is_task_id(task_id: str) -> bool:
+    """True for text that looks like a GNPS2 task ID: 32 hexadecimal digits."""
+    return re.fullmatch(r"[0-9a-fA-F]{32}", task_id or "") is not None
+
+
+class Prefetcher:
+    """
+    Downloads and cleans the files of tasks in the background, before their analysis is run.
+
+    - a task is fetched once per process however many sessions ask for it; an analysis of the
+      same task, here or in another process, waits on the artifact store's task locks for
+      the fetch in progress and then reuses its files (see fetch_task_data)
+    - every prefetch() is a request for the task, withdrawn with cancel(); the fetch is stopped
+      once no request is left, and a download stopped midway is resumed later from its .part file
+    - the outcome of recent prefetches is remembered, so asking again for a fetched task is free
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_PREFETCHES, history_size: int = PREFETCH_HISTORY_SIZE):
+        self.history_size = history_size
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix="massql-prefetch")
+        self._lock = threading.Lock()
+        # Task id -> {"state", "message", "requests", "cancelled" (threading.Event), "future"}
+        self._tasks = OrderedDict()
+
+    def prefetch(self, task_id: str) -> bool:
+        """
+        Request the files of a task, fetching them unless they are fetched or being fetched.
+
+        Returns:
+            bool: False if task_id does not look like a GNPS2 task ID, and nothing is fetched
+        """
+        if not is_task_id(task_id):
+            return False
+        with self._lock:
+            entry = self._tasks.get(task_id)
+            # A fetch being cancelled is replaced by a new one, which resumes its download
+            if entry is not None and entry["state"] in (QUEUED, RUNNING, DONE) and not entry["cancelled"].is_set():
+                entry["requests"] += 1
+                self._tasks.move_to_end(task_id)
+                return True
+
+            entry = {"state": QUEUED, "message": "", "requests": 1, "cancelled": threading.Event()}
+            self._tasks[task_id] = entry
+            self._forget_finished()
+            entry["future"] = self._executor.submit(self._fetch, task_id, entry)
+        return True
+
+    def cancel(self, task_id: str):
+        """Withdraw a request made with prefetch(); the fetch stops when it was the last one."""
+        with self._lock:
+            entry = self._tasks.get(task_id)
+            if entry is None or entry["state"] not in (QUEUED, RUNNING):
+                return
+            entry["requests"] -= 1
+            if entry["requests"] > 0:
+                return
+            entry["cancelled"].set()
+            if entry["future"].cancel():
+                entry.update(state=CANCELLED, message="Cancelled before it started")
+
+    def status(self, task_id: str):
+        """
+        Returns:
+            tuple: (state, message) of the task's latest prefetch, or None if it was never requested
+        """
+        with self._lock:
+            entry = self._tasks.get(task_id)
+            return None if entry is None else (entry["state"], entry["message"])
+
+    def _forget_finished(self):
+        finished = [task_id for task_id, entry in self._tasks.items() if entry["state"] not in (QUEUED, RUNNING)]
+        for task_id in finished[:max(0, len(self._tasks) - self.history_size)]:
+            del self._tasks[task_id]
+
+    def _fetch(self, task_id: str, entry: dict):
+        with self._lock:
+            if entry["cancelled"].is_set():
+                entry.update(state=CANCELLED, message="Cancelled before it started")
+                return
+            entry["state"] = RUNNING
+
+        perf = PerfRecorder(task_id=task_id, prefetch=True)
+        try:
+            with perf.stage("prefetch") as fields:
+                _, _, scan_list, _ = fetch_task_data(task_id, perf=perf, cancelled=entry["cancelled"])
+                fields["scans"] = len(scan_list)
+            state, message = DONE, ""
+        except DownloadCancelled as e:
+            state, message = CANCELLED, str(e)
+        except Exception as e:
+            # The analysis fetches the files again and reports the error
+            print(f"Prefetch of task {task_id} failed: {e}")
+            state, message = FAILED, str(e)
+        finally:
+            perf.flush()
+
+        with self._lock:
+            entry.update(state=state, message=message)
@@ -115,3 +115,7 @@ ALL_QUERIES = {
         "(Compendium) Identification of cyclic peptide analytes in plant metabolomes": "QUERY scaninfo(MS2DATA) WHERE MS2PROD=(58.06513 OR 60.04439 OR 70.06513 OR 72.08078 OR 74.06004 OR 84.04439 OR 84.08078 OR 86.09643 OR 87.05529 OR 88.0393 OR 88.07569 OR 100.11208 OR 101.07094 OR 101.10732 OR 102.05495 OR 102.09134 OR 104.05285 OR 110.07127 OR 114.12773 OR 115.08659 OR 115.12297 OR 116.0706 OR 118.0685 OR 120.08078 OR 124.08692 OR 129.10224 OR 129.11347 OR 129.13862 OR 130.08625 OR 132.08415 OR 134.09643 OR 136.07569 OR 138.10257 OR 143.12912 OR 148.11208 OR 150.09134 OR 157.14477 OR 159.09167 OR 164.10699 OR 173.10732 OR 187.12297):CARDINALITY=range(min=2,max=5):TOLERANCEPPM=10:INTENSITYPERCENT=5",
     },
 }
+
+# Predefined example of the app, also precomputed by warmup.py
+EXAMPLE_TASK_ID = "a322acf7936c4f91a41fd2f267d9b613" # FBMN_CMMC_Workshop_including_druganalog
+EXAMPLE_QUERY_GROUP = "Bile acids (stage 1) queries"
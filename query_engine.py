@@ -0,0 +1,435 @@
+import copy
+import multiprocessing
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from artifact_store import ArtifactStore
+from perf import measure
+from query_plans import get_plan_cache
+from result_cache import file_sha256
+from spectra_index import fragment_index, precursor_index
+from spectra_store import open_spectra_store, peak_tables_from_store
+
+# Number of tasks whose peak tables stay in memory between runs
+SPECTRA_CACHE_SIZE = int(os.environ.get("MASSQL_SPECTRA_CACHE_SIZE", "2"))
+# Size of the process pool used by the parallel execution mode
+QUERY_WORKERS = int(os.environ.get("MASSQL_QUERY_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Memory the peak tables of a run may use; larger tasks are queried in chunks of spectra, 0 disables chunking
+MEMORY_BUDGET_MB = float(os.environ.get("MASSQL_MEMORY_BUDGET_MB", "1024"))
+# Approximate memory used per peak while a chunk is queried: the peak table itself, its
+# precursor and fragment indexes, and the copies massql makes of it while filtering
+_BYTES_PER_PEAK = 400
+
+# Qualifiers the exact-mass fast path reproduces; anything else goes through massql
+_FAST_PATH_QUALIFIERS = {"type", "qualifierppmtolerance", "qualifiermztolerance", "qualifierintensityvalue",
+                         "qualifierintensitypercent", "qualifierintensityticpercent"}
+
+# Workers are forked, so that they share the parent's peak tables and indexes. Spawned or
+# fork server workers would not, and would import the main script, i.e. re-run app.py under
+# Streamlit. Modules whose locks the workers use reset them after a fork (os.register_at_fork).
+_MP_CONTEXT = multiprocessing.get_context("fork")
+
+_spectra_cache = OrderedDict()
+# Task spectra of a pool worker, set once by the pool initializer
+_worker_spectra = None
+
+
+def process_pool(max_workers: int, **kwargs) -> ProcessPoolExecutor:
+    """Process pool of forked workers, whatever the platform's default start method."""
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=_MP_CONTEXT, **kwargs)
+
+
+def _task_of(mgf_path: str):
+    """The artifact store and task ID of a cleaned task MGF, or (None, None) for other files."""
+    name = os.path.basename(mgf_path)
+    if not name.endswith("_mgf_cleaned.mgf"):
+        return None, None
+    return ArtifactStore(os.path.dirname(mgf_path) or "."), name.split("_", 1)[0]
+
+
+def _open_task_spectra_store(mgf_path: str):
+    """The task's binary spectra store next to the cleaned MGF, or None."""
+    store, task_id = _task_of(mgf_path)
+    return None if store is None else open_spectra_store(store, task_id)
+
+
+def _load_from_spectra_store(mgf_path: str, start: int = 0, stop: int = None):
+    """Peak tables of a range of spectra, by default all, from the task's spectra store, or None."""
+    spectra = _open_task_spectra_store(mgf_path)
+    if spectra is None:
+        return None
+    return peak_tables_from_store(spectra, start, stop)
+
+
+def load_task_spectra(mgf_path: str, perf=None) -> (pd.DataFrame, pd.DataFrame):
+    """
+    Load the MS1/MS2 peak tables of a cleaned MGF once and share them across queries.
+
+    The tables are built from the task's memory-mapped spectra store when there is one, and
+    parsed from the MGF by massql otherwise. They are kept in a small in-process LRU keyed by
+    the file identity, so repeated runs on the same task do not load them again. massql's
+    feather cache is written next to the MGF as well; variable (X) queries reload the data
+    internally for their presearch, and read it from that cache instead of re-parsing the
+    text file.
+
+    Args:
+        mgf_path (str): Path to the cleaned MGF file
+        perf (PerfRecorder): Optionally counts the hits and misses of the in-memory cache and
+            of the spectra store
+
+    Returns:
+        tuple: (ms1_df, ms2_df) peak tables as produced by massql
+    """
+    # massql (with pyteomics and SQLAlchemy) is imported on first use, so that the app starts
+    # without it
+    from massql import msql_fileloading
+
+    stat = os.stat(mgf_path)
+    key = (os.path.abspath(mgf_path), stat.st_size, stat.st_mtime_ns)
+    if perf is not None:
+        perf.count("spectra_memory_cache", key in _spectra_cache)
+    if key in _spectra_cache:
+        _spectra_cache.move_to_end(key)
+        return _spectra_cache[key]
+
+    tables = _load_from_spectra_store(mgf_path)
+    if perf is not None:
+        perf.count("spectra_store", tables is not None)
+    if tables is not None:
+        print(f"Loading spectra from the spectra store of {mgf_path}")
+        ms1_df, ms2_df = tables
+        store, task_id = _task_of(mgf_path)
+        # Concurrent loads of the task write the cache once, and massql never reads it half written
+        with store.task_lock(task_id):
+            for df, filename in zip(tables, msql_fileloading._determine_feather_cache_filename(mgf_path)):
+                name = os.path.basename(filename)
+                if not store.exists(name):
+                    with store.atomic_write(task_id, name) as tmp_path:
+                        df.to_feather(tmp_path)
+    else:
+        print(f"Loading spectra from {mgf_path}")
+        ms1_df, ms2_df = msql_fileloading.load_data(mgf_path, cache="feather")
+        for df in (ms1_df, ms2_df):
+            if "scan" in df:
+                df["scan"] = df["scan"].astype(int)
+
+    _spectra_cache[key] = (ms1_df, ms2_df)
+    while len(_spectra_cache) > SPECTRA_CACHE_SIZE:
+        _spectra_cache.popitem(last=False)
+
+    return ms1_df, ms2_df
+
+
+def _fast_path_conditions(parsed_dict):
+    """
+    Return the conditions of a query that is a plain AND of exact-mass MS2PREC/MS2PROD/MS2NL
+    OR-lists with tolerance and intensity qualifiers, and CARDINALITY for MS2PROD, or None if
+    the query needs massql.
+    """
+    querytype = parsed_dict["querytype"]
+    if querytype["datatype"] != "datams2data" or \
+            querytype["function"] not in ("functionscaninfo", "functionscannum"):
+        return None
+
+    for condition in parsed_dict["conditions"]:
+        if condition["conditiontype"] != "where":
+            return None
+        if condition["type"] not in ("ms2precursorcondition", "ms2productcondition", "ms2neutrallosscondition"):
+            return None
+        if not all(isinstance(value, (int, float)) for value in condition["value"]):
+            return None
+        qualifiers = set(condition.get("qualifiers") or {})
+        if condition["type"] == "ms2productcondition":
+            # massql fails on CARDINALITY with neutral losses, so only product ions get it here
+            qualifiers.discard("qualifiercardinality")
+        if qualifiers - _FAST_PATH_QUALIFIERS:
+            return None
+
+    return parsed_dict["conditions"]
+
+
+def _run_exact_mass_query(conditions: list, ms2_df: pd.DataFrame) -> list:
+    """Evaluate fast-path conditions with the precursor and fragment indexes of the peak table and return the passing scans."""
+    if len(ms2_df) == 0:
+        return []
+
+    passing_scans = None
+    for condition in conditions:
+        if condition["type"] == "ms2precursorcondition":
+            scans = precursor_index(ms2_df).matching_scans(condition)
+        else:
+            scans = fragment_index(ms2_df).matching_scans(condition)
+
+        passing_scans = scans if passing_scans is None else np.intersect1d(passing_scans, scans)
+        if len(passing_scans) == 0:
+            break
+
+    return [int(x) for x in passing_scans]
+
+
+def run_query(input_query: str, mgf_path: str, ms1_df: pd.DataFrame, ms2_df: pd.DataFrame,
+              plans: list = None) -> list:
+    """
+    Run a MassQL query against preloaded peak tables and return the matching scans.
+
+    A query made of several queries joined with "|||" returns the scans matching any of them.
+    Plain exact-mass MS2PREC/MS2PROD/MS2NL queries are answered from the precursor and fragment
+    indexes of ms2_df. Other queries with exact-mass MS2PREC conditions only look at the spectra
+    whose precursor matches, and are not evaluated at all when there is none.
+
+    Args:
+        plans (list): Parsed plans of the query, from the plan cache if not given
+    """
+    if plans is None:
+        plans = get_plan_cache().plan(input_query)
+    if len(plans) == 1:
+        return _run_plan(plans[0], mgf_path, ms1_df, ms2_df)
+    scans = []
+    for parsed_dict in plans:
+        scans.extend(_run_plan(parsed_dict, mgf_path, ms1_df, ms2_df))
+    return list(dict.fromkeys(scans))
+
+
+def _run_plan(parsed_dict: dict, mgf_path: str, ms1_df: pd.DataFrame, ms2_df: pd.DataFrame) -> list:
+    conditions = _fast_path_conditions(parsed_dict)
+    if conditions is not None:
+        return _run_exact_mass_query(conditions, ms2_df)
+
+    rows = precursor_index(ms2_df).candidate_rows(parsed_dict)
+    if rows is not None:
+        if len(rows) == 0:
+            return []
+        if len(rows) < len(ms2_df):
+            ms2_df = ms2_df.take(rows)
+
+    from massql import msql_engine
+
+    try:
+        # Same as msql_engine.process_query, without parsing the query a second time
+        results_df = msql_engine._evalute_variable_query(parsed_dict, mgf_path, cache="feather",
+                                                         ms1_df=ms1_df, ms2_df=ms2_df)
+    except KeyError:
+        # massql raises KeyError when a presearch or filter leaves no data, i.e. nothing matches
+        results_df = pd.DataFrame()
+
+    if len(results_df) == 0:
+        return []
+    return [int(x) for x in results_df["scan"].values.tolist()]
+
+
+def _spectrum_chunks(mgf_path: str, budget_mb: float):
+    """
+    Ranges of spectra whose peak tables fit in budget_mb, as (start, stop) pairs.
+
+    Returns:
+        list: The ranges, or None if the whole task fits in the budget or cannot be read in
+            chunks (chunking disabled, no spectra store, or an MGF massql must parse itself)
+    """
+    if budget_mb <= 0 or mgf_path is None:
+        return None
+    spectra = _open_task_spectra_store(mgf_path)
+    if spectra is None or spectra["meta"]["has_title"]:
+        return None
+
+    offsets = spectra["peak_offsets"]
+    chunk_peaks = max(1, int(budget_mb * 1024 ** 2 / _BYTES_PER_PEAK))
+    if offsets[-1] <= chunk_peaks:
+        return None
+    # Chunks end at the first spectrum boundary past every multiple of chunk_peaks
+    bounds = np.unique(np.searchsorted(offsets, np.arange(chunk_peaks, offsets[-1], chunk_peaks), side="left"))
+    bounds = [0] + [int(b) for b in bounds if 0 < b < len(offsets) - 1] + [len(offsets) - 1]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _is_chunkable(plans: list) -> bool:
+    """
+    True if a scan's result only depends on that scan's own peaks, so that the query can be
+    evaluated on chunks of spectra and the results combined.
+
+    Variable (X) queries are not: massql picks the values of X among every peak of the task,
+    and reads the whole task again for it. Neither are OTHERSCAN qualifiers and MS1 conditions,
+    which relate a scan to others.
+    """
+    for parsed_dict in plans:
+        if parsed_dict["querytype"]["datatype"] != "datams2data":
+            return False
+        for condition in parsed_dict["conditions"]:
+            if condition["type"].startswith("ms1") or condition["type"] == "xcondition":
+                return False
+            if "qualifierotherscan" in (condition.get("qualifiers") or {}):
+                return False
+            if not all(isinstance(value, (int, float)) for value in condition.get("value", [])):
+                return False
+    return True
+
+
+def _run_queries_on_chunk(mgf_path: str, start: int, stop: int, queries: dict) -> dict:
+    """
+    Run queries on the peak tables of a range of spectra, read from the task's spectra store.
+
+    Args:
+        queries (dict): Query name -> (query text, parsed plans)
+
+    Returns:
+        dict: Query name -> (scan_list, seconds, peak_rss_mb)
+    """
+    spectra = _open_task_spectra_store(mgf_path)
+    if spectra is None:
+        # Evicted or deleted since the chunks were planned; an empty result would be cached as if
+        # the task had no match
+        raise FileNotFoundError(f"The spectra store of {mgf_path} is gone")
+    tables = peak_tables_from_store(spectra, start, stop)
+    if tables is None:
+        # No peaks in this range
+        return {query_name: ([], 0.0, None) for query_name in queries}
+    ms1_df, ms2_df = tables
+    # massql modifies the plans it evaluates, and every chunk needs them intact
+    return {query_name: measure(run_query, input_query, mgf_path, ms1_df, ms2_df, copy.deepcopy(plans))
+            for query_name, (input_query, plans) in queries.items()}
+
+
+def _run_in_chunks(queries: dict, mgf_path: str, chunks: list, workers: int, record):
+    """
+    Run chunkable queries chunk by chunk and record each query once all chunks are done.
+
+    Each worker process reads its own chunks from the memory-mapped spectra store, so at most
+    workers chunks are in memory at once.
+    """
+    print(f"Querying {mgf_path} in {len(chunks)} chunks of spectra")
+    combined = {query_name: ([], 0.0, None) for query_name in queries}
+
+    def add(chunk_results):
+        for query_name, (scan_list, seconds, peak_rss) in chunk_results.items():
+            scans, total_seconds, max_rss = combined[query_name]
+            scans.extend(scan_list)
+            combined[query_name] = (scans, total_seconds + seconds,
+                                    peak_rss if max_rss is None else max(max_rss, peak_rss or 0))
+
+    if workers > 1 and len(chunks) > 1:
+        with process_pool(min(workers, len(chunks))) as pool:
+            futures = [pool.submit(_run_queries_on_chunk, mgf_path, start, stop, queries) for start, stop in chunks]
+            for future in as_completed(futures):
+                add(future.result())
+    else:
+        for start, stop in chunks:
+            add(_run_queries_on_chunk(mgf_path, start, stop, queries))
+
+    for query_name, (scans, seconds, peak_rss) in combined.items():
+        # Scans are listed once each, in increasing order, whatever the chunk they come from
+        record(query_name, sorted(set(scans)), seconds, peak_rss)
+
+
+def _init_worker(mgf_path):
+    global _worker_spectra
+    # Forked workers inherit the parent's spectra cache, so this is a lookup rather than a reload
+    ms1_df, ms2_df = load_task_spectra(mgf_path)
+    _worker_spectra = (mgf_path, ms1_df, ms2_df)
+
+
+def _run_query_in_worker(query_name, input_query, plans):
+    mgf_path, ms1_df, ms2_df = _worker_spectra
+    scan_list, seconds, peak_rss = measure(run_query, input_query, mgf_path, ms1_df, ms2_df, plans)
+    return query_name, scan_list, seconds, peak_rss
+
+
+def run_queries(custom_queries: dict, mgf_path: str, workers: int = 1, on_result=None,
+                task_id: str = None, result_cache=None, mgf_hash: str = None, perf=None,
+                plans: dict = None) -> list:
+    """
+    Run every query against the task spectra, optionally fanned out over a process pool.
+
+    Args:
+        custom_queries (dict): Dictionary of query names and their MassQL queries
+        mgf_path (str): Path to the cleaned MGF file
+        workers (int): Number of worker processes, 1 runs the queries in this process
+        on_result (callable): Called as on_result(query_name, scan_list, done, total)
+            each time a query completes
+        task_id (str): GNPS2 task ID, part of the result cache key
+        result_cache (ResultCache): Per-query result cache; cached queries are not run again
+        mgf_hash (str): SHA-256 of the cleaned MGF if already known, e.g. from the artifact store
+        perf (PerfRecorder): Records the time, peak RSS and scan count of every query, measured
+            in the process that ran it, and the cache hits and misses
+        plans (dict): Query name -> parsed plans, e.g. from query_plans.prepare_queries(); queries
+            without plans are looked up in the plan cache. Plans are sent to the worker processes
+            along with the queries, so workers never parse a query.
+
+    Tasks whose peak tables would not fit in MEMORY_BUDGET_MB are queried in chunks of spectra
+    read from the task's spectra store, with the budget shared by the workers. Queries that
+    need the whole task at once (see _is_chunkable) still load it, after the chunks.
+
+    Returns:
+        list: One {"query": name, "scan_list": [scans]} dict per query, in input order
+    """
+    total = len(custom_queries)
+    results = {}
+    plans = plans or {}
+
+    def record(query_name, scan_list, seconds=0.0, peak_rss=None, cached=False):
+        results[query_name] = scan_list
+        if perf is not None:
+            perf.query(query_name, seconds, peak_rss, len(scan_list), cached)
+            if result_cache is not None:
+                perf.count("result_cache", cached)
+        if result_cache is not None and not cached:
+            result_cache.put(task_id, custom_queries[query_name], mgf_hash, scan_list)
+        if on_result is not None:
+            on_result(query_name, scan_list, len(results), total)
+
+    pending = dict(custom_queries)
+    if result_cache is not None:
+        mgf_hash = mgf_hash or file_sha256(mgf_path)
+        for query_name, input_query in custom_queries.items():
+            scan_list = result_cache.get(task_id, input_query, mgf_hash)
+            if scan_list is not None:
+                del pending[query_name]
+                record(query_name, scan_list, cached=True)
+
+    # Tasks larger than the memory budget are queried in chunks of spectra, all but the queries
+    # that need the whole task at once; those are run afterwards as usual
+    chunks = _spectrum_chunks(mgf_path, MEMORY_BUDGET_MB / max(1, workers)) if pending else None
+    if chunks is not None:
+        chunked = {}
+        for query_name, input_query in pending.items():
+            query_plans = plans.get(query_name) or get_plan_cache().plan(input_query)
+            if _is_chunkable(query_plans):
+                chunked[query_name] = (input_query, query_plans)
+        if perf is not None:
+            for query_name in pending:
+                perf.count("chunked_queries", query_name in chunked)
+        pending = {query_name: input_query for query_name, input_query in pending.items()
+                   if query_name not in chunked}
+        if chunked:
+            try:
+                _run_in_chunks(chunked, mgf_path, chunks, workers, record)
+            except FileNotFoundError as e:
+                # Queries are only recorded once all their chunks are done, so none of them is yet
+                print(f"{e}, querying the whole task instead")
+                pending.update((query_name, input_query) for query_name, (input_query, _) in chunked.items())
+
+    if pending:
+        # Load in the parent first so that forked workers share the parsed tables
+        ms1_df, ms2_df = load_task_spectra(mgf_path, perf)
+        # Built once per task, and inherited by the forked workers along with the tables
+        if len(ms2_df):
+            precursor_index(ms2_df)
+            fragment_index(ms2_df)
+
+        if workers > 1 and len(pending) > 1:
+            with process_pool(min(workers, len(pending)), initializer=_init_worker, initargs=(mgf_path,)) as pool:
+                futures = [pool.submit(_run_query_in_worker, query_name, input_query, plans.get(query_name))
+                           for query_name, input_query in pending.items()]
+                for future in as_completed(futures):
+                    record(*future.result())
+        else:
+            for query_name, input_query in pending.items():
+                record(query_name, *measure(run_query, input_query, mgf_path, ms1_df, ms2_df,
+                                            plans.get(query_name)))
+
+    if result_cache is not None:
+        result_cache.evict()
+
+    return [{"query": query_name, "scan_list": results[query_name]} for query_name in custom_queries]
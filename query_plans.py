@@ -0,0 +1,380 @@
+import copy
+import hashlib
+import importlib.metadata
+import importlib.util
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+# Provided by lark-parser, which massql depends on
+from lark import Lark
+from lark.exceptions import LarkError, UnexpectedCharacters, UnexpectedEOF, UnexpectedToken
+
+from artifact_store import TEMP_MGF_DIR
+
+# Parsed plans are kept next to the other cached files so that they survive restarts
+PLAN_CACHE_DIR = os.environ.get("MASSQL_PLAN_CACHE_DIR", os.path.join(TEMP_MGF_DIR, "plan_cache"))
+# Size budget of the plan files; the least recently used are removed beyond it
+PLAN_CACHE_MAX_BYTES = int(os.environ.get("MASSQL_PLAN_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Number of parsed queries kept in memory by each process
+PLAN_CACHE_SIZE = 1024
+
+# Several queries joined with this separator are run separately and their results merged,
+# as the massql command line does
+QUERY_SEPARATOR = "|||"
+
+# Located without importing massql, which is slow to import and only needed to parse
+_GRAMMAR_PATH = os.path.join(os.path.dirname(importlib.util.find_spec("massql").origin), "msql.ebnf")
+_thread_state = threading.local()
+
+
+def _parser_version() -> str:
+    """massql version and grammar checksum, part of the plan cache key so that an upgrade parses queries again."""
+    try:
+        version = importlib.metadata.version("massql")
+    except importlib.metadata.PackageNotFoundError:
+        version = ""
+    with open(_GRAMMAR_PATH, "rb") as f:
+        return f"{version}:{hashlib.sha256(f.read()).hexdigest()}"
+
+
+_PARSER_VERSION = _parser_version()
+
+
+class QueryError(ValueError):
+    """A query that massql cannot parse."""
+
+
+def split_queries(input_query: str) -> list:
+    """The queries joined with QUERY_SEPARATOR in input_query."""
+    return [query.strip() for query in input_query.split(QUERY_SEPARATOR) if query.strip()]
+
+
+def _parse_msql(input_query: str) -> dict:
+    """Same as massql's msql_parser.parse_msql, with the grammar compiled once per thread."""
+    from massql import msql_parser
+
+    if getattr(_thread_state, "parser", None) is None:
+        with open(_GRAMMAR_PATH, "r") as f:
+            _thread_state.parser = Lark(f.read(), start="statement")
+
+    # Strip the comments as parse_msql does
+    query_splits = [split.lstrip() for split in input_query.split("\n")]
+    query_splits = [split.split("#")[0].lstrip() for split in query_splits if len(split) > 0]
+    input_query = "\n".join(split for split in query_splits if len(split) > 0)
+
+    parsed_list = msql_parser.MassQLToJSON().transform(_thread_state.parser.parse(input_query))
+    parsed_list["query"] = input_query
+    return parsed_list
+
+
+def _describe_error(e: Exception) -> str:
+    """Short description of a parse error, without lark's lists of expected grammar terminals."""
+    if isinstance(e, UnexpectedCharacters):
+        return f"Unexpected character {e.char!r} at line {e.line}, column {e.column}"
+    if isinstance(e, UnexpectedEOF) or (isinstance(e, UnexpectedToken) and e.token.type == "$END"):
+        return "The query ends unexpectedly"
+    if isinstance(e, UnexpectedToken):
+        return f"Unexpected {str(e.token)!r} at line {e.line}, column {e.column}"
+    return " ".join(str(e).split())[:300]
+
+
+def parse_query(input_query: str) -> list:
+    """
+    Parse a query, possibly made of several queries joined with QUERY_SEPARATOR.
+
+    Returns:
+        list: One massql plan (parsed dict) per query
+
+    Raises:
+        QueryError: If a query is empty or cannot be parsed
+    """
+    queries = split_queries(input_query)
+    if not queries:
+        raise QueryError("The query is empty")
+
+    plans = []
+    for i, query in enumerate(queries):
+        try:
+            plans.append(_parse_msql(query))
+        except (LarkError, KeyError, ValueError, TypeError) as e:
+            where = f"Query {i + 1} of {len(queries)}: " if len(queries) > 1 else ""
+            raise QueryError(f"{where}{_describe_error(e)}") from e
+    return plans
+
+
+def plan_warnings(plans: list) -> list:
+    """Reasons why valid plans will not match anything in the cleaned MGF of a task."""
+    warnings = []
+    for plan in plans:
+        uses_ms1 = plan["querytype"]["datatype"] == "datams1data" or \
+            any(condition["type"].startswith("ms1") for condition in plan["conditions"])
+        if uses_ms1:
+            warnings.append("Uses MS1 data, which the MGF of a molecular networking task does not contain")
+            break
+    return warnings
+
+
+def _parse_entry(input_query: str) -> dict:
+    """Cache entry of a query, {"plans": [...]} or {"error": message}; run by the parse workers."""
+    try:
+        return {"plans": parse_query(input_query)}
+    except QueryError as e:
+        return {"error": str(e)}
+
+
+class PlanCache:
+    """
+    Parsed massql query plans by exact query text, shared by the sessions and runs of a process.
+
+    - plans, and the errors of queries that cannot be parsed, are kept in an in-memory LRU and
+      as JSON files in cache_dir, so other processes and restarts do not parse a query again;
+      the files are keyed by the massql version as well, and the least recently used are
+      evicted once they take more than max_bytes
+    - queries are parsed by a pool of forked worker processes, workers wide (QUERY_WORKERS by
+      default), so the queries of a group are parsed in parallel and parses of other sessions
+      do not wait behind them; a query already being parsed is not parsed a second time: a run
+      waits for the parse started when the query was edited
+    - plan() returns copies, as massql modifies the plans it evaluates
+    """
+
+    def __init__(self, cache_dir: str = PLAN_CACHE_DIR, max_entries: int = PLAN_CACHE_SIZE,
+                 max_bytes: int = PLAN_CACHE_MAX_BYTES, workers: int = None):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        # Started on the first miss
+        self._pool = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _entry_path(self, input_query: str) -> str:
+        key = hashlib.sha256(json.dumps([_PARSER_VERSION, input_query]).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _remember(self, input_query: str, entry: dict):
+        with self._lock:
+            self._entries[input_query] = entry
+            self._entries.move_to_end(input_query)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _lookup(self, input_query: str):
+        """Cached entry, {"plans": [...]} or {"error": message}, or None if never parsed."""
+        with self._lock:
+            if input_query in self._entries:
+                self._entries.move_to_end(input_query)
+                return self._entries[input_query]
+        path = self._entry_path(input_query)
+        try:
+            with open(path, "r") as f:
+                entry = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        self._remember(input_query, entry)
+        return entry
+
+    def _store(self, input_query: str, entry: dict):
+        path = self._entry_path(input_query)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+        self._remember(input_query, entry)
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used plan files until the directory fits in its size budget."""
+        entries = []
+        total_bytes = 0
+        for dir_entry in os.scandir(self.cache_dir):
+            if not dir_entry.name.endswith(".json"):
+                continue
+            try:
+                stat = dir_entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+            total_bytes += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total_bytes -= size
+            except OSError:
+                pass
+
+    def _parse_pool(self):
+        with self._lock:
+            if self._pool is None:
+                # Imported here, as query_engine imports this module
+                from query_engine import QUERY_WORKERS, process_pool
+                self._pool = process_pool(self.workers or QUERY_WORKERS)
+            return self._pool
+
+    def _start_parse(self, input_query: str, future: Future):
+        """Parse a query in the worker pool, then store its entry and complete future with it."""
+        pool = self._parse_pool()
+
+        def parsed(pool_future):
+            try:
+                try:
+                    entry = pool_future.result()
+                except BrokenProcessPool:
+                    # A worker died, e.g. killed for its memory: parse here, and start a new pool
+                    # on the next miss
+                    self._forget_pool(pool)
+                    entry = _parse_entry(input_query)
+                self._store(input_query, entry)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(entry)
+
+        try:
+            pool_future = pool.submit(_parse_entry, input_query)
+        except BrokenProcessPool:
+            pool_future = Future()
+            pool_future.set_exception(BrokenProcessPool())
+        pool_future.add_done_callback(parsed)
+
+    def _forget_pool(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+
+    def _get(self, input_query: str):
+        entry = self._lookup(input_query)
+        if entry is not None:
+            future = Future()
+            future.set_result(entry)
+            return future, True
+
+        with self._lock:
+            future = self._pending.get(input_query)
+            if future is None and input_query in self._entries:
+                # Parsed by another thread since the lookup above
+                future = Future()
+                future.set_result(self._entries[input_query])
+                return future, True
+            start = future is None
+            if start:
+                future = Future()
+                self._pending[input_query] = future
+
+        if start:
+            self._start_parse(input_query, future)
+        future.add_done_callback(lambda _: self._forget_pending(input_query, future))
+        return future, False
+
+    def _forget_pending(self, input_query: str, future: Future):
+        with self._lock:
+            if self._pending.get(input_query) is future:
+                del self._pending[input_query]
+
+    def submit(self, input_query: str) -> Future:
+        """Start parsing a query in the background, unless it is cached or already being parsed."""
+        return self._get(input_query)[0]
+
+    def status(self, input_query: str):
+        """
+        Returns:
+            tuple: (state, message) where state is "pending", "error", "warning" or "ok"
+        """
+        future = self.submit(input_query)
+        if not future.done():
+            return "pending", "Checking the query..."
+        entry = future.result()
+        if "error" in entry:
+            return "error", entry["error"]
+        warnings = plan_warnings(entry["plans"])
+        if warnings:
+            return "warning", "; ".join(warnings)
+        return "ok", ""
+
+    def plan(self, input_query: str, perf=None) -> list:
+        """
+        Parsed plans of a query, waiting for a parse already in progress.
+
+        Args:
+            input_query (str): Query text, possibly several queries joined with QUERY_SEPARATOR
+            perf (PerfRecorder): Optionally counts the hits and misses of the plan cache
+
+        Returns:
+            list: One massql plan per query, copied so that the caller may modify them
+
+        Raises:
+            QueryError: If the query cannot be parsed
+        """
+        future, cached = self._get(input_query)
+        if perf is not None:
+            perf.count("query_plans", cached)
+        entry = future.result()
+        if "error" in entry:
+            raise QueryError(entry["error"])
+        return copy.deepcopy(entry["plans"])
+
+
+_plan_cache = None
+_plan_cache_lock = threading.Lock()
+
+
+def _forget_plan_cache_after_fork():
+    """
+    A forked worker starts with a plan cache of its own: the parent's may be locked by one of its
+    threads, or waiting on parses of its worker pool, which belongs to the parent.
+    """
+    global _plan_cache, _plan_cache_lock
+    _plan_cache = None
+    _plan_cache_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_forget_plan_cache_after_fork)
+
+
+def get_plan_cache() -> PlanCache:
+    """The plan cache of this process."""
+    global _plan_cache
+    with _plan_cache_lock:
+        if _plan_cache is None:
+            _plan_cache = PlanCache()
+        return _plan_cache
+
+
+def prepare_queries(custom_queries: dict, perf=None) -> dict:
+    """
+    Parse every query before any data is loaded.
+
+    Args:
+        custom_queries (dict): Dictionary of query names and their MassQL queries
+        perf (PerfRecorder): Optionally counts the hits and misses of the plan cache
+
+    Returns:
+        dict: Query name -> list of parsed plans
+
+    Raises:
+        QueryError: Listing every query that cannot be parsed
+    """
+    plan_cache = get_plan_cache()
+    # The misses are parsed in parallel by the parse workers
+    for input_query in custom_queries.values():
+        plan_cache.submit(input_query)
+
+    plans, errors = {}, []
+    for query_name, input_query in custom_queries.items():
+        try:
+            plans[query_name] = plan_cache.plan(input_query, perf)
+        except QueryError as e:
+            errors.append(f"{query_name}: {e}")
+    if errors:
+        raise QueryError("Invalid queries, please fix them in the query editor:\n" + "\n".join(errors))
+    return plans
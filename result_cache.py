@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import threading
+
+# The cache lives under temp_mgf/, which docker-compose mounts from ./temp so it survives restarts
+RESULT_CACHE_DIR = os.environ.get("MASSQL_RESULT_CACHE_DIR", "temp_mgf/result_cache")
+RESULT_CACHE_MAX_BYTES = int(os.environ.get("MASSQL_RESULT_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+_file_hashes = {}
+
+
+def normalize_query(input_query: str) -> str:
+    """
+    Drop comments and blank lines and collapse the spaces within lines, so that cosmetic
+    edits of a query map to the same cache entry.
+
+    A comment runs from "#" to the end of its line, as massql strips them, so line breaks
+    are kept. The queries joined with "|||" (query_plans.QUERY_SEPARATOR) are split first,
+    as the massql command line does.
+    """
+    queries = []
+    for query in input_query.split("|||"):
+        lines = (" ".join(line.split("#")[0].split()) for line in query.split("\n"))
+        queries.append("\n".join(line for line in lines if line))
+    return "|||".join(query for query in queries if query)
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 of a file's content, memoized per file identity (path, size, mtime)."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+        _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+
+class ResultCache:
+    """
+    On-disk cache of per-query scan lists keyed by (task_id, normalized query text, MGF hash).
+
+    Every entry is a small JSON file. A hit refreshes the file's mtime, and eviction removes the
+    least recently used entries until the directory fits in max_bytes.
+    """
+
+    def __init__(self, cache_dir: str = RESULT_CACHE_DIR, max_bytes: int = RESULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _entry_path(self, task_id: str, input_query: str, mgf_hash: str) -> str:
+        key = hashlib.sha256(
+            json.dumps([task_id, normalize_query(input_query), mgf_hash]).encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, task_id: str, input_query: str, mgf_hash: str):
+        """Return the cached scan list, or None on a miss."""
+        path = self._entry_path(task_id, input_query, mgf_hash)
+        try:
+            with open(path, "r") as f:
+                scan_list = json.load(f)["scan_list"]
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+        return scan_list
+
+    def put(self, task_id: str, input_query: str, mgf_hash: str, scan_list: list):
+        path = self._entry_path(task_id, input_query, mgf_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"task_id": task_id, "query": normalize_query(input_query), "scan_list": scan_list}, f)
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in its size budget."""
+        entries = []
+        total_bytes = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_bytes += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total_bytes -= size
+            except OSError:
+                pass
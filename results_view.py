@@ -0,0 +1,176 @@
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+PAGE_SIZES = [50, 100, 500, 1000]
+
+MIRROR_LINK_COLUMN = st.column_config.LinkColumn("Mirror plot", width='small', display_text="View")
+
+
+def labels_with_queries(labels: np.ndarray, query_names: list) -> np.ndarray:
+    """
+    Labels of query_validation that list at least one of query_names.
+
+    A label is the ", "-joined names of the queries a scan passed, so a query is matched as a
+    whole item of the label rather than as a substring, e.g. "query1" does not match "query10".
+    """
+    selected = []
+    for label in labels:
+        padded = f", {label}, "
+        if any(f", {name}, " in padded for name in query_names):
+            selected.append(label)
+    return np.asarray(selected, dtype=object)
+
+
+def filter_results(table: pd.DataFrame, query_names: list = None, search: str = "") -> pd.DataFrame:
+    """
+    Rows of a results table that passed any of query_names and match the search text.
+
+    Args:
+        table (pd.DataFrame): library_final or full_table
+        query_names (list): Query names, or the "did not pass" label, to keep; all rows if empty
+        search (str): Scan number, or case-insensitive text found in the compound name
+
+    Returns:
+        pd.DataFrame: The matching rows, in table order
+    """
+    mask = np.ones(len(table), dtype=bool)
+    if query_names:
+        # Labels are repeated over many rows, so they are matched once per distinct label
+        labels = labels_with_queries(table["query_validation"].unique(), query_names)
+        mask &= table["query_validation"].isin(labels).values
+
+    search = search.strip()
+    if search:
+        found = table["Compound_Name"].astype(str).str.contains(search, case=False, regex=False, na=False).values
+        if search.isdigit():
+            found |= (table["#Scan#"] == int(search)).values
+        mask &= found
+
+    return table if mask.all() else table[mask]
+
+
+def render_results_table(table: pd.DataFrame, query_names: list, key: str):
+    """
+    Show one page of a results table, filtered on the server.
+
+    Only the rows of the current page are sent to the browser, so reruns stay fast whatever
+    the size of the table.
+
+    Args:
+        table (pd.DataFrame): library_final or full_table
+        query_names (list): Names of the executed queries, offered as filters
+        key (str): Prefix of the widget keys, unique per table
+    """
+    fallback_label = "Did not pass any selected query"
+    options = list(query_names)
+    if (table["query_validation"] == fallback_label).any():
+        options.append(fallback_label)
+
+    col_queries, col_search = st.columns([2, 1])
+    selected = col_queries.multiselect("Passed any of the queries", options, key=f"{key}_queries",
+                                       placeholder="All scans")
+    search = col_search.text_input("Search", key=f"{key}_search", placeholder="Scan number or compound name")
+    filtered = filter_results(table, selected, search)
+
+    col_size, col_page, col_info = st.columns([1, 1, 2], vertical_alignment="bottom")
+    page_size = col_size.selectbox("Rows per page", PAGE_SIZES, index=1, key=f"{key}_page_size")
+    n_pages = max(1, -(-len(filtered) // page_size))
+    # Filters may leave fewer pages than the one previously shown
+    if st.session_state.get(f"{key}_page", 1) > n_pages:
+        st.session_state[f"{key}_page"] = n_pages
+    page = col_page.number_input(f"Page (of {n_pages})", min_value=1, max_value=n_pages, step=1,
+                                 key=f"{key}_page")
+
+    start = (page - 1) * page_size
+    page_rows = filtered.iloc[start:start + page_size]
+    if len(filtered) == len(table):
+        col_info.caption(f"Rows {start + 1 if len(page_rows) else 0}–{start + len(page_rows)} of {len(table)}")
+    else:
+        col_info.caption(f"Rows {start + 1 if len(page_rows) else 0}–{start + len(page_rows)} of "
+                         f"{len(filtered)} matching rows ({len(table)} in total)")
+
+    st.dataframe(page_rows, width='content', hide_index=True, column_config={"mirror_link": MIRROR_LINK_COLUMN})
+
+
+def render_download(job_manager, job_id: str, file_name: str, label: str, write_export, key: str,
+                    mime: str = "text/tab-separated-values"):
+    """
+    Two-step download: the export is only built when asked for, then kept with the job results.
+
+    The file is sent to the browser once the user clicks "Prepare", instead of being embedded
+    in the page on every rerun.
+
+    Args:
+        job_manager (JobManager): Manager holding the job's results
+        job_id (str): Finished job whose results are exported
+        file_name (str): Name of the downloaded file
+        label (str): Text of the buttons
+        write_export (callable): Called as write_export(path) to write the export on first request
+        key (str): Key of the prepare button
+        mime (str): MIME type of the file
+    """
+    if st.button(f"Prepare {label}", key=key, icon=":material/manufacturing:"):
+        path = job_manager.export(job_id, file_name, write_export)
+        with open(path, "rb") as f:
+            st.download_button(
+                label=f"Download {label}",
+                data=f,
+                file_name=file_name,
+                mime=mime,
+                icon=":material/download:",
+                on_click="ignore",
+            )
+
+
+def render_performance(records: list):
+    """
+    Show the performance measurements of a job: stages, individual queries and caches.
+
+    Args:
+        records (list): Records of the job, as written by PerfRecorder
+    """
+    if not records:
+        st.info("No performance measurements were recorded for this analysis.")
+        return
+
+    by_kind = {}
+    for record in records:
+        by_kind.setdefault(record.get("kind"), []).append(record)
+
+    # Comparisons record the stages and queries of several tasks
+    several_tasks = len({record.get("task_id") for record in records if record.get("kind") != "cache"}) > 1
+    common = {"job_id", "task_id", "timestamp", "kind", "stage", "seconds", "peak_rss_mb", "failed"}
+    stages = pd.DataFrame([{
+        **({"Task": record.get("task_id")} if several_tasks else {}),
+        "Stage": record["stage"],
+        "Time (s)": record["seconds"],
+        "Peak RSS (MB)": record["peak_rss_mb"],
+        "Failed": record.get("failed", False),
+        "Details": ", ".join(f"{key}={value}" for key, value in record.items() if key not in common),
+    } for record in by_kind.get("stage", [])])
+    st.markdown("#### Stages")
+    st.caption("Stages may overlap: the library table and the MGF are downloaded at the same time, and the MGF "
+               "is cleaned as it arrives. Peak RSS is the largest memory use of the server process during "
+               "the stage, which other analyses running at the same time count towards.")
+    st.dataframe(stages, width='content', hide_index=True)
+
+    queries = pd.DataFrame(by_kind.get("query", []))
+    if len(queries):
+        st.markdown("#### Queries")
+        computed = queries[~queries["cached"]]
+        st.write(f"{len(computed)} queries run in {computed['seconds'].sum():.1f}s, "
+                 f"{len(queries) - len(computed)} read from the result cache.")
+        columns = (["task_id"] if several_tasks else []) + ["query", "seconds", "peak_rss_mb", "scans", "cached"]
+        st.dataframe(queries[columns]
+                     .sort_values("seconds", ascending=False)
+                     .rename(columns={"task_id": "Task", "query": "Query", "seconds": "Time (s)",
+                                      "peak_rss_mb": "Peak RSS (MB)", "scans": "Scans", "cached": "Cached"}),
+                     width='content', hide_index=True)
+
+    caches = pd.DataFrame(by_kind.get("cache", []))
+    if len(caches):
+        st.markdown("#### Caches")
+        st.dataframe(caches.groupby("cache", as_index=False)[["hits", "misses"]].sum()
+                     .rename(columns={"cache": "Cache", "hits": "Hits", "misses": "Misses"}),
+                     width='content', hide_index=True)
@@ -1,4 +1,10 @@
 #!/bin/bash
 
 source activate py39
-streamlit run app.py --server.port 5000 --server.address 0.0.0.0
\ No newline at end of file
+
+# Optionally precompute the example analysis and parse the built-in queries while the server starts
+if [ "${MASSQL_WARMUP:-0}" = "1" ]; then
+    python warmup.py &
+fi
+
+streamlit run app.py --server.port 5000 --server.address 0.0.0.0
@@ -0,0 +1,205 @@
+import os
+import threading
+import weakref
+
+import numpy as np
+import pandas as pd
+from massql.msql_engine_filters import _get_intensity_mask, _get_mz_tolerance
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def _reset_lock_after_fork():
+    """A forked query worker keeps the parent's indexes, with a fresh lock in case a thread of the parent held it."""
+    global _indexes_lock
+    _indexes_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_lock_after_fork)
+
+
+def _index_for(df: pd.DataFrame, index_class):
+    """Index of a peak table, built on first use and kept for as long as the table exists."""
+    key = (id(df), index_class)
+    with _indexes_lock:
+        entry = _indexes.get(key)
+        if entry is not None and entry[0]() is df:
+            return entry[1]
+
+    index = index_class(df)
+    with _indexes_lock:
+        _indexes[key] = (weakref.ref(df, lambda _, key=key: _indexes.pop(key, None)), index)
+    return index
+
+
+def _windows(masses: list, qualifiers):
+    """Lower and upper bounds of the tolerance window of each mass, computed as massql does."""
+    lows, highs = [], []
+    for mz in masses:
+        mz_tol = _get_mz_tolerance(qualifiers, mz)
+        lows.append(mz - mz_tol)
+        highs.append(mz + mz_tol)
+    return np.asarray(lows, dtype=float), np.asarray(highs, dtype=float)
+
+
+def _is_mass_list(values) -> bool:
+    return all(isinstance(value, (int, float)) for value in values)
+
+
+def precursor_conditions(parsed_dict: dict):
+    """
+    MS2PREC conditions that every scan matched by a query must satisfy.
+
+    Only exact-mass conditions of MS2DATA queries qualify: no variables (X) or ANY, no EXCLUDED,
+    CARDINALITY or OTHERSCAN qualifiers, and WHERE rather than FILTER clauses. Restricting the
+    peak table to the scans they accept then leaves the result of the query unchanged.
+
+    Returns:
+        list: The conditions, or None if the query cannot be restricted by precursor mass
+    """
+    if parsed_dict["querytype"]["datatype"] != "datams2data":
+        return None
+
+    conditions = []
+    for condition in parsed_dict["conditions"]:
+        qualifiers = condition.get("qualifiers") or {}
+        if not _is_mass_list(condition.get("value", [])):
+            # Variables are searched for in the whole peak table
+            return None
+        if "qualifierotherscan" in qualifiers:
+            return None
+        if condition["type"] == "ms2precursorcondition" and condition["conditiontype"] == "where" and \
+                not {"qualifierexcluded", "qualifiercardinality"} & set(qualifiers):
+            conditions.append(condition)
+    return conditions or None
+
+
+class PrecursorIndex:
+    """
+    Sorted precursor m/z of the spectra of an MS2 peak table, with the rows of each spectrum.
+
+    A spectrum is a run of consecutive rows with the same scan and precursor m/z, as massql and
+    the spectra store lay the tables out. Looking up a tolerance window is then a binary search
+    over the spectra instead of a comparison with every peak.
+    """
+
+    def __init__(self, ms2_df: pd.DataFrame):
+        self.n_rows = len(ms2_df)
+        if self.n_rows == 0:
+            self.precmz = np.empty(0, dtype=float)
+            self.scans = self.starts = self.ends = np.empty(0, dtype=np.int64)
+            return
+
+        scans = ms2_df["scan"].values
+        precmz = ms2_df["precmz"].values.astype(float)
+        same_precmz = (precmz[1:] == precmz[:-1]) | (np.isnan(precmz[1:]) & np.isnan(precmz[:-1]))
+        starts = np.concatenate(([0], np.flatnonzero((scans[1:] != scans[:-1]) | ~same_precmz) + 1))
+        ends = np.append(starts[1:], self.n_rows)
+
+        order = np.argsort(precmz[starts], kind="stable")
+        self.precmz = precmz[starts][order]
+        self.scans = scans[starts][order]
+        self.starts = starts[order]
+        self.ends = ends[order]
+
+    def _match_spectra(self, masses: list, qualifiers) -> np.ndarray:
+        """Mask of the spectra whose precursor lies strictly inside the window of any listed mass, as in massql."""
+        lows, highs = _windows(masses, qualifiers)
+        first = np.searchsorted(self.precmz, lows, side="right")
+        last = np.searchsorted(self.precmz, highs, side="left")
+        inside = first < last
+        # Count the windows open at each spectrum
+        open_windows = np.zeros(len(self.precmz) + 1, dtype=np.int64)
+        np.add.at(open_windows, first[inside], 1)
+        np.add.at(open_windows, last[inside], -1)
+        return np.cumsum(open_windows[:-1]) > 0
+
+    def matching_scans(self, condition: dict) -> np.ndarray:
+        """Sorted scans passing an exact-mass MS2PREC condition."""
+        return np.unique(self.scans[self._match_spectra(condition["value"], condition.get("qualifiers", None))])
+
+    def candidate_rows(self, parsed_dict: dict):
+        """
+        Rows of the peak table belonging to the spectra that can match a query.
+
+        Returns:
+            np.ndarray: Sorted row positions, possibly empty, or None if the query cannot be
+                restricted by precursor mass
+        """
+        conditions = precursor_conditions(parsed_dict)
+        if conditions is None:
+            return None
+
+        mask = np.ones(len(self.precmz), dtype=bool)
+        for condition in conditions:
+            mask &= self._match_spectra(condition["value"], condition.get("qualifiers", None))
+
+        order = np.argsort(self.starts[mask])
+        starts = self.starts[mask][order]
+        lengths = self.ends[mask][order] - starts
+        offsets = np.cumsum(lengths) - lengths
+        return np.arange(lengths.sum()) - np.repeat(offsets - starts, lengths)
+
+
+class FragmentIndex:
+    """
+    Inverted index of the peaks of an MS2 peak table: peak positions sorted by m/z and by neutral
+    loss, with the scan and intensities of every peak.
+
+    The peaks of an MS2PROD or MS2NL tolerance window are a contiguous slice of the sorted
+    positions, found by binary search; only those peaks are then checked against the intensity
+    qualifiers. Windows and intensity thresholds are the ones massql uses, so conditions match
+    exactly the same scans as massql's filters.
+    """
+
+    def __init__(self, ms2_df: pd.DataFrame):
+        position_type = np.int32 if len(ms2_df) < 2 ** 31 else np.int64
+        self.scans = ms2_df["scan"].values
+        self.intensities = {column: ms2_df[column].values for column in ("i", "i_norm", "i_tic_norm")}
+
+        mz = ms2_df["mz"].values
+        # Same arithmetic as massql's ms2nl_condition
+        neutral_loss = ms2_df["precmz"].values - mz
+        self._sorted = {}
+        for kind, values in (("ms2productcondition", mz), ("ms2neutrallosscondition", neutral_loss)):
+            order = np.argsort(values, kind="stable").astype(position_type)
+            self._sorted[kind] = (values[order], order)
+
+    def _matching_peaks(self, kind: str, masses: list, qualifiers) -> np.ndarray:
+        """Positions of the peaks inside the window of any listed mass that pass the intensity qualifiers."""
+        values, order = self._sorted[kind]
+        lows, highs = _windows(masses, qualifiers)
+        first = np.searchsorted(values, lows, side="right")
+        last = np.searchsorted(values, highs, side="left")
+        peaks = np.concatenate([order[start:end] for start, end in zip(first, last)] or [order[:0]])
+        intensities = {column: column_values[peaks] for column, column_values in self.intensities.items()}
+        return peaks[_get_intensity_mask(intensities, qualifiers)]
+
+    def matching_scans(self, condition: dict) -> np.ndarray:
+        """
+        Sorted scans passing an exact-mass MS2PROD or MS2NL condition.
+
+        With CARDINALITY=range(min, max), a scan passes when it has peaks for at least min and at
+        most max of the listed masses. As in massql, the qualifier is ignored for a single mass.
+        """
+        qualifiers = condition.get("qualifiers", None)
+        masses = condition["value"]
+        cardinality = (qualifiers or {}).get("qualifiercardinality")
+        if cardinality is None or len(masses) == 1:
+            return np.unique(self.scans[self._matching_peaks(condition["type"], masses, qualifiers)])
+
+        scans_per_mass = [np.unique(self.scans[self._matching_peaks(condition["type"], [mz], qualifiers)])
+                          for mz in masses]
+        scans, counts = np.unique(np.concatenate(scans_per_mass), return_counts=True)
+        return scans[(counts >= cardinality["min"]) & (counts <= cardinality["max"])]
+
+
+def precursor_index(ms2_df: pd.DataFrame) -> PrecursorIndex:
+    """Precursor index of an MS2 peak table, shared by every query run against it."""
+    return _index_for(ms2_df, PrecursorIndex)
+
+
+def fragment_index(ms2_df: pd.DataFrame) -> FragmentIndex:
+    """Fragment index of an MS2 peak table, shared by every query run against it."""
+    return _index_for(ms2_df, FragmentIndex)
@@ -0,0 +1,298 @@
+import json
+import os
+import struct
+import threading
+from array import array
+
+import numpy as np
+import pandas as pd
+
+from artifact_store import ArtifactStore
+
+# One .npy file per column; per-spectrum columns have one row per spectrum and the peak
+# columns one row per peak, with peak_offsets[k]:peak_offsets[k + 1] spanning spectrum k
+SPECTRA_COLUMNS = ("scan", "precmz", "charge", "rt", "peak_offsets", "mz", "intensity")
+# The SCANS and PEPMASS values of the MGF as written, listed in the result tables
+TEXT_COLUMNS = ("scan_text", "pepmass_text")
+# Values of a column kept in memory before they are appended to its file
+_FLUSH_VALUES = 64 * 1024
+# Bytes reserved for the header of the .npy files written in chunks
+_NPY_HEADER_SIZE = 128
+
+
+def column_name(task_id: str, column: str) -> str:
+    return f"{task_id}_spectra.{column}.npy"
+
+
+def meta_name(task_id: str) -> str:
+    return f"{task_id}_spectra.json"
+
+
+def add_scan_info(line: str, scan_list: list, pepmass_list: list):
+    """Append the value of a SCANS= or PEPMASS= line of a cleaned MGF, as text, to scan_list or pepmass_list."""
+    if line.startswith("SCANS="):
+        scan_list.append(line.strip().split("=")[1])
+    elif line.startswith("PEPMASS="):
+        pepmass_list.append(line.strip().split("=")[1].split()[0])
+
+
+class _ColumnFile:
+    """
+    A column of the spectra store, appended in chunks to its .npy file while it is built.
+
+    The file starts with a fixed-size header space, filled in with the final length once the
+    column is complete, so the values are written once and never held in memory all at once.
+    """
+
+    def __init__(self, path: str, typecode: str):
+        self.path = path
+        self.dtype = np.dtype(typecode)
+        self.values = array(typecode)
+        self.flushed = 0
+        self._file = open(path, "wb")
+        self._file.seek(_NPY_HEADER_SIZE)
+
+    def __len__(self) -> int:
+        return self.flushed + len(self.values)
+
+    def append(self, value):
+        self.values.append(value)
+
+    def truncate(self, length: int):
+        """Drop the values past length; they must not have been flushed yet."""
+        del self.values[length - self.flushed:]
+
+    def flush(self):
+        self.values.tofile(self._file)
+        self.flushed += len(self.values)
+        del self.values[:]
+
+    def finish(self):
+        """Write the remaining values and the .npy header, and close the file."""
+        self.flush()
+        header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (self.dtype.str, self.flushed)
+        magic = np.lib.format.magic(1, 0)
+        header = header.ljust(_NPY_HEADER_SIZE - len(magic) - 3) + "\n"
+        self._file.seek(0)
+        self._file.write(magic + struct.pack("<H", len(header)) + header.encode("latin1"))
+        self._file.close()
+
+    def close(self):
+        self._file.close()
+
+
+class SpectraStoreBuilder:
+    """
+    Collect the spectra of a cleaned MGF into the columns of a task's spectra store while its
+    lines stream past.
+
+    Lines are interpreted the way massql's line-based MGF loader does, so that the peak
+    tables built from the store match what massql would load from the text file. Columns are
+    written to temporary files in the store as they grow, so memory use does not depend on
+    the size of the task; write() commits them, discard() removes them.
+    """
+
+    def __init__(self, store: ArtifactStore, task_id: str):
+        self.store = store
+        self.task_id = task_id
+        self.columns = {}
+        for column, typecode in zip(SPECTRA_COLUMNS, "qdqdqdd"):
+            tmp_path = f"{store.path(column_name(task_id, column))}.{os.getpid()}.{threading.get_ident()}.tmp"
+            self.columns[column] = _ColumnFile(tmp_path, typecode)
+        self.columns["peak_offsets"].append(0)
+        self.scan_text = []
+        self.pepmass_text = []
+        self.has_title = False
+        self.valid = True
+        self._params = None
+
+    def _drop_open_spectrum(self):
+        """Drop the peaks of a spectrum that was never closed."""
+        n_peaks = self.columns["peak_offsets"].values[-1]
+        self.columns["mz"].truncate(n_peaks)
+        self.columns["intensity"].truncate(n_peaks)
+
+    def add_line(self, line: str):
+        add_scan_info(line, self.scan_text, self.pepmass_text)
+        line = line.strip()
+        if not line:
+            return
+
+        columns = self.columns
+        if line == "BEGIN IONS":
+            # Spectra without SCANS fall back to their 1-based position, as in massql
+            self._params = {"scan": len(columns["scan"]) + 1, "rt": 0.0, "precmz": 0.0, "charge": 1}
+            self._drop_open_spectrum()
+            return
+
+        if self._params is None:
+            return
+
+        if line == "END IONS":
+            try:
+                columns["scan"].append(int(self._params["scan"]))
+            except ValueError:
+                # Non-integer scan ids cannot be stored; callers fall back to the MGF
+                self.valid = False
+                columns["scan"].append(0)
+            columns["precmz"].append(self._params["precmz"])
+            columns["charge"].append(self._params["charge"])
+            columns["rt"].append(self._params["rt"])
+            columns["peak_offsets"].append(len(columns["mz"]))
+            self._params = None
+            # Only closed spectra are flushed, so an open spectrum can still be dropped; the last
+            # peak offset stays in memory, as the start of the next spectrum
+            if len(columns["mz"].values) + len(columns["scan"].values) >= _FLUSH_VALUES:
+                for column in SPECTRA_COLUMNS:
+                    if column != "peak_offsets":
+                        columns[column].flush()
+                offsets = columns["peak_offsets"]
+                last = offsets.values.pop()
+                offsets.flush()
+                offsets.values.append(last)
+            return
+
+        if "=" in line:
+            key, value = line.split("=", 1)
+            key = key.upper().strip()
+            value = value.strip()
+            try:
+                if key == "PEPMASS":
+                    self._params["precmz"] = float(value.split()[0])
+                elif key == "SCANS":
+                    self._params["scan"] = value
+                elif key == "RTINSECONDS":
+                    self._params["rt"] = float(value) / 60.0
+                elif key == "CHARGE":
+                    self._params["charge"] = int(value.strip("+"))
+                elif key == "TITLE":
+                    self.has_title = True
+            except (ValueError, IndexError):
+                pass
+        else:
+            parts = line.split()
+            if len(parts) >= 2:
+                try:
+                    mz, intensity = float(parts[0]), float(parts[1])
+                except ValueError:
+                    return
+                columns["mz"].append(mz)
+                columns["intensity"].append(intensity)
+
+    def write(self):
+        """Commit the columns to the artifact store, one atomically renamed .npy file per column."""
+        # A spectrum still open at the end of the file is not part of the store
+        self._drop_open_spectrum()
+        meta = {"n_spectra": len(self.columns["scan"]), "n_peaks": len(self.columns["mz"]),
+                "has_title": self.has_title}
+        for column in SPECTRA_COLUMNS:
+            self.columns[column].finish()
+            self.store.commit(self.task_id, column_name(self.task_id, column), self.columns[column].path)
+        for column in TEXT_COLUMNS:
+            with self.store.atomic_write(self.task_id, column_name(self.task_id, column)) as tmp_path:
+                with open(tmp_path, "wb") as f:
+                    np.save(f, np.array(getattr(self, column), dtype=str))
+
+        with self.store.atomic_write(self.task_id, meta_name(self.task_id)) as tmp_path:
+            with open(tmp_path, "w") as f:
+                json.dump(meta, f)
+
+    def discard(self):
+        """Remove the column files not committed by write(), e.g. after a failed download."""
+        for column_file in self.columns.values():
+            column_file.close()
+            if os.path.exists(column_file.path):
+                os.remove(column_file.path)
+
+
+def build_spectra_store(store: ArtifactStore, task_id: str, mgf_path: str) -> bool:
+    """Convert an existing cleaned MGF into a spectra store; returns False if it cannot be stored."""
+    builder = SpectraStoreBuilder(store, task_id)
+    try:
+        with open(mgf_path, "r") as f:
+            for line in f:
+                builder.add_line(line)
+        if builder.valid:
+            builder.write()
+        return builder.valid
+    finally:
+        builder.discard()
+
+
+def open_spectra_store(store: ArtifactStore, task_id: str):
+    """
+    Memory-map a task's spectra store.
+
+    Returns:
+        dict: column name -> read-only array, plus "meta"; None if the store is incomplete
+    """
+    columns = SPECTRA_COLUMNS + TEXT_COLUMNS
+    names = [column_name(task_id, column) for column in columns] + [meta_name(task_id)]
+    if not all(store.exists(name) for name in names):
+        return None
+
+    spectra = {column: np.load(store.path(column_name(task_id, column)), mmap_mode="r") for column in columns}
+    with open(store.path(meta_name(task_id)), "r") as f:
+        spectra["meta"] = json.load(f)
+    return spectra
+
+
+def peak_tables_from_store(spectra: dict, start: int = 0, stop: int = None):
+    """
+    Build massql's (ms1_df, ms2_df) peak tables from a spectra store without parsing text.
+
+    Mirrors massql's line-based MGF loader: spectra without peaks or with a zero base peak
+    are skipped, zero-intensity peaks are dropped, and i_norm/i_tic_norm are computed per
+    spectrum. Files with TITLE lines are read by massql through pyteomics instead, so None
+    is returned for them and the caller should let massql load the MGF.
+
+    Args:
+        spectra (dict): Spectra store, as returned by open_spectra_store()
+        start (int): First spectrum of the tables
+        stop (int): End of the range of spectra, all remaining spectra by default; only the
+            peaks of the range are read from the memory-mapped arrays
+
+    Returns:
+        tuple: (ms1_df, ms2_df), or None if the spectra have no peaks or must be read by massql
+    """
+    if spectra["meta"]["has_title"]:
+        return None
+
+    stop = len(spectra["scan"]) if stop is None else stop
+    offsets = spectra["peak_offsets"][start:stop + 1]
+    mz = spectra["mz"][offsets[0]:offsets[-1]]
+    intensity = spectra["intensity"][offsets[0]:offsets[-1]]
+    offsets = offsets - offsets[0]
+
+    counts = np.diff(offsets)
+    i_max = np.zeros(len(counts))
+    i_sum = np.zeros(len(counts))
+    for k in np.nonzero(counts)[0]:
+        peaks = intensity[offsets[k]:offsets[k + 1]].tolist()
+        i_max[k] = max(peaks)
+        # Sequential sum, as massql computes it, so that i_tic_norm is bit-identical
+        i_sum[k] = sum(peaks)
+
+    spectrum_index = np.repeat(np.arange(len(counts)), counts)
+    keep = (i_max[spectrum_index] != 0) & (intensity != 0)
+    spectrum_index = spectrum_index[keep]
+    peak_i = np.asarray(intensity[keep])
+
+    ms2_df = pd.DataFrame({
+        "i": peak_i,
+        "i_norm": peak_i / i_max[spectrum_index],
+        "i_tic_norm": peak_i / i_sum[spectrum_index],
+        "mz": np.asarray(mz[keep]),
+        "scan": np.asarray(spectra["scan"][start:stop])[spectrum_index],
+        "rt": np.asarray(spectra["rt"][start:stop])[spectrum_index],
+        "precmz": np.asarray(spectra["precmz"][start:stop])[spectrum_index],
+        "ms1scan": 0,
+        "charge": np.asarray(spectra["charge"][start:stop])[spectrum_index],
+        "polarity": 1,
+    })
+    if len(ms2_df) == 0:
+        return None
+
+    # massql's MGF loader has no MS1 data and uses a single placeholder row
+    ms1_df = pd.DataFrame([{"i": 0, "i_norm": 0, "i_tic_norm": 0, "mz": 0, "scan": 1, "rt": 0, "polarity": 1}])
+    return ms1_df, ms2_df
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import query_engine  # noqa: E402
+import query_plans  # noqa: E402
+from artifact_store import ArtifactStore  # noqa: E402
+from benchmarks.run_benchmarks import clean_stage  # noqa: E402
+from benchmarks.synthetic_data import generate_dataset  # noqa: E402
+from query_plans import PlanCache  # noqa: E402
+
+# Small enough to run every test in seconds, large enough for every kind of spectrum
+N_SPECTRA = 400
+TASK_ID = "synthetic"
+
+
+@pytest.fixture(scope="session", autouse=True)
+def plan_cache(tmp_path_factory):
+    """A plan cache of the test session, instead of the one in temp_mgf/."""
+    query_plans._plan_cache = PlanCache(str(tmp_path_factory.mktemp("plan_cache")))
+    yield query_plans._plan_cache
+    query_plans._plan_cache = None
+
+
+@pytest.fixture(scope="session")
+def raw_dataset(tmp_path_factory):
+    """(raw_mgf_path, library_path) of a synthetic task, see benchmarks/synthetic_data.py."""
+    return generate_dataset(str(tmp_path_factory.mktemp("data")), N_SPECTRA)
+
+
+@pytest.fixture(scope="session")
+def task(tmp_path_factory, raw_dataset):
+    """
+    Cleaned synthetic task in an artifact store of its own, with its spectra store and index,
+    as after a download.
+    """
+    raw_mgf, library_path = raw_dataset
+    store = ArtifactStore(str(tmp_path_factory.mktemp("store")), max_bytes=2 ** 62)
+    mgf_path, scan_list, pepmass_list = clean_stage(store, TASK_ID, raw_mgf)
+    yield {"store": store, "task_id": TASK_ID, "raw_mgf": raw_mgf, "mgf_path": mgf_path,
+           "scan_list": scan_list, "pepmass_list": pepmass_list,
+           "library_matches": pd.read_csv(library_path, sep="\t")}
+    query_engine._spectra_cache.clear()
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+
+import pytest
+
+from artifact_store import ArtifactStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ArtifactStore(str(tmp_path), max_bytes=2500)
+
+
+def write_task(store: ArtifactStore, task_id: str, size: int = 1000):
+    """Commit a task file of the given size, and make the task the most recently used one."""
+    with store.atomic_write(task_id, f"{task_id}_mgf_cleaned.mgf") as tmp_path:
+        with open(tmp_path, "wb") as f:
+            f.write(b"x" * size)
+    # last_access has the resolution of time.time(); keep the order of the tasks unambiguous
+    time.sleep(0.01)
+
+
+def task_files(store: ArtifactStore) -> set:
+    return {name.split("_", 1)[0] for name in os.listdir(store.root) if name.endswith(".mgf")}
+
+
+def test_atomic_write_commits_and_verifies(store):
+    write_task(store, "a")
+    name = "a_mgf_cleaned.mgf"
+    assert store.exists(name) and store.verify(name)
+
+    with open(store.path(name), "r+b") as f:
+        f.write(b"y")
+    assert store.exists(name) and not store.verify(name)
+
+    with pytest.raises(RuntimeError):
+        with store.atomic_write("b", "b_mgf_cleaned.mgf") as tmp_path:
+            with open(tmp_path, "wb") as f:
+                f.write(b"partial")
+            raise RuntimeError("download interrupted")
+    assert not store.exists("b_mgf_cleaned.mgf")
+    assert sorted(os.listdir(store.root)) == [name, "locks", "manifest.json"]
+
+
+def test_evict_removes_least_recently_used_tasks(store):
+    for task_id in ("a", "b", "c"):
+        write_task(store, task_id)
+    store.touch("a_mgf_cleaned.mgf")
+    store.evict()
+    assert task_files(store) == {"a", "c"}
+    assert not store.exists("b_mgf_cleaned.mgf")
+
+
+def test_evict_skips_tasks_being_read(store):
+    for task_id in ("a", "b", "c"):
+        write_task(store, task_id)
+
+    with store.reading("a"):
+        # Another reader of the same task does not wait
+        with store.reading("a"):
+            store.evict()
+        assert task_files(store) == {"a", "c"}
+        assert store.verify("a_mgf_cleaned.mgf")
+
+    store.max_bytes = 1000
+    store.evict(keep={"c"})
+    assert task_files(store) == {"c"}
+
+
+def test_evict_skips_tasks_read_by_another_thread(store):
+    for task_id in ("a", "b", "c"):
+        write_task(store, task_id)
+    started, done = threading.Event(), threading.Event()
+
+    def reader():
+        with store.reading("a"):
+            started.set()
+            done.wait(10)
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    started.wait(10)
+    try:
+        store.max_bytes = 0
+        store.evict()
+        assert task_files(store) == {"a"}
+    finally:
+        done.set()
+        thread.join()
+
+
+def test_evict_skips_tasks_being_downloaded(store):
+    for task_id in ("a", "b", "c"):
+        write_task(store, task_id)
+    with store.task_lock("a"):
+        store.max_bytes = 0
+        store.evict()
+    assert task_files(store) == {"a"}
+
+
+def test_manifest_is_only_parsed_again_when_it_changes(store, monkeypatch):
+    write_task(store, "a")
+    reads = []
+    read_manifest = ArtifactStore._read_manifest
+    monkeypatch.setattr(ArtifactStore, "_read_manifest", lambda self: reads.append(1) or read_manifest(self))
+
+    for _ in range(5):
+        assert store.exists("a_mgf_cleaned.mgf")
+        assert ArtifactStore(store.root).checksum("a_mgf_cleaned.mgf")
+    assert len(reads) <= 1
+
+    # A commit, in this or another process, is seen by the next check
+    write_task(store, "b")
+    assert store.exists("b_mgf_cleaned.mgf")
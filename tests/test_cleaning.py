@@ -0,0 +1,94 @@
+import pytest
+
+from artifact_store import ArtifactStore
+from spectra_store import SpectraStoreBuilder
+from utils import clean_mgf_file, clean_mgf_lines, iter_decoded, iter_mgf_lines
+
+# Header lines, a peakless spectrum, a spectrum whose only peak follows a non-peak line, a
+# multi-byte title, a non-integer scan and a last spectrum that is never closed
+EDGE_CASES = (
+    "#comment before the first spectrum\n"
+    "BEGIN IONS\nPEPMASS=100.5 2000\nSCANS=1\nEND IONS\n\n"
+    "BEGIN IONS\nTITLE=Ångström – 5 µg\nPEPMASS=200.25\nSCANS=2\n50.1 10\n60 0\nEND IONS\n\n"
+    "BEGIN IONS\nPEPMASS=300\nSCANS=3\n1 2 3\n70.5 5.5\nEND IONS\n"
+    "BEGIN IONS\nPEPMASS=400\nSCANS=4a\n80.0 1.0\nEND IONS\n"
+    "BEGIN IONS\nPEPMASS=500\nSCANS=5\n90.0 1.0\n"
+)
+
+
+def baseline_clean(input_path: str, output_path: str) -> (list, list):
+    """The cleaner the streaming one replaced: whole file in memory, then one pass over the output."""
+    with open(input_path, "r") as mgf_file:
+        lines = mgf_file.readlines()
+
+    cleaned_mgf_lines = []
+    inside_scan = False
+    current_scan = []
+    for line in lines:
+        if line.startswith("BEGIN IONS"):
+            inside_scan = True
+            current_scan = [line]
+        elif line.startswith("END IONS"):
+            current_scan.append(line)
+            if any(
+                len(peak.split()) == 2
+                and all(part.replace(".", "", 1).isdigit() for part in peak.split())
+                for peak in current_scan
+            ):
+                cleaned_mgf_lines.extend(current_scan)
+            inside_scan = False
+        elif inside_scan:
+            current_scan.append(line)
+        else:
+            cleaned_mgf_lines.append(line)
+
+    with open(output_path, "w") as fout:
+        fout.writelines(cleaned_mgf_lines)
+
+    scan_list, pepmass_list = [], []
+    with open(output_path, "r") as mgf_file:
+        for line in mgf_file:
+            if line.startswith("SCANS="):
+                scan_list.append(line.strip().split("=")[1])
+            elif line.startswith("PEPMASS="):
+                pepmass_list.append(line.strip().split("=")[1].split()[0])
+    return scan_list, pepmass_list
+
+
+def read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+@pytest.fixture(params=["synthetic", "edge_cases", "edge_cases_crlf"])
+def raw_mgf(request, tmp_path, raw_dataset):
+    if request.param == "synthetic":
+        return raw_dataset[0]
+    path = tmp_path / "raw.mgf"
+    text = EDGE_CASES.replace("\n", "\r\n") if request.param.endswith("crlf") else EDGE_CASES
+    path.write_bytes(text.encode("utf-8"))
+    return str(path)
+
+
+def test_clean_mgf_file_matches_baseline(tmp_path, raw_mgf):
+    expected = baseline_clean(raw_mgf, str(tmp_path / "baseline.mgf"))
+    store = ArtifactStore(str(tmp_path / "store"), max_bytes=2 ** 62)
+    for builder in (None, SpectraStoreBuilder(store, "task")):
+        assert clean_mgf_file(raw_mgf, str(tmp_path / "cleaned.mgf"), chunk_size=7, builder=builder) == expected
+        assert read_bytes(str(tmp_path / "cleaned.mgf")) == read_bytes(str(tmp_path / "baseline.mgf"))
+        if builder is not None:
+            builder.discard()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 5, 4096])
+def test_streamed_download_matches_baseline(tmp_path, raw_mgf, chunk_size):
+    # Byte chunks of any size, as they arrive from the server, splitting lines, CRLF pairs and
+    # multi-byte characters
+    expected = baseline_clean(raw_mgf, str(tmp_path / "baseline.mgf"))
+    data = read_bytes(raw_mgf)
+    byte_chunks = (data[i:i + chunk_size] for i in range(0, len(data), chunk_size))
+    builder = SpectraStoreBuilder(ArtifactStore(str(tmp_path / "store"), max_bytes=2 ** 62), "task")
+    result = clean_mgf_lines(iter_mgf_lines(iter_decoded(byte_chunks)), str(tmp_path / "cleaned.mgf"), builder)
+    builder.discard()
+    assert result == expected
+    assert read_bytes(str(tmp_path / "cleaned.mgf")) == read_bytes(str(tmp_path / "baseline.mgf"))
@@ -0,0 +1,86 @@
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import gnps2_client
+from artifact_store import ArtifactStore
+from utils import MGF_RESULT_PATHS, clean_mgf_file, download_and_filter_mgf
+
+
+class FakeGNPS2(BaseHTTPRequestHandler):
+    """Stand-in for the GNPS2 endpoints the app uses: task information and result files."""
+
+    # {task_id: (workflow name, {result path: bytes})}, set by the fixture
+    tasks = {}
+    requested = []
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        task = self.tasks.get(params.get("task"))
+        if task is None:
+            self.send_error(404)
+            return
+        workflowname, files = task
+        if url.path == "/taskjson":
+            body = ('{"workflowname": "%s"}' % workflowname).encode()
+        elif url.path == "/resultfile" and params.get("file") in files:
+            self.requested.append(params["file"])
+            body = files[params["file"]]
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def gnps2(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeGNPS2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(gnps2_client, "GNPS2_BASE_URL", f"http://127.0.0.1:{server.server_address[1]}")
+    monkeypatch.setattr(FakeGNPS2, "tasks", {})
+    monkeypatch.setattr(FakeGNPS2, "requested", [])
+    yield FakeGNPS2
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize("workflowname, result_path", [
+    ("feature_based_molecular_networking_workflow", "nf_output/clustering/spectra_reformatted.mgf"),
+    ("classical_networking_workflow", "nf_output/clustering/specs_ms.mgf"),
+])
+def test_download_fetches_the_workflow_mgf(tmp_path, gnps2, raw_dataset, workflowname, result_path):
+    assert MGF_RESULT_PATHS[workflowname] == result_path
+    raw_mgf = raw_dataset[0]
+    with open(raw_mgf, "rb") as f:
+        raw_bytes = f.read()
+    # Only the workflow's own MGF is served, so that a wrong path fails with a 404
+    gnps2.tasks["task1"] = (workflowname, {result_path: raw_bytes})
+
+    store = ArtifactStore(str(tmp_path / "store"), max_bytes=2 ** 62)
+    cleaned_mgf, scan_list, pepmass_list = download_and_filter_mgf("task1", store)
+    expected = clean_mgf_file(raw_mgf, str(tmp_path / "expected.mgf"))
+    assert (scan_list, pepmass_list) == expected
+    with open(cleaned_mgf, "rb") as f, open(tmp_path / "expected.mgf", "rb") as expected_file:
+        assert f.read() == expected_file.read()
+    assert store.verify("task1_mgf_cleaned.mgf")
+    assert gnps2.requested == [result_path]
+
+    # The cleaned file is reused afterwards
+    assert download_and_filter_mgf("task1", store) == (cleaned_mgf, scan_list, pepmass_list)
+    assert gnps2.requested == [result_path]
+
+
+def test_download_rejects_other_workflows(tmp_path, gnps2):
+    gnps2.tasks["task1"] = ("library_search_workflow", {})
+    with pytest.raises(ValueError, match="Unsupported workflow"):
+        download_and_filter_mgf("task1", ArtifactStore(str(tmp_path / "store")))
@@ -0,0 +1,107 @@
+from io import StringIO
+
+import pandas as pd
+import pytest
+
+from artifact_store import ArtifactStore
+from benchmarks.run_benchmarks import clean_stage
+from pipeline import build_result_tables
+from utils import insert_mgf_info
+
+
+def baseline_insert_mgf_info(input_mgf: str, validation_df: pd.DataFrame) -> str:
+    """The export the indexed one replaced: every line of the MGF, filtered in a StringIO buffer."""
+    mask = ~validation_df["query_validation"].str.contains('Did not pass any selected query', na=True, case=False)
+    valid_scans = set(
+        pd.to_numeric(validation_df.loc[mask, "#Scan#"], errors="coerce")
+        .dropna().astype(int).tolist()
+    )
+    scan_to_validation = {
+        int(k): v for k, v in zip(
+            pd.to_numeric(validation_df["#Scan#"], errors="coerce").fillna(-1).astype(int),
+            validation_df["query_validation"]
+        ) if k != -1
+    }
+
+    buffer = StringIO()
+    spectrum_lines = []
+    skip_spectrum = False
+    with open(input_mgf, "r") as f:
+        file_contents = f.readlines()
+    for line in file_contents:
+        if line.startswith("BEGIN IONS"):
+            spectrum_lines = [line]
+            skip_spectrum = False
+        elif line.startswith("SCANS"):
+            scan_number = int(line.split("=")[1].strip())
+            spectrum_lines.append(line)
+
+            if scan_number not in valid_scans:
+                skip_spectrum = True
+                continue
+
+            validation_status = scan_to_validation.get(scan_number, "Unknown")
+            for prev_line in spectrum_lines[:-1]:
+                buffer.write(prev_line)
+            buffer.write(f"MASSQL_VALIDATION={validation_status}\n")
+            buffer.write(line)
+            spectrum_lines = []
+
+        elif line.startswith("END IONS"):
+            if not skip_spectrum:
+                spectrum_lines.append(line)
+                for spectrum_line in spectrum_lines:
+                    buffer.write(spectrum_line)
+            spectrum_lines = []
+        else:
+            if not skip_spectrum:
+                if spectrum_lines:
+                    spectrum_lines.append(line)
+                else:
+                    buffer.write(line)
+    return buffer.getvalue()
+
+
+def validation_table(task) -> pd.DataFrame:
+    """The #Scan# and query_validation columns of the full table, as the app passes them to the export."""
+    query_results = [
+        {"query": "every third", "scan_list": [int(scan) for scan in task["scan_list"][::3]]},
+        {"query": "every fifth", "scan_list": [int(scan) for scan in task["scan_list"][::5]]},
+    ]
+    _, full_table = build_result_tables(query_results, task["library_matches"], task["scan_list"],
+                                        task["pepmass_list"], task["task_id"])
+    return full_table[["#Scan#", "query_validation"]].astype(str)
+
+
+def test_validated_mgf_matches_baseline(task):
+    validation_df = validation_table(task)
+    path = insert_mgf_info(task["task_id"], task["mgf_path"], validation_df, task["store"])
+    with open(path, "rb") as f:
+        exported = f.read()
+    assert exported == baseline_insert_mgf_info(task["mgf_path"], validation_df).encode("utf-8")
+    assert exported.count(b"MASSQL_VALIDATION=") == len(task["scan_list"][::3]) + len(task["scan_list"][::5]) - \
+        len(task["scan_list"][::15])
+
+    # Asking again returns the stored export
+    assert insert_mgf_info(task["task_id"], task["mgf_path"], validation_df, task["store"]) == path
+
+
+@pytest.mark.parametrize("header", ["", "#header line\n\n"])
+def test_validated_mgf_of_edge_cases_matches_baseline(tmp_path, header):
+    # Spectra without a SCANS line, with lines between them and with a multi-byte title
+    raw_mgf = tmp_path / "raw.mgf"
+    raw_mgf.write_text(
+        f"{header}BEGIN IONS\nPEPMASS=100\nSCANS=1\n50 1\nEND IONS\n\n"
+        "BEGIN IONS\nTITLE=Ångström\nPEPMASS=200\nSCANS=2\n60 1\nEND IONS\nbetween spectra\n"
+        "BEGIN IONS\nPEPMASS=300\n70 1\nEND IONS\n"
+        "BEGIN IONS\nPEPMASS=400\nSCANS=4\n80 1\nEND IONS\n", encoding="utf-8")
+    store = ArtifactStore(str(tmp_path / "store"), max_bytes=2 ** 62)
+    mgf_path, _, _ = clean_stage(store, "task", str(raw_mgf))
+
+    for passed in ([], ["1"], ["2"], ["1", "2", "4"]):
+        validation_df = pd.DataFrame({"#Scan#": ["1", "2", "4"]})
+        validation_df["query_validation"] = [
+            "query a, query b" if scan in passed else "Did not pass any selected query"
+            for scan in validation_df["#Scan#"]]
+        with open(insert_mgf_info("task", mgf_path, validation_df, store), "rb") as f:
+            assert f.read() == baseline_insert_mgf_info(mgf_path, validation_df).encode("utf-8"), passed
@@ -0,0 +1,80 @@
+import os
+import subprocess
+import sys
+import time
+import uuid
+
+import pytest
+
+import jobs
+from jobs import DONE, FAILED, QUEUED, RUNNING, JobManager, _process_identity
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "PERF_LOG", str(tmp_path / "perf.jsonl"))
+    return JobManager(str(tmp_path / "jobs"), max_concurrent=1)
+
+
+@pytest.fixture
+def other_process():
+    """A running process other than this one, e.g. warmup.py."""
+    process = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+    yield process
+    process.kill()
+    process.wait()
+
+
+def add_job(manager: JobManager, owner: str, state: str = RUNNING, key: str = "key") -> str:
+    """Status of a job submitted by another process, as it finds it in the jobs directory."""
+    job_id = uuid.uuid4().hex
+    os.makedirs(os.path.join(manager.jobs_dir, job_id))
+    manager._write_status(job_id, key=key, task_id="task", state=state, progress=0.5, message="Running queries",
+                          created=time.time(), owner=owner)
+    return job_id
+
+
+def wait_until_finished(manager: JobManager, job_id: str, timeout: float = 10) -> dict:
+    deadline = time.time() + timeout
+    while manager.status(job_id)["state"] not in (DONE, FAILED):
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+    return manager.status(job_id)
+
+
+def test_job_of_live_process_is_reported_as_is(manager, other_process):
+    job_id = add_job(manager, _process_identity(other_process.pid))
+    assert manager.status(job_id)["state"] == RUNNING
+    # An identical submission attaches to it
+    assert manager._submit("key", "task", lambda on_progress, perf: {}) == job_id
+
+
+@pytest.mark.parametrize("state", [QUEUED, RUNNING])
+def test_job_of_dead_process_is_reported_failed(manager, other_process, state):
+    owner = _process_identity(other_process.pid)
+    job_id = add_job(manager, owner, state)
+    other_process.kill()
+    other_process.wait()
+
+    status = manager.status(job_id)
+    assert status["state"] == FAILED and "server restart" in status["message"]
+    # The stale job is not reused: the analysis runs again
+    new_job_id = manager._submit("key", "task", lambda on_progress, perf: {"scans": 1})
+    assert new_job_id != job_id
+    assert wait_until_finished(manager, new_job_id)["state"] == DONE
+    assert manager.results(new_job_id) == {"scans": 1}
+
+
+def test_job_of_process_with_reused_pid_is_reported_failed(manager):
+    # Same pid as this process, another start time, as after a container restart
+    pid, start_time = _process_identity(os.getpid()).split(":")
+    job_id = add_job(manager, f"{pid}:{int(start_time) - 1}")
+    assert manager.status(job_id)["state"] == FAILED
+
+
+def test_jobs_of_this_process_are_not_stale(manager):
+    job_id = add_job(manager, manager._owner)
+    assert manager.status(job_id)["state"] == RUNNING
+
+    job_id = manager._submit("other key", "task", lambda on_progress, perf: on_progress(1.0, "Done") or {})
+    assert wait_until_finished(manager, job_id)["state"] == DONE
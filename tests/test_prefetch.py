@@ -0,0 +1,125 @@
+import threading
+import time
+from functools import partial
+
+import pytest
+
+import prefetch
+from gnps2_client import DownloadCancelled
+from jobs import DONE, FAILED, RUNNING
+from perf import PerfRecorder
+from prefetch import CANCELLED, Prefetcher, is_task_id
+
+TASK_A = "a" * 32
+TASK_B = "b" * 32
+
+
+class FakeFetch:
+    """Stand-in for fetch_task_data that runs until released or cancelled."""
+
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.failing = set()
+
+    def __call__(self, task_id, perf=None, cancelled=None):
+        self.calls.append(task_id)
+        while not self.release.wait(0.01):
+            if cancelled.is_set():
+                raise DownloadCancelled(f"Download of task {task_id} cancelled")
+        if task_id in self.failing:
+            raise RuntimeError("Unsupported workflow")
+        return None, None, ["1", "2"], ["100.0", "200.0"]
+
+
+def wait_for(condition, timeout: float = 10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def fetch(monkeypatch, tmp_path):
+    fake = FakeFetch()
+    monkeypatch.setattr(prefetch, "fetch_task_data", fake)
+    monkeypatch.setattr(prefetch, "PerfRecorder", partial(PerfRecorder, log_paths=(str(tmp_path / "perf.jsonl"),)))
+    yield fake
+    fake.release.set()
+
+
+def test_is_task_id():
+    assert is_task_id(TASK_A) and is_task_id("0123456789ABCDEFabcdef0123456789")
+    assert not any(is_task_id(text) for text in (None, "", TASK_A[:-1], TASK_A + "0", "g" * 32, f" {TASK_A}"))
+
+
+def test_task_is_fetched_once(fetch):
+    prefetcher = Prefetcher()
+    assert not prefetcher.prefetch("not a task")
+    assert prefetcher.status("not a task") is None
+
+    assert prefetcher.prefetch(TASK_A) and prefetcher.prefetch(TASK_A)
+    wait_for(lambda: prefetcher.status(TASK_A) == (RUNNING, ""))
+    fetch.release.set()
+    wait_for(lambda: prefetcher.status(TASK_A) == (DONE, ""))
+
+    # Asking again for a fetched task does not fetch it again
+    assert prefetcher.prefetch(TASK_A)
+    assert prefetcher.status(TASK_A) == (DONE, "")
+    assert fetch.calls == [TASK_A]
+
+
+def test_fetch_stops_when_the_last_request_is_withdrawn(fetch):
+    prefetcher = Prefetcher()
+    prefetcher.prefetch(TASK_A)
+    prefetcher.prefetch(TASK_A)
+    wait_for(lambda: prefetcher.status(TASK_A)[0] == RUNNING)
+
+    prefetcher.cancel(TASK_A)
+    time.sleep(0.05)
+    assert prefetcher.status(TASK_A)[0] == RUNNING
+    prefetcher.cancel(TASK_A)
+    wait_for(lambda: prefetcher.status(TASK_A)[0] == CANCELLED)
+
+    # A new request starts a new fetch, which resumes the download
+    prefetcher.prefetch(TASK_A)
+    fetch.release.set()
+    wait_for(lambda: prefetcher.status(TASK_A) == (DONE, ""))
+    assert fetch.calls == [TASK_A, TASK_A]
+
+
+def test_queued_fetch_is_cancelled_before_it_starts(fetch):
+    prefetcher = Prefetcher(max_concurrent=1)
+    prefetcher.prefetch(TASK_A)
+    prefetcher.prefetch(TASK_B)
+    wait_for(lambda: prefetcher.status(TASK_A)[0] == RUNNING)
+
+    prefetcher.cancel(TASK_B)
+    assert prefetcher.status(TASK_B) == (CANCELLED, "Cancelled before it started")
+    fetch.release.set()
+    wait_for(lambda: prefetcher.status(TASK_A)[0] == DONE)
+    assert fetch.calls == [TASK_A]
+
+
+def test_failed_fetch_is_reported(fetch):
+    fetch.failing.add(TASK_A)
+    fetch.release.set()
+    prefetcher = Prefetcher()
+    prefetcher.prefetch(TASK_A)
+    wait_for(lambda: prefetcher.status(TASK_A) == (FAILED, "Unsupported workflow"))
+
+    # A failed fetch is tried again on the next request
+    fetch.failing.clear()
+    prefetcher.prefetch(TASK_A)
+    wait_for(lambda: prefetcher.status(TASK_A) == (DONE, ""))
+
+
+def test_history_of_finished_fetches_is_bounded(fetch):
+    fetch.release.set()
+    prefetcher = Prefetcher(history_size=2)
+    task_ids = [f"{i:032x}" for i in range(4)]
+    for task_id in task_ids:
+        prefetcher.prefetch(task_id)
+        wait_for(lambda: prefetcher.status(task_id) == (DONE, ""))
+    # The oldest finished fetches are forgotten as new ones are requested
+    assert [prefetcher.status(task_id) for task_id in task_ids] == [None, None, (DONE, ""), (DONE, "")]
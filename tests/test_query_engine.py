@@ -0,0 +1,133 @@
+import copy
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import query_engine
+from query_plans import get_plan_cache, prepare_queries, split_queries
+from queries import ALL_QUERIES
+
+# Built-in queries whose massql evaluation takes seconds even on a small task
+SLOW_QUERIES = {
+    "(Compendium) Search for two product ions with specific m/z delta",
+    "(Compendium) Find a protonated precursor by searching for the presence of M+Na",
+    "(Compendium) biarylitide A - peptidegenomics",
+    "(Compendium) Sulfatome",
+}
+
+
+def generated_queries(ms2_df, n_scans: int = 8, seed: int = 0) -> dict:
+    """
+    Exact-mass queries built from the peaks of some spectra of the task, so that they match
+    something, with every qualifier of the fast path.
+    """
+    rng = np.random.default_rng(seed)
+    queries = {}
+    for scan in rng.choice(np.unique(ms2_df["scan"].values), size=n_scans, replace=False):
+        peaks = ms2_df[ms2_df["scan"] == scan].sort_values("i", ascending=False)
+        first, second = peaks["mz"].values[:2]
+        precursor = peaks["precmz"].values[0]
+        queries.update({
+            f"products {scan}": f"QUERY scaninfo(MS2DATA) WHERE MS2PROD={first:.4f}:TOLERANCEMZ=0.01 "
+                                f"AND MS2PROD={second:.4f}:TOLERANCEPPM=20",
+            f"precursor and loss {scan}": f"QUERY scaninfo(MS2DATA) WHERE MS2PREC={precursor:.4f}:TOLERANCEMZ=0.01 "
+                                          f"AND MS2NL={precursor - second:.3f}:TOLERANCEMZ=0.01",
+            f"intensity {scan}": f"QUERY scannum(MS2DATA) WHERE MS2PROD={first:.2f}:TOLERANCEMZ=0.1:"
+                                 f"INTENSITYPERCENT=50 AND MS2PROD=({second:.2f} OR 1000):TOLERANCEMZ=0.1:"
+                                 f"INTENSITYVALUE=100",
+            f"cardinality {scan}": f"QUERY scaninfo(MS2DATA) WHERE MS2PROD=({first:.3f} OR {second:.3f} OR "
+                                   f"{precursor:.3f}):TOLERANCEMZ=0.01:CARDINALITY=range(min=2, max=3)",
+        })
+    return queries
+
+
+def builtin_queries() -> dict:
+    custom_queries = {}
+    for group in ("Bile acids (stage 1) queries", "Bile acids (stage 2) queries", "Compendium"):
+        custom_queries.update({query_name: input_query for query_name, input_query in ALL_QUERIES[group].items()
+                               if query_name not in SLOW_QUERIES})
+    return custom_queries
+
+
+@pytest.fixture(scope="module")
+def spectra(task):
+    return query_engine.load_task_spectra(task["mgf_path"])
+
+
+@pytest.fixture(scope="module")
+def reference_mgf(task, tmp_path_factory):
+    """Copy of the cleaned MGF that massql parses itself, without the feather cache written from the spectra store."""
+    path = str(tmp_path_factory.mktemp("reference") / "reference.mgf")
+    shutil.copyfile(task["mgf_path"], path)
+    return path
+
+
+@pytest.fixture(scope="module")
+def test_queries(spectra):
+    return dict(builtin_queries(), **generated_queries(spectra[1]))
+
+
+def massql_scans(input_query: str, mgf_path: str) -> list:
+    """Scans matching a query, as the massql command line computes them."""
+    from massql import msql_engine
+
+    scans = set()
+    for query in split_queries(input_query):
+        try:
+            results_df = msql_engine.process_query(query, mgf_path)
+        except KeyError:
+            continue
+        if len(results_df) == 0:
+            continue
+        scans.update(int(scan) for scan in results_df["scan"].values.tolist())
+    return sorted(scans)
+
+
+def test_feather_cache_is_committed_to_the_store(task, spectra):
+    from massql import msql_fileloading
+
+    for df, filename in zip(spectra, msql_fileloading._determine_feather_cache_filename(task["mgf_path"])):
+        assert task["store"].verify(os.path.basename(filename))
+        assert pd.read_feather(filename).equals(df)
+    assert not [name for name in os.listdir(task["store"].root) if name.endswith(".tmp")]
+
+
+def test_generated_queries_take_fast_path(spectra):
+    for input_query in generated_queries(spectra[1]).values():
+        assert all(query_engine._fast_path_conditions(plan) is not None for plan in get_plan_cache().plan(input_query))
+
+
+def test_run_query_matches_massql(task, spectra, reference_mgf, test_queries):
+    ms1_df, ms2_df = spectra
+    matched = 0
+    for query_name, input_query in test_queries.items():
+        expected = massql_scans(input_query, reference_mgf)
+        assert sorted(set(query_engine.run_query(input_query, task["mgf_path"], ms1_df, ms2_df))) == expected, \
+            query_name
+        matched += bool(expected)
+    # The comparison is only meaningful if queries do match
+    assert matched >= len(test_queries) // 4
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_chunked_queries_match_whole_task(task, test_queries, monkeypatch, capsys, workers):
+    # Forked workers start with a plan cache of their own, in temp_mgf/, unless given the plans.
+    # massql modifies the plans it evaluates, so each run gets its own copy.
+    plans = prepare_queries(test_queries)
+    monkeypatch.setattr(query_engine, "MEMORY_BUDGET_MB", 0)
+    whole = query_engine.run_queries(test_queries, task["mgf_path"], workers, plans=copy.deepcopy(plans))
+
+    # A few thousand peaks per chunk, whatever the number of workers
+    budget_mb = 2000 * query_engine._BYTES_PER_PEAK / 1024 ** 2
+    monkeypatch.setattr(query_engine, "MEMORY_BUDGET_MB", budget_mb * workers)
+    assert len(query_engine._spectrum_chunks(task["mgf_path"], budget_mb)) > 2
+    capsys.readouterr()
+    chunked = query_engine.run_queries(test_queries, task["mgf_path"], workers, plans=copy.deepcopy(plans))
+    output = capsys.readouterr().out
+    assert "chunks of spectra" in output and "whole task instead" not in output
+
+    assert [result["query"] for result in chunked] == list(test_queries)
+    assert [sorted(result["scan_list"]) for result in chunked] == [sorted(result["scan_list"]) for result in whole]
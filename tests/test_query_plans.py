@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from query_plans import PlanCache, QueryError, parse_query
+from queries import ALL_QUERIES
+
+INVALID_QUERY = "QUERY scaninfo(MS2DATA) WHERE MS2PROD="
+
+
+def test_plan_cache_parses_in_worker_pool(tmp_path):
+    queries = list(ALL_QUERIES["Bile acids (stage 1) queries"].values())[:3]
+    plan_cache = PlanCache(str(tmp_path), workers=2)
+    futures = [plan_cache.submit(input_query) for input_query in queries + [INVALID_QUERY]]
+
+    for input_query, future in zip(queries, futures):
+        assert future.result(timeout=120) == {"plans": parse_query(input_query)}
+        assert plan_cache.plan(input_query) == parse_query(input_query)
+    assert "error" in futures[-1].result(timeout=120)
+    with pytest.raises(QueryError):
+        plan_cache.plan(INVALID_QUERY)
+    assert plan_cache._pool is not None
+
+    # Another process reads the stored plans instead of parsing them again
+    assert len(os.listdir(tmp_path)) == len(queries) + 1
+    other = PlanCache(str(tmp_path), workers=2)
+    assert other.plan(queries[0]) == parse_query(queries[0])
+    assert other._pool is None
+
+
+def test_plan_cache_survives_a_dead_worker(tmp_path):
+    plan_cache = PlanCache(str(tmp_path), workers=1)
+    input_query = list(ALL_QUERIES["Bile acids (stage 1) queries"].values())[0]
+    pool = plan_cache._parse_pool()
+    # Make the pool unusable, as when a worker is killed
+    pool._broken = "a worker was killed"
+
+    assert plan_cache.plan(input_query) == parse_query(input_query)
+    assert plan_cache._pool is None
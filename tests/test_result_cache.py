@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+from query_plans import parse_query
+from queries import ALL_QUERIES
+from result_cache import ResultCache, normalize_query
+
+QUERY = "QUERY scaninfo(MS2DATA) WHERE MS2PROD=184.07:TOLERANCEMZ=0.01 AND MS2NL=59.07:TOLERANCEMZ=0.01"
+COMMENTED_QUERY = (
+    "# Phosphocholines\n"
+    "QUERY scaninfo(MS2DATA) WHERE  # any MS2 spectrum\n"
+    "\tMS2PROD=184.07:TOLERANCEMZ=0.01\n"
+    "\n"
+    "   AND MS2NL=59.07:TOLERANCEMZ=0.01 # trimethylamine loss\n"
+)
+
+
+def conditions(input_query: str) -> list:
+    """The parsed queries, without the query text massql keeps in them."""
+    return [{key: value for key, value in plan.items() if key != "query"} for plan in parse_query(input_query)]
+
+
+@pytest.mark.parametrize("edited", [
+    QUERY.replace(" ", "  "),
+    f"  {QUERY}\t\n\n",
+    f"# phosphocholines\n{QUERY}",
+    f"{QUERY} # a comment",
+])
+def test_cosmetic_edits_share_cache_entry(edited):
+    assert conditions(edited) == conditions(QUERY)
+    assert normalize_query(edited) == QUERY
+
+
+def test_comments_do_not_swallow_the_next_lines():
+    normalized = normalize_query(COMMENTED_QUERY)
+    assert normalized == ("QUERY scaninfo(MS2DATA) WHERE\n"
+                          "MS2PROD=184.07:TOLERANCEMZ=0.01\n"
+                          "AND MS2NL=59.07:TOLERANCEMZ=0.01")
+    # The normalized query is still the query that was run
+    assert conditions(normalized) == conditions(COMMENTED_QUERY)
+
+    # A query that differs only after the comment is a different query
+    other = COMMENTED_QUERY.replace("MS2NL=59.07", "MS2NL=60.08")
+    assert normalize_query(other) != normalized
+
+
+def test_queries_joined_with_separator():
+    # Split before the comments are stripped, as the massql command line does
+    joined = f"{QUERY} # first |||  {QUERY.replace('184.07', '104.11')}  "
+    assert normalize_query(joined) == f"{QUERY}|||{QUERY.replace('184.07', '104.11')}"
+    assert conditions(normalize_query(joined)) == conditions(joined)
+
+
+def test_builtin_queries_parse_the_same_once_normalized():
+    for input_query in ALL_QUERIES["Bile acids (stage 1) queries"].values():
+        assert conditions(normalize_query(input_query)) == conditions(input_query)
+
+
+def test_cache_round_trip_and_eviction(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=2 ** 62)
+    assert cache.get("task", QUERY, "hash") is None
+    cache.put("task", COMMENTED_QUERY, "hash", [3, 1, 2])
+    assert cache.get("task", COMMENTED_QUERY.replace("  #", " #"), "hash") == [3, 1, 2]
+    assert cache.get("task", QUERY, "hash") is None
+    assert cache.get("other task", COMMENTED_QUERY, "hash") is None
+    assert cache.get("task", COMMENTED_QUERY, "other hash") is None
+
+    cache.put("task", QUERY, "hash", [1])
+    os.utime(cache._entry_path("task", QUERY, "hash"), (0, 0))
+    cache.max_bytes = os.path.getsize(cache._entry_path("task", COMMENTED_QUERY, "hash"))
+    cache.evict()
+    assert cache.get("task", QUERY, "hash") is None
+    assert cache.get("task", COMMENTED_QUERY, "hash") == [3, 1, 2]
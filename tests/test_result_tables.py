@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from pipeline import build_result_tables
+from utils import create_mirrorplot_link
+
+FALLBACK_LABEL = "Did not pass any selected query"
+
+
+def baseline_result_tables(query_results: list, library_matches: pd.DataFrame, all_scans: list,
+                           pepmass_list: list, task_id: str) -> (pd.DataFrame, pd.DataFrame):
+    """The merges build_result_tables replaced: exploded query results joined on text scan ids."""
+    results_df = pd.DataFrame(query_results).explode("scan_list")
+    results_df = results_df.rename(columns={"scan_list": "#Scan#", "query": "query_validation"})
+    results_df["#Scan#"] = results_df["#Scan#"].astype(str)
+    library_matches = library_matches.assign(**{"#Scan#": library_matches["#Scan#"].astype(str)})
+
+    library_final = pd.merge(library_matches, results_df, on="#Scan#", how="left")
+    library_final["query_validation"] = library_final["query_validation"].fillna(FALLBACK_LABEL)
+    create_mirrorplot_link(library_final, task_id)
+    library_final = library_final.groupby("#Scan#", as_index=False).agg({
+        "query_validation": lambda x: ", ".join(set(x)),
+        **{col: "first" for col in library_final.columns if col not in ["#Scan#", "query_validation"]},
+    })
+
+    all_scans_df = pd.DataFrame({"#Scan#": all_scans})
+    all_scans_df["#Scan#"] = all_scans_df["#Scan#"].astype(str)
+    all_scans_df["pepmass"] = pepmass_list
+    full_table = pd.merge(all_scans_df, results_df, on="#Scan#", how="left")
+    full_table = pd.merge(full_table, library_matches, on="#Scan#", how="left")
+    full_table["query_validation"] = full_table["query_validation"].fillna(FALLBACK_LABEL)
+    create_mirrorplot_link(full_table, task_id)
+    col_order = ["#Scan#", "pepmass", "mirror_link", "query_validation", "Compound_Name"]
+    full_table = full_table.groupby("#Scan#", as_index=False).agg({
+        "query_validation": lambda x: ", ".join(set(x)),
+        **{col: "first" for col in full_table.columns if col not in col_order},
+    })
+    return library_final, full_table
+
+
+def assert_same_table(table: pd.DataFrame, expected: pd.DataFrame):
+    """Same scans, query sets and other columns; the baseline listed the queries of a scan in any order."""
+    assert set(expected.columns) <= set(table.columns)
+    columns = list(expected.columns)
+
+    def normalized(df):
+        df = df[columns].assign(**{
+            "#Scan#": df["#Scan#"].astype(str),
+            "query_validation": [frozenset(labels.split(", ")) for labels in df["query_validation"]],
+        })
+        df = df.sort_values("#Scan#", ignore_index=True).astype(object)
+        return df.where(df.notna(), None)
+
+    pd.testing.assert_frame_equal(normalized(table), normalized(expected), check_dtype=False)
+
+
+def query_results_of(scans: list, seed: int = 0) -> list:
+    """Results of a few queries on random scans, some listed twice and one not in the task."""
+    rng = np.random.default_rng(seed)
+    scans = np.asarray(scans)
+    query_results = []
+    for i, size in enumerate([0, 1, len(scans) // 10, len(scans) // 3]):
+        scan_list = [int(scan) for scan in rng.choice(scans, size=size, replace=False)]
+        query_results.append({"query": f"query {i}", "scan_list": scan_list + scan_list[:2] + [10 ** 9]})
+    return query_results
+
+
+def test_result_tables_match_baseline(task):
+    query_results = query_results_of([int(scan) for scan in task["scan_list"]])
+    args = (query_results, task["library_matches"], task["scan_list"], task["pepmass_list"], task["task_id"])
+    library_final, full_table = build_result_tables(*args)
+    expected_library, expected_full = baseline_result_tables(*args)
+
+    assert_same_table(library_final, expected_library)
+    assert_same_table(full_table, expected_full)
+    assert full_table["pepmass"].tolist() == [
+        pepmass for _, pepmass in sorted(zip(map(int, task["scan_list"]), task["pepmass_list"]))]
+
+
+@pytest.mark.parametrize("all_scans", [["1", "2", "10", "x3"], ["1", "2", "10", "3"]])
+def test_result_tables_with_text_scan_ids_match_baseline(all_scans):
+    library_matches = pd.DataFrame({"#Scan#": ["2", "10", "10", all_scans[-1], "99"],
+                                    "SpectrumID": ["CCMSLIB1", "CCMSLIB2", "CCMSLIB3", "CCMSLIB4", "CCMSLIB5"],
+                                    "Compound_Name": ["a", "b", "c", "d", "e"]})
+    query_results = [{"query": "q1", "scan_list": [1, 10, 1000]}, {"query": "q2", "scan_list": [10, 99]},
+                     {"query": "q3", "scan_list": []}]
+    args = (query_results, library_matches, all_scans, ["100.1", "200.2", "300.3", "400.4"], "task")
+    library_final, full_table = build_result_tables(*args)
+    expected_library, expected_full = baseline_result_tables(*args)
+
+    assert_same_table(library_final, expected_library)
+    assert_same_table(full_table, expected_full)
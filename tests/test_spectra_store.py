@@ -0,0 +1,60 @@
+import os
+
+import pandas as pd
+import pytest
+
+import spectra_store
+from artifact_store import ArtifactStore
+from spectra_store import SpectraStoreBuilder, open_spectra_store, peak_tables_from_store
+from utils import _scan_info_from_store, clean_mgf_file
+
+
+def test_scan_info_of_stored_task_matches_first_run(task):
+    # A later run reads the scans and precursors from the spectra store; they must be the
+    # text values of the first run, as the result tables and exports use them
+    cleaned_name = f"{task['task_id']}_mgf_cleaned.mgf"
+    assert _scan_info_from_store(task["store"], task["task_id"], cleaned_name) == \
+        (task["scan_list"], task["pepmass_list"])
+
+
+def test_scan_info_of_task_without_spectra_store(tmp_path, raw_dataset):
+    # Cleaned before the spectra store existed: it is built from the cleaned MGF
+    store = ArtifactStore(str(tmp_path), max_bytes=2 ** 62)
+    cleaned_name = "task_mgf_cleaned.mgf"
+    expected = clean_mgf_file(raw_dataset[0], store.path(cleaned_name))
+    assert _scan_info_from_store(store, "task", cleaned_name) == expected
+
+
+@pytest.mark.parametrize("flush_values", [1, 100, 64 * 1024])
+def test_peak_tables_from_store_match_massql(tmp_path, task, monkeypatch, flush_values):
+    # Columns written in chunks of any size, with a spectrum left open at the end of the file
+    from massql import msql_fileloading
+
+    monkeypatch.setattr(spectra_store, "_FLUSH_VALUES", flush_values)
+    mgf_path = str(tmp_path / "task_mgf_cleaned.mgf")
+    with open(task["mgf_path"], "r") as fin, open(mgf_path, "w") as fout:
+        fout.write(fin.read() + "BEGIN IONS\nPEPMASS=500\nSCANS=999999\n90.0 1.0\n")
+    store = ArtifactStore(str(tmp_path / "store"), max_bytes=2 ** 62)
+    builder = SpectraStoreBuilder(store, "task")
+    with open(mgf_path, "r") as f:
+        for line in f:
+            builder.add_line(line)
+            assert all(len(column.values) <= flush_values + 100 for column in builder.columns.values())
+    builder.write()
+    builder.discard()
+    assert not [name for name in os.listdir(store.root) if name.endswith(".tmp")]
+
+    ms1_df, ms2_df = peak_tables_from_store(open_spectra_store(store, "task"))
+    expected_ms1_df, expected_ms2_df = msql_fileloading.load_data(mgf_path)
+    expected_ms2_df["scan"] = expected_ms2_df["scan"].astype(int)
+    pd.testing.assert_frame_equal(ms2_df, expected_ms2_df[ms2_df.columns], check_dtype=False)
+    assert len(ms1_df) == len(expected_ms1_df)
+
+
+def test_discarded_builder_leaves_no_files(tmp_path):
+    store = ArtifactStore(str(tmp_path), max_bytes=2 ** 62)
+    builder = SpectraStoreBuilder(store, "task")
+    builder.add_line("BEGIN IONS\n")
+    builder.add_line("50.0 1.0\n")
+    builder.discard()
+    assert not [name for name in os.listdir(store.root) if name.startswith("task")]
@@ -1,9 +1,22 @@
+import codecs
+import hashlib
+import json
 import os
+import threading
 import urllib.parse
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from io import IncrementalNewlineDecoder
 
 import pandas as pd
-from gnpsdata import taskresult, workflow_fbmn, taskinfo
+
+import gnps2_client
+from artifact_store import ArtifactStore
+from mgf_index import MgfIndexBuilder, build_mgf_index, iter_validated_mgf, open_mgf_index
+from perf import PerfRecorder
+from spectra_store import SpectraStoreBuilder, add_scan_info, build_spectra_store, open_spectra_store
+
+# Read size used when streaming MGF files
+MGF_CHUNK_SIZE = 1024 * 1024
 
 
 def get_git_short_rev():
@@ -16,85 +29,270 @@ def get_git_short_rev():
         return ".git/ not found"
 
 
-def gnps2_download_resultfile_wrapper(mgf_file_path, task_id):
-    return taskresult.download_gnps2_task_resultfile(task_id, "nf_output/clustering/specs_ms.mgf", mgf_file_path)
+# Location of the spectra MGF in the results of each supported GNPS2 workflow
+MGF_RESULT_PATHS = {
+    "feature_based_molecular_networking_workflow": "nf_output/clustering/spectra_reformatted.mgf",
+    "classical_networking_workflow": "nf_output/clustering/specs_ms.mgf",
+}
 
 
-def fbmn_download_mgf_wrapper(mgf_file_path, task_id):
-    return workflow_fbmn.download_mgf(task_id, mgf_file_path)
+# Library matches of the molecular networking workflows
+LIBRARY_RESULT_PATH = 'nf_output/library/merged_results_with_gnps.tsv'
 
 
-def gnps2_get_libray_dataframe_wrapper(task_id):
-    return taskresult.get_gnps2_task_resultfile_dataframe(task_id, 'nf_output/library/merged_results_with_gnps.tsv')
+def iter_chunks(file_obj, chunk_size: int = MGF_CHUNK_SIZE):
+    """Read a file in fixed-size chunks."""
+    return iter(lambda: file_obj.read(chunk_size), "")
 
 
-def download_and_filter_mgf(task_id: str) -> (str, list, list):
-    os.makedirs("temp_mgf", exist_ok=True)
-    mgf_file_path = f"temp_mgf/{task_id}_mgf_all.mgf"
-    cleaned_mgf = f"temp_mgf/{task_id}_mgf_cleaned.mgf"
+def iter_decoded(byte_chunks, encoding: str = "utf-8"):
+    """
+    Decode a stream of byte chunks the way a text-mode file would: multi-byte characters split
+    across chunks are reassembled and line endings are translated to "\n".
+    """
+    decoder = IncrementalNewlineDecoder(codecs.getincrementaldecoder(encoding)(), translate=True)
+    for chunk in byte_chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
 
-    # Skip if cleaned file already exists
-    if os.path.exists(cleaned_mgf):
-        print(f"Skipping download, using existing file: {cleaned_mgf}")
-        scan_list, pepmass_list = [], []
-        with open(cleaned_mgf, "r") as mgf_file:
-            for line in mgf_file:
-                if line.startswith("SCANS="):
-                    scan_list.append(line.strip().split("=")[1])
-                elif line.startswith("PEPMASS="):
-                    pepmass_list.append(line.strip().split("=")[1].split()[0])
-        return cleaned_mgf, scan_list, pepmass_list
-
-    task_info = taskinfo.get_task_information(task_id)
-    workflowname = task_info.get('workflowname')
-    if workflowname == 'feature_based_molecular_networking_workflow':
-        fbmn_download_mgf_wrapper(mgf_file_path, task_id)
-    elif workflowname == 'classical_networking_workflow':
-        gnps2_download_resultfile_wrapper(mgf_file_path, task_id)
-    else:
-        raise ValueError(f"Unsupported workflow: {workflowname}. Cannot download MGF.")
 
-    scan_list, pepmass_list = [], []
-    with open(mgf_file_path, "r") as mgf_file:
-        lines = mgf_file.readlines()
+def iter_mgf_lines(chunks):
+    """Split a stream of text chunks into lines, keeping the line endings."""
+    remainder = ""
+    for chunk in chunks:
+        lines = (remainder + chunk).split("\n")
+        remainder = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if remainder:
+        yield remainder
+
+
+def _is_peak_line(line: str) -> bool:
+    parts = line.split()
+    return len(parts) == 2 and all(part.replace(".", "", 1).isdigit() for part in parts)
 
-    cleaned_mgf_lines = []
-    inside_scan = False
-    current_scan = []
+
+def iter_cleaned_mgf(lines):
+    """
+    Drop the spectra without any valid "m/z intensity" peak line from a stream of MGF lines.
+
+    Only the current spectrum is buffered, and once a valid peak has been seen its remaining
+    lines are not checked anymore. Lines outside BEGIN/END IONS blocks are passed through.
+    """
+    current_scan = None
+    has_peak = False
     for line in lines:
         if line.startswith("BEGIN IONS"):
-            inside_scan = True
             current_scan = [line]  # Start a new scan block
+            has_peak = False
         elif line.startswith("END IONS"):
+            if current_scan is not None:
+                current_scan.append(line)
+                if has_peak:
+                    yield from current_scan
+            current_scan = None
+        elif current_scan is not None:
             current_scan.append(line)
-            if any(
-                len(peak.split()) == 2
-                and all(part.replace(".", "", 1).isdigit() for part in peak.split())
-                for peak in current_scan
-            ):
-                cleaned_mgf_lines.extend(current_scan)
-            inside_scan = False
-        elif inside_scan:
-            current_scan.append(line)
+            has_peak = has_peak or _is_peak_line(line)
         else:
-            cleaned_mgf_lines.append(line)
+            yield line
+
 
-    with open(cleaned_mgf, "w") as fout:
-        fout.writelines(cleaned_mgf_lines)
+def clean_mgf_lines(lines, output_path: str, builder: SpectraStoreBuilder = None,
+                    index: MgfIndexBuilder = None) -> (list, list):
+    """
+    Write the cleaned version of a stream of MGF lines to a file.
 
-    # Extract all scan numbers from the cleaned MGF file
-    with open(cleaned_mgf, "r") as mgf_file:
+    Args:
+        lines: MGF lines, e.g. from iter_mgf_lines()
+        output_path (str): Path of the cleaned MGF
+        builder (SpectraStoreBuilder): Optionally fed every cleaned line, so that the binary
+            spectra store is built in the same pass
+        index (MgfIndexBuilder): Optionally fed every cleaned line, to record the byte offsets
+            of the spectra in the output
+
+    Returns:
+        tuple: (scan_list, pepmass_list) collected from the cleaned spectra, as text
+    """
+    if builder is not None:
+        # The builder collects the same values, to keep them in the spectra store
+        scan_list, pepmass_list = builder.scan_text, builder.pepmass_text
+    else:
+        scan_list, pepmass_list = [], []
+    with open(output_path, "w", encoding="utf-8") as fout:
+        for line in iter_cleaned_mgf(lines):
+            if builder is not None:
+                builder.add_line(line)
+            else:
+                add_scan_info(line, scan_list, pepmass_list)
+            if index is not None:
+                index.add_line(line)
+            fout.write(line)
+    return scan_list, pepmass_list
+
+
+def clean_mgf_file(input_path: str, output_path: str, chunk_size: int = MGF_CHUNK_SIZE,
+                   builder: SpectraStoreBuilder = None, index: MgfIndexBuilder = None) -> (list, list):
+    """Write a cleaned copy of an MGF file in a single streaming pass, see clean_mgf_lines()."""
+    with open(input_path, "r") as fin:
+        return clean_mgf_lines(iter_mgf_lines(iter_chunks(fin, chunk_size)), output_path, builder, index)
+
+
+def _scan_info_from_store(store: ArtifactStore, task_id: str, cleaned_name: str):
+    """
+    (scan_list, pepmass_list) of a cleaned MGF, read from its spectra store when possible.
+
+    The store keeps the values as written in the MGF, so they are the same as on the run
+    that downloaded the task.
+    """
+    spectra = open_spectra_store(store, task_id)
+    if spectra is None and build_spectra_store(store, task_id, store.path(cleaned_name)):
+        spectra = open_spectra_store(store, task_id)
+
+    if spectra is not None:
+        return spectra["scan_text"].tolist(), spectra["pepmass_text"].tolist()
+
+    scan_list, pepmass_list = [], []
+    with open(store.path(cleaned_name), "r") as mgf_file:
         for line in mgf_file:
-            if line.startswith("SCANS="):
-                scan_list.append(line.strip().split("=")[1])
-            elif line.startswith("PEPMASS="):
-                pepmass_list.append(line.strip().split("=")[1].split()[0])
+            add_scan_info(line, scan_list, pepmass_list)
+    return scan_list, pepmass_list
+
+
+def download_library_table(task_id: str, store: ArtifactStore = None, perf: PerfRecorder = None,
+                           cancelled: threading.Event = None) -> pd.DataFrame:
+    """
+    Library matches of a task, downloaded once into the artifact store and read from there afterwards.
+
+    Args:
+        task_id (str): GNPS2 task ID
+        store (ArtifactStore): Store of the task files
+        perf (PerfRecorder): Optionally counts the hits and misses of the stored table
+        cancelled (threading.Event): Stops the download when set, see gnps2_client.iter_resultfile()
+
+    Returns:
+        pd.DataFrame: The library matches table
+    """
+    store = store or ArtifactStore()
+    library_name = f"{task_id}_library.tsv"
+
+    # A lock of its own, so that the table is fetched while the MGF download holds the task lock
+    with store.task_lock(task_id, "library"):
+        cached = store.verify(library_name)
+        if perf is not None:
+            perf.count("library_file", cached)
+        if cached:
+            store.touch(library_name)
+        else:
+            part_path = store.path(f"{library_name}.part")
+            for _ in gnps2_client.iter_resultfile(task_id, LIBRARY_RESULT_PATH, part_path, cancelled=cancelled):
+                pass
+            store.commit(task_id, library_name, part_path)
+        return pd.read_csv(store.path(library_name), sep="\t")
+
+
+def download_and_filter_mgf(task_id: str, store: ArtifactStore = None, perf: PerfRecorder = None,
+                            cancelled: threading.Event = None) -> (str, list, list):
+    store = store or ArtifactStore()
+    mgf_name = f"{task_id}_mgf_all.mgf"
+    cleaned_name = f"{task_id}_mgf_cleaned.mgf"
+    cleaned_mgf = store.path(cleaned_name)
+
+    # Concurrent sessions on the same task wait here for a single download
+    with store.task_lock(task_id):
+        # Skip if a complete cleaned file already exists
+        cached = store.verify(cleaned_name)
+        if perf is not None:
+            perf.count("task_files", cached)
+        if cached:
+            print(f"Skipping download, using existing file: {cleaned_mgf}")
+            store.touch(cleaned_name)
+            scan_list, pepmass_list = _scan_info_from_store(store, task_id, cleaned_name)
+            return cleaned_mgf, scan_list, pepmass_list
+
+        task_info = gnps2_client.get_task_information(task_id)
+        workflowname = task_info.get('workflowname')
+        if workflowname not in MGF_RESULT_PATHS:
+            raise ValueError(f"Unsupported workflow: {workflowname}. Cannot download MGF.")
+
+        # The MGF is cleaned as it arrives; the raw bytes are kept in a .part file so that an
+        # interrupted download resumes where it stopped
+        part_path = store.path(f"{mgf_name}.part")
+        builder = SpectraStoreBuilder(store, task_id)
+        index = MgfIndexBuilder()
+        try:
+            with store.atomic_write(task_id, cleaned_name) as tmp_path:
+                byte_chunks = gnps2_client.iter_resultfile(task_id, MGF_RESULT_PATHS[workflowname], part_path,
+                                                           cancelled=cancelled)
+                scan_list, pepmass_list = clean_mgf_lines(iter_mgf_lines(iter_decoded(byte_chunks)), tmp_path,
+                                                          builder, index)
+            store.commit(task_id, mgf_name, part_path)
+            index.write(store, task_id)
+            if builder.valid:
+                builder.write()
+        finally:
+            builder.discard()
+
+    # Keep the shared volume under its byte budget
+    store.evict(keep={task_id})
 
     return cleaned_mgf, scan_list, pepmass_list
 
 
-def insert_mgf_info(task: str, input_mgf: str, validation_df: pd.DataFrame) -> StringIO:
+def fetch_task_data(task_id: str, store: ArtifactStore = None, perf: PerfRecorder = None,
+                    cancelled: threading.Event = None) -> (pd.DataFrame, str, list, list):
+    """
+    Fetch the library matches and the cleaned MGF of a task concurrently.
+
+    The library table is downloaded while the task information is looked up and the MGF is
+    streamed into the cleaner. The MGF is cleaned as it arrives, so its download and cleaning
+    are measured as a single stage. Both files are kept in the artifact store, and a fetch of
+    the same task already in progress, e.g. a prefetch, is waited for instead of repeated.
+    Setting `cancelled` stops both downloads with gnps2_client.DownloadCancelled.
+
+    Returns:
+        tuple: (library_matches, cleaned_mgf_path, scan_list, pepmass_list)
+    """
+    perf = perf or PerfRecorder(log_paths=())
+
+    def fetch_library():
+        with perf.stage("library_download") as fields:
+            library_matches = download_library_table(task_id, store, perf, cancelled)
+            fields["rows"] = len(library_matches)
+        return library_matches
+
+    def fetch_mgf():
+        with perf.stage("mgf_download_and_clean") as fields:
+            cleaned_mgf_path, scan_list, pepmass_list = download_and_filter_mgf(task_id, store, perf, cancelled)
+            fields["scans"] = len(scan_list)
+        return cleaned_mgf_path, scan_list, pepmass_list
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        library_future = pool.submit(fetch_library)
+        mgf_future = pool.submit(fetch_mgf)
+        cleaned_mgf_path, scan_list, pepmass_list = mgf_future.result()
+        library_matches = library_future.result()
+    return library_matches, cleaned_mgf_path, scan_list, pepmass_list
+
+
+def insert_mgf_info(task: str, input_mgf: str, validation_df: pd.DataFrame, store: ArtifactStore = None) -> str:
+    """
+    Write the spectra that passed validation, annotated with a MASSQL_VALIDATION line, to a file.
+
+    The spectra are located through the byte-offset index of the cleaned MGF and streamed to
+    disk in chunks. The export is kept in the artifact store, keyed by the validation
+    content, so asking for the same export again reuses it.
+
+    Returns:
+        str: Path of the validated MGF
+    """
     print(f"Inserting MGF info for task {task}...")
+    store = store or ArtifactStore()
 
     mask = ~validation_df["query_validation"].str.contains('Did not pass any selected query', na=True, case=False)
     valid_scans = set(
@@ -108,66 +306,64 @@ def insert_mgf_info(task: str, input_mgf: str, validation_df: pd.DataFrame) -> S
         ) if k != -1
     }
 
-    buffer = StringIO()
-    spectrum_lines = []
-    skip_spectrum = False
+    digest = hashlib.sha256(json.dumps([store.checksum(os.path.basename(input_mgf)), sorted(
+        (scan, str(scan_to_validation.get(scan))) for scan in valid_scans)]).encode()).hexdigest()
+    export_name = f"{task}_validated_{digest[:16]}.mgf"
+    if store.exists(export_name):
+        store.touch(export_name)
+        return store.path(export_name)
+
     print(f"Processing MGF file: {input_mgf}")
     print(f"Filtering to {len(valid_scans)} scans that passed validation (out of {len(validation_df)} total scans)")
 
-    file_contents = open(input_mgf, "r").readlines()
-    for line in file_contents:
-        if line.startswith("BEGIN IONS"):
-            spectrum_lines = [line]
-            skip_spectrum = False
-        elif line.startswith("SCANS"):
-            scan_number = int(line.split("=")[1].strip())
-            spectrum_lines.append(line)
+    with store.task_lock(task):
+        index = open_mgf_index(store, task)
+        if index is None:
+            build_mgf_index(store, task, input_mgf)
+            index = open_mgf_index(store, task)
 
-            if scan_number not in valid_scans:
-                skip_spectrum = True
-                continue
+        with store.atomic_write(task, export_name) as tmp_path:
+            with open(tmp_path, "wb") as fout:
+                for chunk in iter_validated_mgf(input_mgf, index, valid_scans, scan_to_validation):
+                    fout.write(chunk)
 
-            validation_status = scan_to_validation.get(scan_number, "Unknown")
+    print(f"Processed {input_mgf}")
+    return store.path(export_name)
 
-            insert_string = f"MASSQL_VALIDATION={validation_status}\n"
 
-            for prev_line in spectrum_lines[:-1]:
-                buffer.write(prev_line)
-            buffer.write(insert_string)
-            buffer.write(line)
-            spectrum_lines = []
+def _quote_values(values: pd.Series) -> pd.Series:
+    """urllib.parse.quote() of every value, computed once per distinct value."""
+    if pd.api.types.is_integer_dtype(values):
+        # Digits and "-" are never escaped
+        return values.astype(str)
+    values = values.astype(str)
+    # Only values with characters outside quote()'s always-safe set need escaping
+    needs_quoting = ~values.str.fullmatch(r"[A-Za-z0-9_.~/-]*")
+    if needs_quoting.any():
+        uniques = values[needs_quoting].unique()
+        values = values.copy()
+        values[needs_quoting] = values[needs_quoting].map(
+            dict(zip(uniques, (urllib.parse.quote(value) for value in uniques))))
+    return values
 
-        elif line.startswith("END IONS"):
-            if not skip_spectrum:
-                spectrum_lines.append(line)
-                for spectrum_line in spectrum_lines:
-                    buffer.write(spectrum_line)
-            spectrum_lines = []
-        else:
-            if not skip_spectrum:
-                if spectrum_lines:
-                    spectrum_lines.append(line)
-                else:
-                    buffer.write(line)
-    print(f"Processed {input_mgf}")
-    buffer.seek(0)
-    return buffer
+
+def mirrorplot_links(scans: pd.Series, spectrum_ids: pd.Series, task_id: str) -> pd.Series:
+    """
+    Mirror plot links of the given scans, against their library spectrum when there is one.
+
+    Quoting is applied per character, so the constant USI prefixes are quoted once and the
+    links are assembled with column-wise string concatenation. Only pass the rows that need
+    a link, e.g. the ones being displayed.
+    """
+    scan_prefix = "https://metabolomics-usi.gnps2.org/dashinterface/?usi1=" + urllib.parse.quote(
+        f"mzspec:GNPS2:TASK-{task_id}-nf_output/clustering/spectra_reformatted.mgf:scan:")
+    library_prefix = "&usi2=" + urllib.parse.quote("mzspec:GNPS:GNPS-LIBRARY:accession:")
+
+    links = scan_prefix + _quote_values(scans)
+    has_library = spectrum_ids.notna()
+    links[has_library] = links[has_library] + library_prefix + _quote_values(spectrum_ids[has_library])
+    return links
 
 
 def create_mirrorplot_link(result_df: pd.DataFrame, task_id: str):
-    result_df['mirror_link'] = result_df.apply(
-        lambda x:
-            "https://metabolomics-usi.gnps2.org/dashinterface/?usi1="
-            + urllib.parse.quote(
-                f"mzspec:GNPS2:TASK-{task_id}-nf_output/clustering/spectra_reformatted.mgf:scan:{x['#Scan#']}"
-            )
-            + "&usi2="
-            + urllib.parse.quote(
-                f"mzspec:GNPS:GNPS-LIBRARY:accession:{x['SpectrumID']}"
-            ) if pd.notna(x['SpectrumID']) else
-            "https://metabolomics-usi.gnps2.org/dashinterface/?usi1="
-            + urllib.parse.quote(
-                f"mzspec:GNPS2:TASK-{task_id}-nf_output/clustering/spectra_reformatted.mgf:scan:{x['#Scan#']}"
-            ),
-        axis=1
-    )
+    result_df['mirror_link'] = mirrorplot_links(result_df['#Scan#'], result_df['SpectrumID'], task_id)
@@ -0,0 +1,44 @@
+"""
+Precompute the app's example analysis and parse the built-in queries, e.g. when the server starts.
+
+The example job is written to the jobs folder like any analysis, so the first visitor who runs
+the example attaches to it instead of starting it again, whether it is still running here or
+finished (until it expires after MASSQL_JOB_RETENTION_HOURS). Its downloaded task files and query results stay cached after that.
+The parsed built-in queries go to the plan cache shared by every session.
+
+Example:
+    python warmup.py
+    MASSQL_WARMUP=1 ./run_server.sh
+"""
+import sys
+import time
+
+from jobs import DONE, FAILED, JobManager
+from queries import ALL_QUERIES, EXAMPLE_QUERY_GROUP, EXAMPLE_TASK_ID
+from query_plans import QueryError, prepare_queries
+
+
+def main() -> int:
+    start_time = time.time()
+    manager = JobManager()
+    # Same task and queries as the "Load Example" run of the app, so that it finds this job
+    job_id = manager.submit(EXAMPLE_TASK_ID, dict(ALL_QUERIES[EXAMPLE_QUERY_GROUP]))
+    print(f"Example analysis of task {EXAMPLE_TASK_ID}: job {job_id}")
+
+    for group, custom_queries in ALL_QUERIES.items():
+        try:
+            prepare_queries(custom_queries)
+        except QueryError as e:
+            print(f"{group}: {e}", file=sys.stderr)
+    print(f"Built-in queries parsed after {time.time() - start_time:.1f}s")
+
+    status = manager.status(job_id)
+    while status["state"] not in (DONE, FAILED):
+        time.sleep(1)
+        status = manager.status(job_id)
+    print(f"Example analysis {status['state']} after {time.time() - start_time:.1f}s: {status['message']}")
+    return 0 if status["state"] == DONE else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())